@@ -45,3 +45,52 @@ if not GET_EVENTS_FUNC:
 
 # URL to redirect to to after an occurrence is canceled
 OCCURRENCE_CANCEL_REDIRECT = getattr(settings, 'OCCURRENCE_CANCEL_REDIRECT', None)
+
+# Whether to keep the OccurrenceIndex table up to date and answer occurrence
+# queries from it instead of expanding the rules on every request
+USE_OCCURRENCE_INDEX = getattr(settings, 'USE_OCCURRENCE_INDEX', False)
+
+# Number of days before and after today covered by the OccurrenceIndex when
+# it is built with the rebuild_occurrence_index command
+OCCURRENCE_INDEX_HORIZON = getattr(settings, 'OCCURRENCE_INDEX_HORIZON', 548)
+
+# Maximum number of compiled rrule objects kept by schedule.utils.rrule_cache
+RRULE_CACHE_SIZE = getattr(settings, 'RRULE_CACHE_SIZE', 1024)
+
+# Number of seconds the availability bitmaps of the rooms are cached for.
+# The cached bitmaps are not invalidated when reservations change, so this
+# is 0 (no caching) by default
+AVAILABILITY_CACHE_TIMEOUT = getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 0)
+
+# Number of seconds the pages rendered by schedule.views.room_by_periods are
+# cached for.  The cache keys include the version of the room, which is
+# bumped whenever its reservations change, and the pages are also answered
+# with an ETag so that browsers get a 304 while the room does not change.
+# 0 disables both.  Leave it to 0 if GET_EVENTS_FUNC shows the reservations
+# of other rooms, since their changes do not bump the version of the room
+ROOM_PAGE_CACHE_TIMEOUT = getattr(settings, 'ROOM_PAGE_CACHE_TIMEOUT', 0)
+
+# Callable returning for a request and a room a string which is the same for
+# all of the users who are shown the same pages of the room.  It is part of
+# the cache keys of the rendered pages
+PERMISSION_CLASS_FUNC = getattr(settings, 'PERMISSION_CLASS_FUNC', None)
+if not PERMISSION_CLASS_FUNC:
+    def get_permission_class(request, room):
+        user = request.user
+        if not user.is_authenticated():
+            return 'anonymous'
+        if getattr(settings, 'CHECK_PERMISSION_FUNC', None) or getattr(settings, 'GET_EVENTS_FUNC', None):
+            # the pages may depend on the user
+            return 'user-%s' % user.pk
+        return 'authenticated'
+
+    PERMISSION_CLASS_FUNC = get_permission_class
+
+# Number of seconds the fragments rendered by the month_table, day_cell and
+# daily_table template tags are cached for, under keys including the version
+# of the room and the permission class of the user.  0 disables the cache
+FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 0)
+
+# Number of days recurring reservations without an end are checked for
+# conflicts by Reservation.objects.find_conflicts
+CONFLICT_HORIZON = getattr(settings, 'CONFLICT_HORIZON', 730)
@@ -1,11 +1,14 @@
-from schedule.models import Room
+from schedule.models import Room, Occurrence
+from schedule.models.rules import format_rrule_string
 from django.contrib.syndication.feeds import FeedDoesNotExist
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from schedule.feeds.atom import Feed
-from schedule.feeds.iroom import IRoomFeed
+from schedule.feeds.iroom import IRoomFeed, format_value
 from django.http import HttpResponse
-import datetime, itertools
+from django.shortcuts import get_object_or_404
+import datetime
+from collections import namedtuple
 
 class UpcomingReservationsFeed(Feed):
     feed_id = "upcoming"
@@ -24,8 +27,8 @@ class UpcomingReservationsFeed(Feed):
         return obj.get_absolute_url()
     
     def items(self, obj):
-        return itertools.islice(obj.occurrences_after(datetime.datetime.now()), 
-            getattr(settings, "FEED_LIST_LENGTH", 10))
+        return obj.occurrences_after(datetime.datetime.now(),
+            limit=getattr(settings, "FEED_LIST_LENGTH", 10))
     
     def item_id(self, item):
         return str(item.id)
@@ -45,24 +48,103 @@ class UpcomingReservationsFeed(Feed):
         return "%s \n %s" % (item.reservation.title, item.reservation.description)
 
 
+OccurrenceOverride = namedtuple('OccurrenceOverride',
+    'start end original_start cancelled title')
+
+# an item of RoomIRoom: a reservation, alone or with the persisted occurrence
+# overriding one of its occurrences, and the starts of its cancelled ones
+IRoomItem = namedtuple('IRoomItem', 'reservation occurrence exdates')
+
+
 class RoomIRoom(IRoomFeed):
+    """
+    Every reservation of a room is one VEVENT with its RRULE.  The cancelled
+    persisted occurrences of a recurring reservation are EXDATEs of it, the
+    moved or retitled ones are VEVENTs of their own with a RECURRENCE-ID.
+    """
+    def get_object(self, request, room_id):
+        return get_object_or_404(Room, pk=room_id)
+
     def items(self):
-        cal_id = self.args[1]
-        cal = Room.objects.get(pk=cal_id)
-        
-        return cal.reservations.all()
+        cal = self.obj
+        reservations = cal.reservations.select_related('rule').order_by('pk').iterator()
+        # the persisted occurrences are read as rows, sorted like the
+        # reservations, and joined to them as both are walked
+        rows = Occurrence.objects.filter(reservation__room=cal).order_by(
+            'reservation', 'original_start').values_list('reservation',
+            *OccurrenceOverride._fields).iterator()
+        row = next(rows, None)
+        for reservation in reservations:
+            overrides = []
+            while row is not None and row[0] <= reservation.pk:
+                if row[0] == reservation.pk:
+                    overrides.append(OccurrenceOverride(*row[1:]))
+                row = next(rows, None)
+            for item in self._reservation_items(reservation, overrides):
+                yield item
+
+    def _reservation_items(self, reservation, overrides):
+        if reservation.rule is None:
+            # a single occurrence has no RECURRENCE-ID, the override
+            # replaces the reservation itself
+            yield IRoomItem(reservation, overrides and overrides[0] or None, ())
+            return
+        exdates = [o.original_start for o in overrides if o.cancelled]
+        yield IRoomItem(reservation, None, exdates)
+        duration = reservation.end - reservation.start
+        for occurrence in overrides:
+            if occurrence.cancelled:
+                continue
+            if (occurrence.start != occurrence.original_start or
+                    occurrence.end != occurrence.original_start + duration or
+                    (occurrence.title and occurrence.title != reservation.title)):
+                yield IRoomItem(reservation, occurrence, ())
 
     def item_uid(self, item):
-        return str(item.id)
+        return 'reservation-%s@%s' % (item.reservation.id, self.domain)
 
     def item_start(self, item):
-        return item.start
+        return (item.occurrence or item.reservation).start
 
     def item_end(self, item):
-        return item.end
+        return (item.occurrence or item.reservation).end
 
     def item_summary(self, item):
-        return item.title
-        
+        return (item.occurrence and item.occurrence.title) or item.reservation.title
+
     def item_created(self, item):
-        return item.created_on
\ No newline at end of file
+        return item.reservation.created_on
+
+    def item_properties(self, item):
+        reservation, occurrence = item.reservation, item.occurrence
+        if occurrence is not None:
+            if reservation.rule is None:
+                return occurrence.cancelled and [('status', 'CANCELLED')] or []
+            return [('recurrence_id', occurrence.original_start)]
+        properties = []
+        if reservation.rule is not None:
+            properties.append(('rrule', self._rrule(reservation)))
+            if item.exdates:
+                properties.append(('exdate',
+                    ','.join([format_value(exdate) for exdate in item.exdates])))
+        return properties
+
+    def _rrule(self, reservation):
+        """
+        Returns the RRULE value of a recurring reservation.  The
+        end_recurring_period excludes the occurrences starting at it, while
+        UNTIL includes them, and UNTIL may not go with COUNT, which is then
+        lowered to the number of occurrences before the end.
+        """
+        params = reservation.rule.get_params()
+        until = reservation.end_recurring_period
+        suffix = ''
+        if until is not None:
+            if 'count' in params:
+                params = dict(params)
+                params['count'] = len(reservation.get_rrule_object().between(
+                    reservation.start - datetime.timedelta(seconds=1), until))
+            else:
+                suffix = ';UNTIL=%s' % format_value(until - datetime.timedelta(seconds=1))
+        rrule = format_rrule_string(reservation.rule.frequency, params)
+        return rrule[len('RRULE:'):] + suffix
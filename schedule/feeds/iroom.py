@@ -1,6 +1,10 @@
-import vobject
+import copy
+import datetime
+import time
 
+from django.contrib.sites.models import get_current_site
 from django.http import HttpResponse
+from django.utils.encoding import smart_unicode
 
 EVENT_ITEMS = (
     ('uid', 'uid'),
@@ -11,28 +15,127 @@ EVENT_ITEMS = (
     ('last_modified', 'last_modified'),
     ('created', 'created'),
 )
+TEXT_ITEMS = ('summary', 'location')
+# RFC 5545 requires these to be written in UTC
+UTC_ITEMS = ('last_modified', 'created')
+
+CALENDAR_HEADER = (
+    'BEGIN:VCALENDAR',
+    'VERSION:2.0',
+    'PRODID:-//django-schedule//NONSGML iCalendar feed//EN',
+)
+CALENDAR_FOOTER = (
+    'END:VCALENDAR',
+)
+# lines longer than this many octets are folded, see RFC 5545 3.1
+LINE_LENGTH = 75
+
+
+def format_value(value):
+    """
+    Formats a datetime, date or text value of a property.  Datetimes are
+    written as floating local times, like they are stored.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y%m%dT%H%M%S')
+    if isinstance(value, datetime.date):
+        return value.strftime('%Y%m%d')
+    return smart_unicode(value)
+
+
+def format_utc(value):
+    """
+    Formats a naive local datetime as a UTC time.
+    """
+    utc = datetime.datetime.utcfromtimestamp(time.mktime(value.timetuple()))
+    return utc.strftime('%Y%m%dT%H%M%SZ')
+
+
+def escape_text(value):
+    """
+    Escapes the backslashes, semicolons, commas and newlines of a text value.
+    """
+    return (value.replace('\\', '\\\\').replace(';', '\\;')
+        .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold_line(line):
+    """
+    Encodes ``line`` as utf-8 and folds it into chunks of at most
+    LINE_LENGTH octets, never splitting a multibyte character.
+    """
+    chunks = []
+    chunk, size, limit = [], 0, LINE_LENGTH
+    for char in line:
+        encoded = char.encode('utf-8')
+        if size + len(encoded) > limit:
+            chunks.append(''.join(chunk))
+            # the continuation lines start with a space
+            chunk, size, limit = [], 0, LINE_LENGTH - 1
+        chunk.append(encoded)
+        size += len(encoded)
+    chunks.append(''.join(chunk))
+    return '\r\n '.join(chunks) + '\r\n'
+
+
+def format_property(name, value):
+    return fold_line(u'%s:%s' % (name.upper().replace('_', '-'), value))
 
-class IRoomFeed(object):
-
-    def __call__(self, *args, **kwargs):
-        self.args = args
-        self.kwargs = kwargs
-        
-        cal = vobject.iRoom()
 
+class IRoomFeed(object):
+    """
+    Writes the items of a feed as an iCalendar stream.  The calendar is
+    never built in memory: the response iterates over the VEVENTs as
+    ``items`` yields them, so ``items`` should be a generator or an
+    ``.iterator()`` over a queryset.
+    """
+
+    def __call__(self, request, *args, **kwargs):
+        # the response is written after this view returns, and one feed
+        # instance serves every request, so the state of the request goes
+        # on a copy of it
+        feed = copy.copy(self)
+        feed.request = request
+        feed.args = (request,) + args
+        feed.kwargs = kwargs
+        feed.domain = get_current_site(request).domain
+        feed.obj = feed.get_object(request, *args, **kwargs)
+        return HttpResponse(feed.iter_calendar(),
+            mimetype='text/calendar; charset=utf-8')
+
+    def get_object(self, request, *args, **kwargs):
+        """
+        Returns the object whose calendar is written, before the response
+        starts.  It is available to ``items`` as ``self.obj``.
+        """
+        return None
+
+    def iter_calendar(self):
+        yield ''.join(fold_line(line) for line in CALENDAR_HEADER)
+        # the time the calendar is written, the DTSTAMP of every VEVENT
+        dtstamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
         for item in self.items():
-
-            reservation = cal.add('vreservation')
-
-            for vkey, key in EVENT_ITEMS:
-                value = getattr(self, 'item_' + key)(item)
-                if value:
-                    reservation.add(vkey).value = value
-
-        response = HttpResponse(cal.serialize())
-        response['Content-Type'] = 'text/room'
-
-        return response
+            yield self.format_event(item, dtstamp)
+        yield ''.join(fold_line(line) for line in CALENDAR_FOOTER)
+
+    def format_event(self, item, dtstamp):
+        lines = [fold_line(u'BEGIN:VEVENT')]
+        for vkey, key in EVENT_ITEMS:
+            value = getattr(self, 'item_' + key)(item)
+            if value:
+                if vkey in UTC_ITEMS:
+                    value = format_utc(value)
+                else:
+                    value = format_value(value)
+                if vkey in TEXT_ITEMS:
+                    value = escape_text(value)
+                lines.append(format_property(vkey, value))
+            if vkey == 'uid':
+                lines.append(format_property('dtstamp', dtstamp))
+        for vkey, value in self.item_properties(item):
+            lines.append(format_property(vkey, format_value(value)))
+        lines.append(fold_line(u'END:VEVENT'))
+        return ''.join(lines)
 
     def items(self):
         return []
@@ -56,4 +159,11 @@ class IRoomFeed(object):
         pass
 
     def item_created(self, item):
-        pass
\ No newline at end of file
+        pass
+
+    def item_properties(self, item):
+        """
+        Returns a list of the extra ``(name, value)`` properties of the
+        VEVENT of ``item``, like its RRULE.  The values are not escaped.
+        """
+        return []
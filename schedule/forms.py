@@ -1,6 +1,7 @@
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 from schedule.models import Reservation, Occurrence, Rule
+from schedule.models.rules import parse_params
 import datetime
 import time
 
@@ -40,7 +41,7 @@ class RuleForm(forms.ModelForm):
     def clean_params(self):
         params = self.cleaned_data["params"]
         try:
-            Rule(params=params).get_params()
-        except (ValueError, SyntaxError):
+            parse_params(params)
+        except ValueError:
             raise forms.ValidationError(_("Params format looks invalid"))
         return self.cleaned_data["params"]
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = "Rebuild the occurrence index, or extend it up to the current horizon"
+    option_list = BaseCommand.option_list + (
+        make_option('--extend', action='store_true', dest='extend', default=False,
+            help='Only index the part of the horizon which is not indexed yet.'),
+    )
+
+    def handle(self, **options):
+        from schedule.models import OccurrenceIndex
+        from schedule.models.indexes import get_default_index_window
+
+        start, end = get_default_index_window()
+        window = OccurrenceIndex.objects.get_window()
+        if options['extend'] and window is not None:
+            print "Extending the occurrence index up to %s ..." % end
+            OccurrenceIndex.objects.extend(end)
+            OccurrenceIndex.objects.trim(start)
+        else:
+            print "Rebuilding the occurrence index from %s to %s ..." % (start, end)
+            OccurrenceIndex.objects.rebuild(start, end)
+        print "The occurrence index now holds %d occurrences." % OccurrenceIndex.objects.count()
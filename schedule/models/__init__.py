@@ -1,5 +1,6 @@
 from schedule.models.rooms import *
 from schedule.models.reservations import *
 from schedule.models.rules import *
+from schedule.models.indexes import *
 
 from schedule.signals import *
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+from django.db import connections, models, transaction
+from django.db.models import Q
+from django.utils.translation import ugettext, ugettext_lazy as _
+import datetime
+import itertools
+from schedule.conf.settings import USE_OCCURRENCE_INDEX, OCCURRENCE_INDEX_HORIZON
+from schedule.models.reservations import Reservation, Occurrence
+from schedule.utils import ReservationListManager
+
+# the columns written by OccurrenceIndexManager._insert_rows
+INDEX_COLUMNS = ('reservation', 'occurrence', 'start', 'end', 'original_start', 'cancelled')
+INSERT_BATCH_SIZE = 500
+
+class OccurrenceIndexManager(models.Manager):
+
+    def is_enabled(self):
+        return USE_OCCURRENCE_INDEX
+
+    def get_window(self):
+        """
+        Returns the OccurrenceIndexWindow the index covers, or None if the
+        index has never been built.
+        """
+        try:
+            return OccurrenceIndexWindow.objects.get()
+        except OccurrenceIndexWindow.DoesNotExist:
+            return None
+
+    def covers(self, start, end):
+        window = self.get_window()
+        return window is not None and window.start <= start and end <= window.end
+
+    def _index_rows(self, reservation, start, end, after=None):
+        occurrences = Reservation.objects.expand_occurrences([reservation], start, end)
+        for occurrence in occurrences:
+            if after is not None and occurrence.start < after:
+                # already indexed by the previous window
+                continue
+            yield (reservation.pk, occurrence.pk, occurrence.start, occurrence.end,
+                occurrence.original_start, occurrence.cancelled)
+
+    def _insert_rows(self, rows):
+        """
+        Inserts the (reservation_id, occurrence_id, start, end,
+        original_start, cancelled) tuples ``rows``, INSERT_BATCH_SIZE rows
+        per ``executemany`` instead of one ``create`` per row.
+        """
+        connection = connections[self.db]
+        fields = [self.model._meta.get_field(name) for name in INDEX_COLUMNS]
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(self.model._meta.db_table),
+            ', '.join([qn(field.column) for field in fields]),
+            ', '.join(['%s'] * len(fields)))
+        cursor = connection.cursor()
+        rows = iter(rows)
+        while True:
+            batch = [[field.get_db_prep_save(value, connection=connection)
+                for field, value in zip(fields, row)]
+                for row in itertools.islice(rows, INSERT_BATCH_SIZE)]
+            if not batch:
+                break
+            cursor.executemany(sql, batch)
+        transaction.commit_unless_managed(using=self.db)
+
+    def refresh_reservation(self, reservation):
+        """
+        Recomputes the index rows of ``reservation`` within the indexed window.
+        """
+        self.filter(reservation=reservation).delete()
+        window = self.get_window()
+        if window is not None:
+            self._insert_rows(self._index_rows(reservation, window.start, window.end))
+
+    def refresh_occurrence(self, occurrence, deleted=False):
+        """
+        Updates the only index row a persisted occurrence changes, the one
+        of its reservation and original start.  Once the occurrence is
+        deleted the row of the occurrence generated by the rule is back.
+        """
+        self.filter(reservation=occurrence.reservation_id,
+            original_start=occurrence.original_start).delete()
+        window = self.get_window()
+        if window is None:
+            return
+        if not deleted:
+            if occurrence.start < window.end and occurrence.end >= window.start:
+                self._insert_rows([(occurrence.reservation_id, occurrence.pk, occurrence.start,
+                    occurrence.end, occurrence.original_start, occurrence.cancelled)])
+        elif occurrence.original_start < window.end and occurrence.original_end > window.start:
+            # the reservation is gone too when the occurrence was deleted
+            # by cascade
+            if Reservation.objects.filter(pk=occurrence.reservation_id).exists():
+                self._insert_rows([(occurrence.reservation_id, None, occurrence.original_start,
+                    occurrence.original_end, occurrence.original_start, False)])
+
+    def rebuild(self, start, end):
+        """
+        Drops the whole index and computes it again from start to end.
+        """
+        self.all().delete()
+        OccurrenceIndexWindow.objects.all().delete()
+        OccurrenceIndexWindow.objects.create(start=start, end=end)
+        self._insert_rows(itertools.chain.from_iterable(
+            self._index_rows(reservation, start, end)
+            for reservation in Reservation.objects.select_related('rule').iterator()))
+    rebuild = transaction.commit_on_success(rebuild)
+
+    def extend(self, end):
+        """
+        Moves the end of the indexed window forward to ``end`` and only
+        computes the rows of the new part of the window.
+        """
+        window = self.get_window()
+        if window is None or end <= window.end:
+            return
+        self._insert_rows(itertools.chain.from_iterable(
+            self._index_rows(reservation, window.end, end, after=window.end)
+            for reservation in Reservation.objects.select_related('rule').iterator()))
+        window.end = end
+        window.save()
+    extend = transaction.commit_on_success(extend)
+
+    def trim(self, start):
+        """
+        Moves the start of the indexed window forward to ``start`` and drops
+        the rows which are not needed anymore.
+        """
+        window = self.get_window()
+        if window is None or start <= window.start:
+            return
+        self.filter(end__lt=start).delete()
+        window.start = start
+        window.save()
+    trim = transaction.commit_on_success(trim)
+
+    def _to_occurrences(self, rows, reservations):
+        reservation_map = dict([(reservation.pk, reservation) for reservation in reservations])
+        persisted = Occurrence.objects.in_bulk(
+            [occurrence_id for reservation_id, occurrence_id, start, end in rows
+                if occurrence_id is not None])
+        occurrences = []
+        for reservation_id, occurrence_id, start, end in rows:
+            if occurrence_id is not None:
+                occurrences.append(persisted[occurrence_id])
+            else:
+                occurrences.append(reservation_map[reservation_id]._create_virtual_occurrence(start, end))
+        return occurrences
+
+    def get_occurrences_for(self, reservations, start, end):
+        """
+        Returns the sorted occurrences of ``reservations`` from start to end
+        with a single range scan of the index, or None if the index does not
+        cover that window.
+        """
+        if not self.covers(start, end):
+            return None
+        reservations = [reservation for reservation in reservations
+            if reservation.pk is not None]
+        if not reservations:
+            return []
+        rows = self.filter(
+            Q(end__gt=start) | Q(end=start, occurrence__isnull=False),
+            reservation__in=[reservation.pk for reservation in reservations],
+            start__lt=end,
+        ).order_by('start', 'end').values_list('reservation', 'occurrence', 'start', 'end')
+        return self._to_occurrences(list(rows), reservations)
+
+    def occurrences_after(self, reservations, after=None, limit=None, until=None, chunk_size=100):
+        """
+        Works like ``ReservationListManager.occurrences_after`` but reads the
+        occurrences within the indexed window from the index.
+        """
+        if after is None:
+            after = datetime.datetime.now()
+        window = self.get_window()
+        if window is None or not (window.start <= after < window.end):
+            return ReservationListManager(reservations).occurrences_after(
+                after, limit, until, chunk_size)
+        occurrences = self._occurrences_after(list(reservations), after, window, until, chunk_size)
+        return itertools.islice(occurrences, limit)
+
+    def _occurrences_after(self, reservations, after, window, until, chunk_size):
+        rows = self.filter(
+            reservation__in=[reservation.pk for reservation in reservations],
+            end__gt=after,
+        )
+        if until is not None:
+            rows = rows.filter(start__lt=until)
+        rows = rows.order_by('start', 'end', 'reservation', 'original_start').values_list(
+            'reservation', 'occurrence', 'start', 'end')
+        chunk = []
+        for row in rows.iterator():
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                for occurrence in self._to_occurrences(chunk, reservations):
+                    yield occurrence
+                chunk = []
+        for occurrence in self._to_occurrences(chunk, reservations):
+            yield occurrence
+        if until is not None and until <= window.end:
+            return
+        for occurrence in ReservationListManager(reservations).occurrences_after(
+                window.end, until=until, chunk_size=chunk_size):
+            if occurrence.start >= window.end:
+                yield occurrence
+
+
+class OccurrenceIndex(models.Model):
+    '''
+    This is a materialized copy of the occurrences of every reservation
+    within the window described by the OccurrenceIndexWindow.  It is only
+    used if USE_OCCURRENCE_INDEX is set, in which case it is kept up to date
+    from the save signals of Reservation, Rule and Occurrence and the delete
+    signal of Occurrence.  The rows of deleted reservations go by cascade.
+
+    reservation: the reservation that produces the occurrence
+    occurrence: the persisted Occurrence, if there is one
+    start, end: when the occurrence takes place
+    original_start: when the occurrence was generated by the rule
+    cancelled: whether the occurrence has been cancelled
+    '''
+    reservation = models.ForeignKey(Reservation, verbose_name=_("reservation"))
+    occurrence = models.ForeignKey(Occurrence, null=True, blank=True, verbose_name=_("occurrence"))
+    start = models.DateTimeField(_("start"), db_index=True)
+    end = models.DateTimeField(_("end"), db_index=True)
+    original_start = models.DateTimeField(_("original start"))
+    cancelled = models.BooleanField(_("cancelled"), default=False)
+
+    objects = OccurrenceIndexManager()
+
+    class Meta:
+        verbose_name = _('occurrence index')
+        verbose_name_plural = _('occurrence index')
+        app_label = 'schedule'
+
+    def __unicode__(self):
+        return ugettext("%(start)s to %(end)s") % {
+            'start': self.start,
+            'end': self.end,
+        }
+
+
+class OccurrenceIndexWindow(models.Model):
+    '''
+    The period of time the OccurrenceIndex has been computed for.  There is
+    at most one of these.
+    '''
+    start = models.DateTimeField(_("start"))
+    end = models.DateTimeField(_("end"))
+
+    class Meta:
+        verbose_name = _('occurrence index window')
+        verbose_name_plural = _('occurrence index windows')
+        app_label = 'schedule'
+
+    def __unicode__(self):
+        return ugettext("%(start)s to %(end)s") % {
+            'start': self.start,
+            'end': self.end,
+        }
+
+
+def get_default_index_window():
+    """
+    Returns the (start, end) of the rolling window of OCCURRENCE_INDEX_HORIZON
+    days around today.
+    """
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+    horizon = datetime.timedelta(days=OCCURRENCE_INDEX_HORIZON)
+    return today - horizon, today + horizon
@@ -1,23 +1,230 @@
 # -*- coding: utf-8 -*-
 from django.contrib.contenttypes import generic
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, F
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import date
 from django.utils.translation import ugettext, ugettext_lazy as _
 import datetime
-from dateutil import rrule
+from bisect import bisect_right
+from operator import itemgetter
+from schedule.conf.settings import CONFLICT_HORIZON
 from schedule.models.rules import Rule
 from schedule.models.rooms import Room
-from schedule.utils import OccurrenceReplacer
+from schedule.recurrence import SimpleRecurrence, get_simple_recurrence, iter_after, simple_recurrences_overlap
+from schedule.utils import OccurrenceReplacer, ReservationListManager, rrule_cache
 
 class ReservationManager(models.Manager):
 
     def get_for_object(self, content_object, distinction=None, inherit=True):
         return ReservationRelation.objects.get_reservations_for_object(content_object, distinction, inherit)
 
+    def get_occurrences_for(self, reservations, start, end):
+        """
+        Returns one sorted list with the occurrences of all of the
+        ``reservations`` from start to end.  The persisted occurrences of
+        every reservation are fetched with a single query, so this is a lot
+        cheaper than calling ``Reservation.get_occurrences`` once per
+        reservation.
+        """
+        from schedule.models.indexes import OccurrenceIndex
+        if OccurrenceIndex.objects.is_enabled():
+            occurrences = OccurrenceIndex.objects.get_occurrences_for(reservations, start, end)
+            if occurrences is not None:
+                return occurrences
+        return self.expand_occurrences(reservations, start, end)
+
+    def expand_occurrences(self, reservations, start, end):
+        """
+        Works like ``get_occurrences_for`` but always expands the rules of
+        the reservations, even if the OccurrenceIndex is enabled.
+        """
+        reservations = list(reservations)
+        if not reservations:
+            return []
+        reservation_ids = [reservation.pk for reservation in reservations
+            if reservation.pk is not None]
+        persisted_occurrences = []
+        if reservation_ids:
+            persisted_occurrences = Occurrence.objects.in_window(
+                reservation_ids, start, end)
+        occ_replacer = OccurrenceReplacer(persisted_occurrences)
+        occurrences = []
+        for reservation in reservations:
+            occurrences += reservation._get_occurrence_list(start, end)
+        return sorted(occ_replacer.replace_occurrences(occurrences, start, end))
+
+    def get_occurrence_spans(self, reservations, start, end, include_cancelled=False):
+        """
+        Returns the sorted (start, end) tuples of the occurrences of
+        ``reservations`` from start to end.  This works like
+        ``get_occurrences_for`` but does not build any occurrence object,
+        which makes it the cheap way to find out when a room is busy.
+        Cancelled occurrences are left out unless ``include_cancelled``.
+        """
+        spans = [(o_start, o_end) for reservation, o_start, o_end in
+            self.iter_occurrence_spans(reservations, start, end, include_cancelled)]
+        spans.sort()
+        return spans
+
+    def iter_occurrence_spans(self, reservations, start, end, include_cancelled=False):
+        """
+        Yields the (reservation, start, end) tuples of the occurrences of
+        ``reservations`` from start to end, in no particular order.  See
+        ``get_occurrence_spans``.
+        """
+        for reservation, title, o_start, o_end, cancelled in self.iter_occurrence_rows(
+                reservations, start, end, include_cancelled):
+            yield reservation, o_start, o_end
+
+    def get_occurrence_rows(self, reservations, start, end, include_cancelled=True):
+        """
+        Returns the (reservation_id, title, start, end, cancelled) tuples of
+        the occurrences of ``reservations`` from start to end, sorted by start
+        and end.  Like ``get_occurrence_spans`` it only runs one values query
+        for the persisted occurrences and builds no occurrence object, for
+        the callers which only need these fields.
+        """
+        rows = [(reservation.pk, title, o_start, o_end, cancelled) for
+            reservation, title, o_start, o_end, cancelled in
+            self.iter_occurrence_rows(reservations, start, end, include_cancelled)]
+        rows.sort(key=itemgetter(2, 3))
+        return rows
+
+    def iter_occurrence_rows(self, reservations, start, end, include_cancelled=True):
+        """
+        Yields the (reservation, title, start, end, cancelled) tuples of the
+        occurrences of ``reservations`` from start to end, in no particular
+        order.
+        """
+        reservations = list(reservations)
+        reservation_map = dict([(reservation.pk, reservation) for reservation in reservations
+            if reservation.pk is not None])
+        persisted = {}
+        if reservation_map:
+            rows = Occurrence.objects.in_window(reservation_map.keys(), start, end).values_list(
+                'reservation', 'original_start', 'original_end', 'start', 'end', 'cancelled', 'title')
+            for reservation_id, original_start, original_end, o_start, o_end, cancelled, title in rows:
+                persisted[(reservation_id, original_start, original_end)] = (o_start, o_end, cancelled, title)
+        for reservation in reservations:
+            for o_start, o_end in reservation._get_occurrence_spans(start, end):
+                key = (reservation.pk, o_start, o_end)
+                title, cancelled = reservation.title, False
+                if key in persisted:
+                    o_start, o_end, cancelled, title = persisted.pop(key)
+                    if cancelled and not include_cancelled:
+                        continue
+                    if not (o_start < end and o_end >= start):
+                        continue
+                    if title is None:
+                        title = reservation.title
+                yield reservation, title, o_start, o_end, cancelled
+        # persisted occurrences moved into the window from outside of it
+        for (reservation_id, original_start, original_end), (o_start, o_end, cancelled, title) in persisted.items():
+            if o_start < end and o_end >= start and (include_cancelled or not cancelled):
+                reservation = reservation_map[reservation_id]
+                if title is None:
+                    title = reservation.title
+                yield reservation, title, o_start, o_end, cancelled
+
+    def find_conflicts(self, room, start, end, rule=None, exclude=None,
+        end_recurring_period=None, lock=False):
+        """
+        Returns the sorted (reservation, start, end) tuples of the occurrences
+        of the reservations of ``room`` which overlap a reservation from
+        start to end repeating with ``rule`` until ``end_recurring_period``.
+        Recurring reservations without an end_recurring_period are checked
+        for CONFLICT_HORIZON days.  The reservation with the id ``exclude``,
+        usually the one being edited, is ignored.  Cancelled occurrences do
+        not conflict.
+
+        When both the proposed rule and the rule of an existing reservation
+        repeat at a fixed interval, whether any of their occurrences overlap
+        is computed arithmetically, and the occurrences of the existing
+        reservation are only expanded if they do.  Only its moved occurrences
+        are then checked one by one.
+
+        If ``lock`` is set the room row is locked first, so that concurrent
+        bookings of the room wait for each other.  The lock is held until the
+        end of the transaction, so the check and the save of the reservation
+        must happen in the same transaction, e.g. within a function wrapped
+        with ``transaction.commit_on_success``.
+        """
+        if lock:
+            # select_for_update is not available, updating the row takes
+            # the same lock
+            Room.objects.filter(pk=room.pk).update(slug=F('slug'))
+        candidate = Reservation(start=start, end=end, rule=rule,
+            end_recurring_period=end_recurring_period)
+        window_end = end
+        if rule is not None:
+            window_end = end_recurring_period or start + datetime.timedelta(days=CONFLICT_HORIZON)
+            window_end += end - start
+        proposed = candidate._get_occurrence_spans(start, window_end)
+        if not proposed:
+            return []
+        until = end_recurring_period or window_end
+        window_end = proposed[-1][1]
+        # the reservations starting later may have occurrences moved in
+        moved_in = Occurrence.objects.filter(reservation__room=room, cancelled=False,
+            start__lt=window_end, end__gt=start).values('reservation')
+        reservations = self.filter(
+            Q(Q(rule__isnull=True, end__gt=start) |
+                Q(Q(end_recurring_period__isnull=True) | Q(end_recurring_period__gt=start),
+                    rule__isnull=False),
+                start__lt=window_end) | Q(pk__in=moved_in),
+            room=room).select_related('rule')
+        if exclude is not None:
+            reservations = reservations.exclude(pk=exclude)
+        reservations, disjoint = self._split_disjoint(candidate, until, reservations)
+        # the proposed occurrences are sorted and do not overlap each other,
+        # so their ends are sorted too
+        proposed_ends = [o_end for o_start, o_end in proposed]
+        def overlaps(o_start, o_end):
+            index = bisect_right(proposed_ends, o_start)
+            return index < len(proposed) and proposed[index][0] < o_end
+        conflicts = []
+        for reservation, o_start, o_end in self.iter_occurrence_spans(
+                reservations, start, window_end):
+            if overlaps(o_start, o_end):
+                conflicts.append((o_start, o_end, reservation.pk, reservation))
+        if disjoint:
+            # the rules of these never overlap, but their occurrences may
+            # have been moved
+            reservation_map = dict((reservation.pk, reservation) for reservation in disjoint)
+            moved = Occurrence.objects.in_window(reservation_map.keys(), start, window_end).filter(
+                cancelled=False).exclude(start=F('original_start'), end=F('original_end'))
+            for reservation_id, o_start, o_end in moved.values_list('reservation', 'start', 'end'):
+                if overlaps(o_start, o_end):
+                    reservation = reservation_map[reservation_id]
+                    conflicts.append((o_start, o_end, reservation.pk, reservation))
+        conflicts.sort()
+        return [(reservation, o_start, o_end)
+            for o_start, o_end, reservation_id, reservation in conflicts]
+
+    def _split_disjoint(self, candidate, until, reservations):
+        """
+        Splits ``reservations`` in those whose rule may generate occurrences
+        overlapping the ones of the recurring ``candidate`` before ``until``,
+        and those whose rule provably does not.
+        """
+        recurrence = candidate._get_recurrence()
+        if not isinstance(recurrence, SimpleRecurrence):
+            return list(reservations), []
+        duration = candidate.end - candidate.start
+        candidates, disjoint = [], []
+        for reservation in reservations:
+            other = reservation._get_recurrence()
+            if isinstance(other, SimpleRecurrence) and not simple_recurrences_overlap(
+                    recurrence, duration, until, other,
+                    reservation.end - reservation.start, reservation.end_recurring_period):
+                disjoint.append(reservation)
+            else:
+                candidates.append(reservation)
+        return candidates, disjoint
+
 class Reservation(models.Model):
     '''
     This model stores meta data for a date.  You can relate this data to many
@@ -76,38 +283,42 @@ class Reservation(models.Model):
         []
 
         """
-        persisted_occurrences = self.occurrence_set.all()
+        persisted_occurrences = []
+        if self.pk is not None:
+            persisted_occurrences = Occurrence.objects.in_window([self.pk], start, end)
         occ_replacer = OccurrenceReplacer(persisted_occurrences)
         occurrences = self._get_occurrence_list(start, end)
-        final_occurrences = []
-        for occ in occurrences:
-            # replace occurrences with their persisted counterparts
-            if occ_replacer.has_occurrence(occ):
-                p_occ = occ_replacer.get_occurrence(
-                        occ)
-                # ...but only if they are within this period
-                if p_occ.start < end and p_occ.end >= start:
-                    final_occurrences.append(p_occ)
-            else:
-              final_occurrences.append(occ)
-        # then add persisted occurrences which originated outside of this period but now
-        # fall within it
-        final_occurrences += occ_replacer.get_additional_occurrences(start, end)
-        return final_occurrences
+        return occ_replacer.replace_occurrences(occurrences, start, end)
 
     def get_rrule_object(self):
         if self.rule is not None:
-            params = self.rule.get_params()
-            frequency = rrule.__dict__[self.rule.frequency]
-            return rrule.rrule(frequency, dtstart=self.start, **params)
+            return rrule_cache.get(self.rule, self.start)
+
+    def _get_recurrence(self):
+        """
+        Returns an object with the ``between`` and ``after`` methods of the
+        rrule of this reservation.  Plain rules are expanded arithmetically,
+        the others fall back to dateutil.
+        """
+        if self.rule is not None:
+            recurrence = get_simple_recurrence(self.rule.frequency,
+                self.rule.get_params(), self.start)
+            if recurrence is None:
+                recurrence = self.get_rrule_object()
+            return recurrence
 
     def _create_occurrence(self, start, end=None):
         if end is None:
             end = start + (self.end - self.start)
         return Occurrence(reservation=self,start=start,end=end, original_start=start, original_end=end)
 
+    def _create_virtual_occurrence(self, start, end=None):
+        if end is None:
+            end = start + (self.end - self.start)
+        return VirtualOccurrence(self, start, end)
+
     def get_occurrence(self, date):
-        rule = self.get_rrule_object()
+        rule = self._get_recurrence()
         if rule:
             next_occurrence = rule.after(date, inc=True)
         else:
@@ -123,58 +334,72 @@ class Reservation(models.Model):
         """
         returns a list of occurrences for this reservation from start to end.
         """
+        return [self._create_virtual_occurrence(o_start, o_end)
+            for o_start, o_end in self._get_occurrence_spans(start, end)]
+
+    def _get_occurrence_spans(self, start, end):
+        """
+        returns the (start, end) tuples of the occurrences of this reservation
+        from start to end, as generated by its rule.
+        """
         difference = (self.end - self.start)
         if self.rule is not None:
-            occurrences = []
             if self.end_recurring_period and self.end_recurring_period < end:
                 end = self.end_recurring_period
-            rule = self.get_rrule_object()
+            rule = self._get_recurrence()
             o_starts = rule.between(start-difference, end, inc=False)
-            for o_start in o_starts:
-                o_end = o_start + difference
-                occurrences.append(self._create_occurrence(o_start, o_end))
-            return occurrences
+            return [(o_start, o_start + difference) for o_start in o_starts]
         else:
             # check if reservation is in the period
             if self.start < end and self.end >= start:
-                return [self._create_occurrence(self.start)]
+                return [(self.start, self.end)]
             else:
                 return []
 
+    def _iter_occurrence_spans(self, start, end):
+        """
+        Yields the (start, end) tuples of ``_get_occurrence_spans`` sorted by
+        start, expanding the rule only as far as they are consumed.
+        """
+        if self.rule is None:
+            if self.start < end and self.end >= start:
+                yield self.start, self.end
+            return
+        difference = self.end - self.start
+        if self.end_recurring_period and self.end_recurring_period < end:
+            end = self.end_recurring_period
+        for o_start in iter_after(self._get_recurrence(), start - difference):
+            if o_start >= end:
+                return
+            yield o_start, o_start + difference
+
     def _occurrences_after_generator(self, after=None):
         """
-        returns a generator that produces unpresisted occurrences after the
-        datetime ``after``.
+        returns a generator that produces unpresisted occurrences ending after
+        the datetime ``after``.  The occurrences before ``after`` are skipped
+        without being generated.
         """
 
         if after is None:
             after = datetime.datetime.now()
-        rule = self.get_rrule_object()
-        if rule is None:
+        if self.rule is None:
             if self.end > after:
-                yield self._create_occurrence(self.start, self.end)
-            raise StopIteration
-        date_iter = iter(rule)
+                yield self._create_virtual_occurrence(self.start, self.end)
+            return
         difference = self.end - self.start
-        while True:
-            o_start = date_iter.next()
-            if o_start > self.end_recurring_period:
-                raise StopIteration
-            o_end = o_start + difference
-            if o_end > after:
-                yield self._create_occurrence(o_start, o_end)
+        for o_start in iter_after(self._get_recurrence(), after - difference):
+            if self.end_recurring_period is not None and o_start >= self.end_recurring_period:
+                return
+            yield self._create_virtual_occurrence(o_start, o_start + difference)
 
 
-    def occurrences_after(self, after=None):
+    def occurrences_after(self, after=None, limit=None, until=None):
         """
         returns a generator that produces occurrences after the datetime
-        ``after``.  Includes all of the persisted Occurrences.
+        ``after``.  Includes the persisted Occurrences.  See
+        ``ReservationListManager.occurrences_after``.
         """
-        occ_replacer = OccurrenceReplacer(self.occurrence_set.all())
-        generator = self._occurrences_after_generator(after)
-        while True:
-            next = generator.next()
-            yield occ_replacer.get_occurrence(next)
+        return ReservationListManager([self]).occurrences_after(after, limit, until)
     
     def next_occurrence(self):
         for o in self.occurrences_after():
@@ -346,30 +571,28 @@ class ReservationRelation(models.Model):
         return u'%s(%s)-%s' % (self.reservation.title, self.distinction, self.content_object)
 
 
+class OccurrenceManager(models.Manager):
 
+    def in_window(self, reservation_ids, start, end):
+        """
+        Returns the persisted occurrences of the reservations with the ids
+        ``reservation_ids`` which either were generated within the window
+        from start to end or have been moved into it.  The two halves of the
+        filter are served by the composite indexes created by the
+        models/sql/occurrence.<backend>.sql files, so the cost depends on the size of the
+        window, not on the history of the reservations.
+        """
+        return self.filter(
+            Q(original_start__lt=end, original_end__gte=start) |
+            Q(start__lt=end, end__gte=start),
+            reservation__in=reservation_ids)
 
-class Occurrence(models.Model):
-    reservation = models.ForeignKey(Reservation, verbose_name=_("reservation"))
-    title = models.CharField(_("title"), max_length=255, blank=True, null=True)
-    description = models.TextField(_("description"), blank=True, null=True)
-    start = models.DateTimeField(_("start"))
-    end = models.DateTimeField(_("end"))
-    cancelled = models.BooleanField(_("cancelled"), default=False)
-    original_start = models.DateTimeField(_("original start"))
-    original_end = models.DateTimeField(_("original end"))
-
-    class Meta:
-        verbose_name = _("occurrence")
-        verbose_name_plural = _("occurrences")
-        app_label = 'schedule'
-
-    def __init__(self, *args, **kwargs):
-        super(Occurrence, self).__init__(*args, **kwargs)
-        if self.title is None:
-            self.title = self.reservation.title
-        if self.description is None:
-            self.description = self.reservation.description
 
+class OccurrenceBase(object):
+    """
+    The behaviour shared by persisted Occurrences and VirtualOccurrences.
+    """
+    __slots__ = ()
 
     def moved(self):
         return self.original_start != self.start or self.original_end != self.end
@@ -444,3 +667,112 @@ class Occurrence(models.Model):
 
     def __eq__(self, other):
         return self.reservation == other.reservation and self.original_start == other.original_start and self.original_end == other.original_end
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+class Occurrence(OccurrenceBase, models.Model):
+    reservation = models.ForeignKey(Reservation, verbose_name=_("reservation"))
+    title = models.CharField(_("title"), max_length=255, blank=True, null=True)
+    description = models.TextField(_("description"), blank=True, null=True)
+    start = models.DateTimeField(_("start"))
+    end = models.DateTimeField(_("end"))
+    cancelled = models.BooleanField(_("cancelled"), default=False)
+    original_start = models.DateTimeField(_("original start"))
+    original_end = models.DateTimeField(_("original end"))
+
+    objects = OccurrenceManager()
+
+    class Meta:
+        verbose_name = _("occurrence")
+        verbose_name_plural = _("occurrences")
+        app_label = 'schedule'
+
+    def __init__(self, *args, **kwargs):
+        super(Occurrence, self).__init__(*args, **kwargs)
+        if self.title is None:
+            self.title = self.reservation.title
+        if self.description is None:
+            self.description = self.reservation.description
+
+
+class VirtualOccurrence(OccurrenceBase):
+    """
+    An occurrence generated by the rule of a reservation which has not been
+    persisted.  It has the same read API as Occurrence but is a lot cheaper
+    to build, which matters when periods generate thousands of them.  It
+    is turned into an Occurrence the first time it is saved, e.g. by
+    ``move``, ``cancel`` or ``save``.
+    """
+    __slots__ = ('reservation', 'start', 'end', 'original_start', 'original_end',
+        'cancelled', '_title', '_description', '_occurrence')
+
+    def __init__(self, reservation, start, end):
+        self.reservation = reservation
+        self.start = self.original_start = start
+        self.end = self.original_end = end
+        self.cancelled = False
+        self._title = None
+        self._description = None
+        self._occurrence = None
+
+    def _get_title(self):
+        if self._title is None:
+            return self.reservation.title
+        return self._title
+
+    def _set_title(self, title):
+        self._title = title
+    title = property(_get_title, _set_title)
+
+    def _get_description(self):
+        if self._description is None:
+            return self.reservation.description
+        return self._description
+
+    def _set_description(self, description):
+        self._description = description
+    description = property(_get_description, _set_description)
+
+    def reservation_id(self):
+        return self.reservation.id
+    reservation_id = property(reservation_id)
+
+    def pk(self):
+        if self._occurrence is not None:
+            return self._occurrence.pk
+    pk = property(pk)
+    id = pk
+
+    def to_occurrence(self):
+        """
+        Returns the Occurrence model instance for this occurrence.
+        """
+        if self._occurrence is None:
+            self._occurrence = Occurrence(reservation=self.reservation,
+                start=self.start, end=self.end, original_start=self.original_start,
+                original_end=self.original_end, cancelled=self.cancelled,
+                title=self._title, description=self._description)
+        return self._occurrence
+
+    def save(self):
+        occurrence = self.to_occurrence()
+        occurrence.start = self.start
+        occurrence.end = self.end
+        occurrence.cancelled = self.cancelled
+        occurrence.title = self.title
+        occurrence.description = self.description
+        occurrence.save()
+
+    def delete(self):
+        if self.pk is not None:
+            self._occurrence.delete()
+        self._occurrence = None
+
+    def __hash__(self):
+        return hash((self.reservation_id, self.original_start, self.original_end))
+
+    def __repr__(self):
+        return '<VirtualOccurrence: %s>' % self.__unicode__()
+
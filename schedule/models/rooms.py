@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 from django.contrib.contenttypes import generic
+from django.core.cache import cache
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, F
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.template.defaultfilters import slugify
 import datetime
+import heapq
+from itertools import chain, islice
 from dateutil import rrule
-from schedule.utils import ReservationListManager
+from schedule.conf.settings import AVAILABILITY_CACHE_TIMEOUT
+from schedule.utils import ReservationListManager, get_availability_bitmap
 
 class RoomManager(models.Manager):
     """
@@ -97,6 +101,144 @@ class RoomManager(models.Manager):
             dist_q = Q()
         return self.filter(dist_q, Q(roomrelation__object_id=obj.id, roomrelation__content_type=ct))
 
+    def availability(self, rooms, start, end, granularity=datetime.timedelta(minutes=30)):
+        """
+        Returns a dictionary mapping the ids of ``rooms`` to their
+        availability bitmap from start to end, as described in
+        ``Room.availability``.  The reservations and the persisted
+        occurrences of all of the rooms are fetched at once.  Bitmaps are
+        cached for AVAILABILITY_CACHE_TIMEOUT seconds if it is set.
+        """
+        room_ids = [room.pk for room in rooms]
+        bitmaps = {}
+        cache_keys = {}
+        if AVAILABILITY_CACHE_TIMEOUT:
+            for room_id in room_ids:
+                cache_keys[room_id] = 'schedule.availability.%s.%s.%s.%s' % (room_id,
+                    start.strftime('%Y%m%d%H%M%S'), end.strftime('%Y%m%d%H%M%S'),
+                    granularity.days * 86400 + granularity.seconds)
+            cached = cache.get_many(cache_keys.values())
+            for room_id, key in cache_keys.items():
+                if key in cached:
+                    bitmaps[room_id] = cached[key]
+        missing = [room_id for room_id in room_ids if room_id not in bitmaps]
+        if missing:
+            spans = self._get_occurrence_spans(missing, start, end)
+            computed = {}
+            for room_id in missing:
+                bitmaps[room_id] = get_availability_bitmap(spans[room_id], start, end, granularity)
+                if AVAILABILITY_CACHE_TIMEOUT:
+                    computed[cache_keys[room_id]] = bitmaps[room_id]
+            if computed:
+                cache.set_many(computed, AVAILABILITY_CACHE_TIMEOUT)
+        return bitmaps
+
+    def _get_reservations(self, room_ids, start, end):
+        """
+        Returns the reservations of ``room_ids`` which may have occurrences
+        from start to end: those starting before the end, and those with
+        a persisted occurrence moved into the window.
+        """
+        from schedule.models.reservations import Reservation, Occurrence
+        moved = Occurrence.objects.filter(reservation__room__in=room_ids,
+            start__lt=end, end__gte=start).values('reservation')
+        return Reservation.objects.filter(
+            Q(start__lt=end) & (Q(rule__isnull=False) | Q(end__gte=start)) | Q(pk__in=moved),
+            room__in=room_ids).select_related('rule')
+
+    def _get_occurrence_spans(self, room_ids, start, end):
+        """
+        Returns a dictionary mapping each of ``room_ids`` to the (start, end)
+        tuples of the occurrences of the room from start to end.
+        """
+        from schedule.models.reservations import Reservation
+        spans = dict([(room_id, []) for room_id in room_ids])
+        reservations = self._get_reservations(room_ids, start, end)
+        for reservation, o_start, o_end in Reservation.objects.iter_occurrence_spans(
+                reservations, start, end):
+            spans[reservation.room_id].append((o_start, o_end))
+        return spans
+
+    def _iter_occurrence_spans(self, room_ids, start, end):
+        """
+        Returns a dictionary mapping each of ``room_ids`` to an iterator
+        over the (start, end) tuples of the occurrences of the room from
+        start to end, sorted by start.  The persisted occurrences are read
+        at once, the rules are expanded as the iterators are consumed.
+        """
+        from schedule.models.reservations import Occurrence
+        reservations = list(self._get_reservations(room_ids, start, end))
+        room_map = dict([(reservation.pk, reservation.room_id) for reservation in reservations])
+        persisted = set()
+        moved = dict([(room_id, []) for room_id in room_ids])
+        if room_map:
+            rows = Occurrence.objects.in_window(room_map.keys(), start, end).values_list(
+                'reservation', 'original_start', 'original_end', 'start', 'end', 'cancelled')
+            for reservation_id, original_start, original_end, o_start, o_end, cancelled in rows:
+                persisted.add((reservation_id, original_start, original_end))
+                if not cancelled and o_start < end and o_end >= start:
+                    moved[room_map[reservation_id]].append((o_start, o_end))
+        generated = dict([(room_id, []) for room_id in room_ids])
+        for reservation in reservations:
+            generated[reservation.room_id].append(
+                _unpersisted_spans(reservation, start, end, persisted))
+        return dict([(room_id, heapq.merge(sorted(moved[room_id]), *generated[room_id]))
+            for room_id in room_ids])
+
+    def touch(self, room_ids):
+        """
+        Bumps the version of the rooms ``room_ids``, a list or a values
+        queryset, which sets the pages cached for their previous versions
+        aside.  This is done by the signals whenever a reservation changes.
+        """
+        self.filter(pk__in=room_ids).update(version=F('version') + 1,
+            last_modified=datetime.datetime.now())
+
+    def find_free_slots(self, rooms, duration, window, limit=10):
+        """
+        Returns up to ``limit`` (room, start, end) tuples of free slots of
+        length ``duration`` within the (start, end) ``window``, the earliest
+        first, looking in all of ``rooms`` at once.  The free time of each
+        room is cut into consecutive slots from the end of each occurrence.
+        The reservations and persisted occurrences of all of the rooms are
+        fetched at once; the search then merges the free slots of the rooms,
+        expanding the rules as it goes, and stops as soon as it has found
+        ``limit`` of them.
+        """
+        start, end = window
+        rooms = list(rooms)
+        spans = self._iter_occurrence_spans([room.pk for room in rooms], start, end)
+        generators = [_free_slots(room, spans[room.pk], duration, start, end)
+            for room in rooms]
+        return [(room, slot_start, slot_end) for slot_start, room_id, slot_end, room in
+            islice(heapq.merge(*generators), limit)]
+
+
+def _unpersisted_spans(reservation, start, end, persisted):
+    """
+    Yields the sorted spans generated by the rule of ``reservation`` which
+    have no ``persisted`` counterpart.
+    """
+    for o_start, o_end in reservation._iter_occurrence_spans(start, end):
+        if (reservation.pk, o_start, o_end) not in persisted:
+            yield o_start, o_end
+
+def _free_slots(room, spans, duration, start, end):
+    """
+    Yields the (start, room id, end, room) tuples of the free slots of
+    ``room`` between its busy ``spans``, sorted on their start.  The spans
+    must be sorted on their start too, and are only read until the window
+    is full.
+    """
+    free_from = start
+    for o_start, o_end in chain(spans, [(end, end)]):
+        if free_from + duration > end:
+            return
+        while free_from + duration <= min(o_start, end):
+            yield free_from, room.pk, free_from + duration, room
+            free_from += duration
+        free_from = max(free_from, o_end)
+
 class Room(models.Model):
     '''
     This is for grouping reservations so that batch relations can be made to all
@@ -134,6 +276,8 @@ class Room(models.Model):
 
     name = models.CharField(_("name"), max_length = 200)
     slug = models.SlugField(_("slug"),max_length = 200)
+    version = models.PositiveIntegerField(_("version"), default=0, editable=False)
+    last_modified = models.DateTimeField(_("last modified"), null=True, editable=False)
     objects = RoomManager()
 
     class Meta:
@@ -170,8 +314,31 @@ class Room(models.Model):
         """
         return self.reservations.order_by('-start').filter(start__lt=datetime.datetime.now())[:amount]
 
-    def occurrences_after(self, date=None):
-        return ReservationListManager(self.reservations.all()).occurrences_after(date)
+    def occurrences_after(self, date=None, limit=None, until=None):
+        from schedule.models.indexes import OccurrenceIndex
+        if OccurrenceIndex.objects.is_enabled():
+            return OccurrenceIndex.objects.occurrences_after(self.reservations.all(), date, limit, until)
+        return ReservationListManager(self.reservations.all()).occurrences_after(date, limit, until)
+
+    def occurrence_rows(self, start, end):
+        """
+        Returns the (reservation_id, title, start, end, cancelled) tuples of
+        the occurrences of this room from start to end, sorted by start.  See
+        ``ReservationManager.get_occurrence_rows``.
+        """
+        from schedule.models.reservations import Reservation
+        reservations = Room.objects._get_reservations([self.pk], start, end)
+        return Reservation.objects.get_occurrence_rows(reservations, start, end)
+
+    def availability(self, start, end, granularity=datetime.timedelta(minutes=30)):
+        """
+        Returns the availability of the room from start to end as a string
+        of bytes with one bit per ``granularity`` long slot, most significant
+        bit first.  The bit of a slot is set if no occurrence overlaps it;
+        use ``schedule.utils.is_slot_free`` to read it.  Cancelled
+        occurrences do not make the room busy.
+        """
+        return Room.objects.availability([self], start, end, granularity)[self.pk]
 
     def get_absolute_url(self):
         return reverse('room_home', kwargs={'room_slug':self.slug})
@@ -1,10 +1,257 @@
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import simplejson
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from dateutil import rrule
+import datetime
+import logging
+import re
+
+logger = logging.getLogger(__name__)
 
 RRULE_WEEKDAYS = {"MO":0,"TU":1,"WE":2,"TH":3,"FR":4,"SA":5,"SU":6}
 
+RRULE_PARAMS = ("count", "interval", "wkst", "bysetpos", "bymonth",
+    "bymonthday", "byyearday", "byeaster", "byweekno", "byweekday", "byhour",
+    "byminute", "bysecond")
+
+WEEKDAY_RE = re.compile(r'^(MO|TU|WE|TH|FR|SA|SU)(?:\(\s*([+-]?\d+)\s*\))?$')
+INTEGER_RE = re.compile(r'^[+-]?\d+$')
+
+def parse_params(params, strict=True):
+    """
+    Parses a ``param:value[,value]*;...`` string into a dictionary of
+    keyword arguments for ``dateutil.rrule.rrule``.  A ValueError is raised
+    if the string is not well formed, unless ``strict`` is False, in which
+    case the malformed parameters are logged and left out.
+
+    >>> parse_params("byweekday:MO(+1),FR;interval:2")
+    {'interval': 2, 'byweekday': [MO(+1), FR]}
+    >>> parse_params("count:x;interval:2", strict=False)
+    {'interval': 2}
+    """
+    param_dict = {}
+    if params is None:
+        return param_dict
+    for param in params.split(';'):
+        if param.strip() == "":
+            continue # skip blanks
+        try:
+            name, values = _parse_param(param)
+        except ValueError, e:
+            if strict:
+                raise
+            logger.warning('ignoring rrule parameter %r: %s', param, e)
+            continue
+        param_dict[name] = values
+    return param_dict
+
+def _parse_param(param):
+    if param.count(':') != 1:
+        raise ValueError('rrule parameter should follow the param:value format. Error on: %s' % param)
+    name, values = param.split(':')
+    name = str(name.strip())
+    if name not in RRULE_PARAMS:
+        raise ValueError('unknown rrule parameter: %s' % name)
+    values = [parse_param_value(value.strip()) for value in values.split(',')]
+    if len(values) == 1:
+        values = values[0]
+    return name, values
+
+def parse_param_value(param_value):
+    match = WEEKDAY_RE.match(param_value)
+    if match:
+        weekday, n = match.groups()
+        if n is None:
+            return rrule.weekday(RRULE_WEEKDAYS[weekday])
+        try:
+            return rrule.weekday(RRULE_WEEKDAYS[weekday], int(n))
+        except ValueError:
+            raise ValueError('rrule parameter improperly formatted. Error on: %s' % param_value)
+    if param_value.split('(', 1)[0] in RRULE_WEEKDAYS:
+        raise ValueError('rrule parameter improperly formatted. Error on: %s' % param_value)
+    if INTEGER_RE.match(param_value):
+        return int(param_value)
+    raise ValueError('rrule parameter should be integer or weekday constant (e.g. MO, TU, etc.). Error on: %s' % param_value)
+
+def _encode_param_value(value):
+    if isinstance(value, rrule.weekday):
+        return {'weekday': value.weekday, 'n': value.n}
+    return value
+
+def _decode_param_value(value):
+    if isinstance(value, dict):
+        return rrule.weekday(value['weekday'], value['n'])
+    return value
+
+def dump_params(params):
+    """
+    Serializes ``params``, the keyword arguments it parses to and their
+    canonical ``format_params`` form as JSON.  The malformed parameters are
+    left out, and there is no canonical form if there are any.
+    """
+    try:
+        canonical = format_params(parse_params(params))
+    except ValueError:
+        canonical = None
+    encoded = {}
+    for name, value in parse_params(params, strict=False).items():
+        if isinstance(value, list):
+            encoded[name] = [_encode_param_value(v) for v in value]
+        else:
+            encoded[name] = _encode_param_value(value)
+    return simplejson.dumps({'source': params, 'params': encoded, 'canonical': canonical})
+
+def load_canonical_params(data, params):
+    """
+    Returns the canonical form of ``params`` serialized by ``dump_params``,
+    or parses ``params`` again if ``data`` was not serialized from them.
+    Returns None if ``params`` is malformed.
+    """
+    if data:
+        data = simplejson.loads(data)
+        if data['source'] == params and 'canonical' in data:
+            return data['canonical']
+    try:
+        return format_params(parse_params(params))
+    except ValueError:
+        return None
+
+def load_params(data, params):
+    """
+    Returns the keyword arguments serialized by ``dump_params``, or None if
+    they were not serialized from ``params``.
+    """
+    data = simplejson.loads(data)
+    if data['source'] != params:
+        return None
+    param_dict = {}
+    for name, value in data['params'].items():
+        if isinstance(value, list):
+            value = [_decode_param_value(v) for v in value]
+        else:
+            value = _decode_param_value(value)
+        param_dict[str(name)] = value
+    return param_dict
+
+def format_params(param_dict):
+    """
+    Formats a dictionary of rrule keyword arguments back into the params
+    format. The output is canonical, so equal dictionaries always give the
+    same string.
+
+    >>> format_params({'interval': 2, 'byweekday': [rrule.MO(+1), rrule.FR]})
+    'interval:2;byweekday:MO(+1),FR'
+    """
+    params = []
+    for name in RRULE_PARAMS:
+        if name not in param_dict:
+            continue
+        values = param_dict[name]
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        params.append('%s:%s' % (name, ','.join([_format_param_value(v) for v in values])))
+    return ';'.join(params)
+
+def _format_param_value(value):
+    if isinstance(value, rrule.weekday):
+        if value.n:
+            return '%s(%+d)' % (WEEKDAY_NAMES[value.weekday], value.n)
+        return WEEKDAY_NAMES[value.weekday]
+    return str(value)
+
+WEEKDAY_NAMES = dict([(index, name) for name, index in RRULE_WEEKDAYS.items()])
+
+# RFC 5545 RRULE parts and the rrule parameter each one maps to
+RFC_RRULE_PARTS = (
+    ("COUNT", "count"),
+    ("INTERVAL", "interval"),
+    ("WKST", "wkst"),
+    ("BYSETPOS", "bysetpos"),
+    ("BYMONTH", "bymonth"),
+    ("BYMONTHDAY", "bymonthday"),
+    ("BYYEARDAY", "byyearday"),
+    ("BYEASTER", "byeaster"),
+    ("BYWEEKNO", "byweekno"),
+    ("BYDAY", "byweekday"),
+    ("BYHOUR", "byhour"),
+    ("BYMINUTE", "byminute"),
+    ("BYSECOND", "bysecond"),
+)
+RFC_WEEKDAY_RE = re.compile(r'^([+-]?\d+)?(MO|TU|WE|TH|FR|SA|SU)$')
+
+def parse_rrule_string(value):
+    """
+    Parses an RFC 5545 RRULE string into a (frequency, params) tuple, where
+    params follows the format of ``Rule.params``.  UNTIL is not supported,
+    use ``Reservation.end_recurring_period`` instead.
+
+    >>> parse_rrule_string("RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=10")
+    ('WEEKLY', 'count:10;byweekday:MO,WE')
+    """
+    value = value.strip()
+    if value.upper().startswith('RRULE:'):
+        value = value[len('RRULE:'):]
+    # let dateutil validate the rule before we translate it
+    try:
+        rrule.rrulestr(value, dtstart=datetime.datetime(2000, 1, 1))
+    except (KeyError, TypeError, ValueError), e:
+        raise ValueError('invalid rrule string %r: %s' % (value, e))
+    parts = {}
+    for part in value.upper().split(';'):
+        if part.strip() == "":
+            continue
+        name, part_value = part.split('=', 1)
+        parts[name.strip()] = part_value.strip()
+    frequency = parts.pop('FREQ', None)
+    if frequency not in dict(freqs):
+        raise ValueError('unsupported rrule frequency: %s' % frequency)
+    if 'UNTIL' in parts:
+        raise ValueError('UNTIL is not supported, use end_recurring_period instead')
+    param_dict = {}
+    for rfc_name, name in RFC_RRULE_PARTS:
+        if rfc_name not in parts:
+            continue
+        values = []
+        for part_value in parts.pop(rfc_name).split(','):
+            match = RFC_WEEKDAY_RE.match(part_value)
+            if match:
+                n, weekday = match.groups()
+                if n:
+                    part_value = '%s(%s)' % (weekday, n)
+                else:
+                    part_value = weekday
+            values.append(parse_param_value(part_value))
+        if len(values) == 1:
+            values = values[0]
+        param_dict[name] = values
+    if parts:
+        raise ValueError('unsupported rrule parts: %s' % ', '.join(sorted(parts)))
+    return frequency, format_params(param_dict)
+
+def format_rrule_string(frequency, param_dict):
+    """
+    Formats a frequency and a dictionary of rrule keyword arguments as an
+    RFC 5545 RRULE string.
+    """
+    parts = ['FREQ=%s' % frequency]
+    for rfc_name, name in RFC_RRULE_PARTS:
+        if name not in param_dict:
+            continue
+        values = param_dict[name]
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        parts.append('%s=%s' % (rfc_name, ','.join([_format_rfc_value(v) for v in values])))
+    return 'RRULE:%s' % ';'.join(parts)
+
+def _format_rfc_value(value):
+    if isinstance(value, rrule.weekday):
+        if value.n:
+            return '%+d%s' % (value.n, WEEKDAY_NAMES[value.weekday])
+        return WEEKDAY_NAMES[value.weekday]
+    return str(value)
+
 freqs = ( ("YEARLY", _("Yearly")),
             ("MONTHLY", _("Monthly")),
             ("WEEKLY", _("Weekly")),
@@ -13,6 +260,48 @@ freqs = ( ("YEARLY", _("Yearly")),
             ("MINUTELY", _("Minutely")),
             ("SECONDLY", _("Secondly")))
 
+class RuleManager(models.Manager):
+
+    def get_or_create_for_rrule_string(self, value):
+        """
+        Returns a (rule, created) tuple with a Rule equivalent to the RFC 5545
+        RRULE string ``value``, creating it only if there isn't one yet.
+        """
+        rules = self.from_rrule_strings([value])
+        return rules[value]
+
+    def from_rrule_strings(self, values):
+        """
+        Returns a dictionary mapping each of the RRULE strings in ``values``
+        to a (rule, created) tuple.  Equivalent strings share one Rule, so
+        thousands of reservations with the same recurrence use a single row.
+        """
+        new_rules = {}
+        for value in values:
+            if value not in new_rules:
+                new_rules[value] = Rule.from_rrule_string(value)
+        # only the rules of the same frequencies can be equivalent, and
+        # their canonical params were stored when they were saved
+        existing = {}
+        frequencies = set([rule.frequency for rule in new_rules.values()])
+        for rule in self.filter(frequency__in=frequencies).order_by('pk'):
+            canonical = load_canonical_params(rule.compiled_params, rule.params)
+            if canonical is not None:
+                existing.setdefault((rule.frequency, canonical), rule)
+        rules = {}
+        for value in values:
+            if value in rules:
+                continue
+            rule = new_rules[value]
+            key = (rule.frequency, rule.params)
+            created = key not in existing
+            if created:
+                rule.save()
+                existing[key] = rule
+            rules[value] = (existing[key], created)
+        return rules
+
+
 class Rule(models.Model):
     """
     This defines a rule by which an reservation will recur. This is defined by the
@@ -46,44 +335,70 @@ class Rule(models.Model):
     description = models.TextField(_("description"))
     frequency = models.CharField(_("frequency"), choices=freqs, max_length=10)
     params = models.TextField(_("params"), null=True, blank=True)
+    compiled_params = models.TextField(_("compiled params"), null=True, blank=True, editable=False)
+
+    objects = RuleManager()
 
     class Meta:
         verbose_name = _('rule')
         verbose_name_plural = _('rules')
         app_label = 'schedule'
 
-    def parse_param(self, param_value):
-        param = param_value.split('(',1)[0]
-        if param in RRULE_WEEKDAYS:
-            try:
-                return eval("rrule.%s" % param_value)
-            except ValueError:
-                raise ValueError('rrule parameter improperly formatted. Error on: %s' % param_value)
+    def clean(self):
         try:
-            return int(param_value)
-        except ValueError:
-            raise ValueError('rrule parameter should be integer or weekday constant (e.g. MO, TU, etc.). Error on: %s' % param_value)
+            parse_params(self.params)
+        except ValueError, e:
+            raise ValidationError(_("Params format looks invalid: %s") % e)
+
+    def save(self, *args, **kwargs):
+        self.compiled_params = dump_params(self.params)
+        super(Rule, self).save(*args, **kwargs)
+
+    def parse_param(self, param_value):
+        return parse_param_value(param_value)
 
     def get_params(self):
         """
         >>> rule = Rule(params = "count:1;bysecond:1;byminute:1,2,4,5")
         >>> rule.get_params()
         {'count': 1, 'byminute': [1, 2, 4, 5], 'bysecond': 1}
+
+        Saved rules read their params back from ``compiled_params`` instead
+        of parsing them again.  The malformed parameters, which ``clean``
+        rejects but older rows may have, are ignored.
+        """
+        cached = getattr(self, '_params_cache', None)
+        if cached is None or cached[0] != self.params:
+            param_dict = None
+            if self.compiled_params:
+                param_dict = load_params(self.compiled_params, self.params)
+            if param_dict is None:
+                param_dict = parse_params(self.params, strict=False)
+            cached = self._params_cache = (self.params, param_dict)
+        return dict(cached[1])
+
+    def from_rrule_string(cls, value):
+        """
+        Returns a new, unsaved Rule from an RFC 5545 RRULE string.
+
+        >>> rule = Rule.from_rrule_string("RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=10")
+        >>> rule.frequency, rule.params
+        ('WEEKLY', 'count:10;byweekday:MO,WE')
+        """
+        frequency, params = parse_rrule_string(value)
+        rrule_string = format_rrule_string(frequency, parse_params(params))
+        return cls(name=rrule_string[len('RRULE:'):][:32], description=rrule_string,
+            frequency=frequency, params=params)
+    from_rrule_string = classmethod(from_rrule_string)
+
+    def to_rrule_string(self):
+        """
+        Returns this rule as an RFC 5545 RRULE string.
+
+        >>> Rule(frequency="MONTHLY", params="byweekday:TH(+1);interval:2").to_rrule_string()
+        'RRULE:FREQ=MONTHLY;INTERVAL=2;BYDAY=+1TH'
         """
-        if self.params is None:
-            return {}
-        params = self.params.split(';')
-        param_dict = []
-        for param in params:
-            if param.strip() == "":
-                continue # skip blanks
-            param = param.split(':')
-            if len(param) == 2:
-                param = (str(param[0]).strip(), [self.parse_param(p.strip()) for p in param[1].split(',')])
-                if len(param[1]) == 1:
-                    param = (param[0], param[1][0])
-                param_dict.append(param)
-        return dict(param_dict)
+        return format_rrule_string(self.frequency, self.get_params())
 
     def __unicode__(self):
         """Human readable string for Rule"""
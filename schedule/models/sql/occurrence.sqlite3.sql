@@ -0,0 +1,4 @@
+-- persisted occurrences are looked up per reservation, either by the date
+-- their rule generated them on or by the date they have been moved to
+CREATE INDEX schedule_occurrence_reservation_original_start ON schedule_occurrence (reservation_id, original_start);
+CREATE INDEX schedule_occurrence_reservation_start_end ON schedule_occurrence (reservation_id, start, "end");
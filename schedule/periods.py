@@ -1,10 +1,11 @@
 import datetime
+from bisect import bisect_left, bisect_right
 from django.db.models.query import QuerySet
 from django.template.defaultfilters import date
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.utils.dates import WEEKDAYS, WEEKDAYS_ABBR
 from schedule.conf.settings import FIRST_DAY_OF_WEEK, SHOW_CANCELLED_OCCURRENCES
-from schedule.models import Occurrence
+from schedule.models import Occurrence, Reservation
 from schedule.utils import OccurrenceReplacer
 
 weekday_names = []
@@ -23,17 +24,169 @@ else:
         weekday_abbrs.append( WEEKDAYS_ABBR[i] )
 
 
+class OccurrencePool(object):
+    """
+    A sorted list of occurrences which answers overlap queries without
+    scanning all of its occurrences.  The occurrences are sorted on their
+    start and the running maximum of their ends is kept next to them, so
+    both the first and the last occurrence which may overlap a window are
+    found by bisection.
+    """
+    def __init__(self, occurrences):
+        self.occurrences = sorted(occurrences, key=lambda occurrence: occurrence.start)
+        self.starts = [occurrence.start for occurrence in self.occurrences]
+        self.max_ends = []
+        max_end = None
+        for occurrence in self.occurrences:
+            if max_end is None or occurrence.end > max_end:
+                max_end = occurrence.end
+            self.max_ends.append(max_end)
+
+    def __iter__(self):
+        return iter(self.occurrences)
+
+    def __len__(self):
+        return len(self.occurrences)
+
+    def overlapping(self, start, end):
+        """
+        Returns the occurrences which start before ``end`` and end after
+        ``start``, sorted on their start.
+        """
+        # every occurrence before first ends at or before start, every
+        # occurrence from last on starts at or after end
+        first = bisect_right(self.max_ends, start)
+        last = bisect_left(self.starts, end)
+        return [occurrence for occurrence in self.occurrences[first:last]
+            if occurrence.end > start]
+
+
+class OccurrenceCache(object):
+    """
+    Caches the occurrences of a list of reservations for the duration of a
+    request.  A period and all of the periods derived from it share the same
+    cache, so the persisted occurrences are fetched once and the rules are
+    only expanded for windows which are not within a window expanded before.
+    ``hits`` and ``misses`` count how many lookups were served from the cache.
+    """
+    def __init__(self, reservations):
+        self.reservations = reservations
+        self.hits = 0
+        self.misses = 0
+        self._reservation_list = None
+        self._persisted_occurrences = None
+        self._windows = []
+        self._pending_windows = []
+        self._busy_days = {}
+
+    def get_reservations(self):
+        if self._reservation_list is None:
+            self._reservation_list = list(self.reservations)
+        return self._reservation_list
+
+    def get_persisted_occurrences(self):
+        if self._persisted_occurrences is None:
+            self.misses += 1
+            # left lazy, the periods only query it when they look at it
+            self._persisted_occurrences = Occurrence.objects.filter(
+                reservation__in=self.reservations)
+        else:
+            self.hits += 1
+        return self._persisted_occurrences
+
+    def get_occurrences(self, start, end):
+        """
+        Returns the sorted occurrences from start to end.
+        """
+        for window_start, window_end, occurrences, pool in self._windows:
+            if window_start <= start and end <= window_end:
+                self.hits += 1
+                if window_start == start and window_end == end:
+                    return occurrences
+                return pool.overlapping(start, end)
+        self.misses += 1
+        for window_start, window_end in self._pending_windows:
+            if window_start <= start and end <= window_end:
+                # expand the whole window the lookup is part of
+                self._pending_windows.remove((window_start, window_end))
+                self.expand_window(window_start, window_end)
+                return self._windows[-1][3].overlapping(start, end)
+        return self.expand_window(start, end)
+
+    def expand_window(self, start, end):
+        occurrences = Reservation.objects.get_occurrences_for(
+            self.get_reservations(), start, end)
+        self._windows.append((start, end, occurrences, OccurrencePool(occurrences)))
+        return occurrences
+
+    def add_pending_window(self, start, end):
+        """
+        Tells the cache that the occurrences from start to end are going to
+        be looked up, piece by piece, so that the first lookup within that
+        window expands all of it.
+        """
+        if (start, end) not in self._pending_windows:
+            self._pending_windows.append((start, end))
+
+    def get_busy_days(self, start, end):
+        """
+        Returns a bytearray with one byte per day from ``start``, which must
+        be a midnight, to ``end``, set to 1 for the days on which at least one
+        occurrence takes place.  The days are computed a whole year at a
+        time from the spans of the occurrences, without building any
+        occurrence object, so all of the months of a year share one pass.
+        """
+        busy_days = bytearray()
+        year = start.year
+        while True:
+            year_start = datetime.datetime(year, 1, 1)
+            if year_start >= end:
+                break
+            busy_days += self._get_busy_year(year)
+            year += 1
+        offset = (start - datetime.datetime(start.year, 1, 1)).days
+        return busy_days[offset:offset + (end - start).days]
+
+    def _get_busy_year(self, year):
+        if year in self._busy_days:
+            self.hits += 1
+            return self._busy_days[year]
+        self.misses += 1
+        start = datetime.datetime(year, 1, 1)
+        end = datetime.datetime(year + 1, 1, 1)
+        days = (end - start).days
+        busy_days = bytearray(days)
+        spans = Reservation.objects.get_occurrence_spans(self.get_reservations(),
+            start, end, include_cancelled=SHOW_CANCELLED_OCCURRENCES)
+        for o_start, o_end in spans:
+            first = max((o_start - start).days, 0)
+            # the last day which starts before the occurrence ends
+            length = o_end - start
+            last = min(length.days, days)
+            if length.seconds or length.microseconds:
+                last += 1
+            if first < last:
+                busy_days[first:last] = '\x01' * (last - first)
+        self._busy_days[year] = busy_days
+        return busy_days
+
+
 class Period(object):
     '''
     This class represents a period of time. It can return a set of occurrences
     based on its reservations, and its time period (start and end).
     '''
     def __init__(self, reservations, start, end, parent_persisted_occurrences = None,
-        occurrence_pool=None):
+        occurrence_pool=None, occurrence_cache=None):
         self.start = start
         self.end = end
         self.reservations = reservations
+        if occurrence_pool is not None and not isinstance(occurrence_pool, OccurrencePool):
+            occurrence_pool = OccurrencePool(occurrence_pool)
         self.occurrence_pool = occurrence_pool
+        if occurrence_cache is None:
+            occurrence_cache = OccurrenceCache(reservations)
+        self.occurrence_cache = occurrence_cache
         if parent_persisted_occurrences is not None:
             self._persisted_occurrences = parent_persisted_occurrences
 
@@ -44,16 +197,9 @@ class Period(object):
         return self.start!=period.start or self.end!=period.end or self.reservations!=period.reservations
 
     def _get_sorted_occurrences(self):
-        occurrences = []
-        if hasattr(self, "occurrence_pool") and self.occurrence_pool is not None:
-            for occurrence in self.occurrence_pool:
-                if occurrence.start < self.end and occurrence.end > self.start:
-                    occurrences.append(occurrence)
-            return occurrences
-        for reservation in self.reservations:
-            reservation_occurrences = reservation.get_occurrences(self.start, self.end)
-            occurrences += reservation_occurrences
-        return sorted(occurrences)
+        if self.occurrence_pool is not None:
+            return self.occurrence_pool.overlapping(self.start, self.end)
+        return self.occurrence_cache.get_occurrences(self.start, self.end)
 
     def cached_get_sorted_occurrences(self):
         if hasattr(self, '_occurrences'):
@@ -64,12 +210,28 @@ class Period(object):
     occurrences = property(cached_get_sorted_occurrences)
 
     def get_persisted_occurrences(self):
-        if hasattr(self, '_persisted_occurrenes'):
+        if hasattr(self, '_persisted_occurrences'):
             return self._persisted_occurrences
         else:
-            self._persisted_occurrences = Occurrence.objects.filter(reservation__in = self.reservations)
+            self._persisted_occurrences = self.occurrence_cache.get_persisted_occurrences()
             return self._persisted_occurrences
 
+    def occurrence_tuples(self):
+        """
+        Returns the (reservation_id, title, start, end, cancelled) tuples of
+        the occurrences of the period, sorted by start, without building any
+        occurrence object.
+        """
+        return Reservation.objects.get_occurrence_rows(
+            self.occurrence_cache.get_reservations(), self.start, self.end)
+
+    def get_busy_days(self):
+        """
+        Returns a bytearray with one byte per day of the period, set to 1 if
+        the day has occurrences.  The period must start at a midnight.
+        """
+        return self.occurrence_cache.get_busy_days(self.start, self.end)
+
     def classify_occurrence(self, occurrence):
         """
             returns an integer marker denoting what is the relation of the
@@ -119,14 +281,15 @@ class Period(object):
 
     def get_time_slot(self, start, end ):
         if start >= self.start and end <= self.end:
+            self.occurrence_cache.add_pending_window(self.start, self.end)
             return Period( self.reservations, start, end,
-                parent_persisted_occurrences=self.get_persisted_occurrences(),
-                occurrence_pool=self.occurrences)
+                occurrence_cache=self.occurrence_cache)
         return None
 
     def create_sub_period(self, cls, start=None):
         start = start or self.start
-        return cls(self.reservations, start, self.get_persisted_occurrences(), self.occurrences)
+        self.occurrence_cache.add_pending_window(self.start, self.end)
+        return cls(self.reservations, start, occurrence_cache=self.occurrence_cache)
 
     def get_periods(self, cls):
         period = self.create_sub_period(cls)
@@ -136,22 +299,26 @@ class Period(object):
 
 
 class Year(Period):
-    def __init__(self, reservations, date=None, parent_persisted_occurrences=None):
+    def __init__(self, reservations, date=None, parent_persisted_occurrences=None,
+        occurrence_pool=None, occurrence_cache=None):
         if date is None:
             date = datetime.datetime.now()
         start, end = self._get_year_range(date)
-        super(Year, self).__init__(reservations, start, end, parent_persisted_occurrences)
+        super(Year, self).__init__(reservations, start, end,
+            parent_persisted_occurrences, occurrence_pool, occurrence_cache)
 
     def get_months(self):
         return self.get_periods(Month)
 
     def next_year(self):
-        return Year(self.reservations, self.end)
+        return Year(self.reservations, self.end,
+            occurrence_cache=self.occurrence_cache)
     next = next_year
 
     def prev_year(self):
         start = datetime.datetime(self.start.year-1, self.start.month, self.start.day)
-        return Year(self.reservations, start)
+        return Year(self.reservations, start,
+            occurrence_cache=self.occurrence_cache)
     prev = prev_year
 
     def _get_year_range(self, year):
@@ -172,12 +339,12 @@ class Month(Period):
     and day periods within the date.
     """
     def __init__(self, reservations, date=None, parent_persisted_occurrences=None,
-        occurrence_pool=None):
+        occurrence_pool=None, occurrence_cache=None):
         if date is None:
             date = datetime.datetime.now()
         start, end = self._get_month_range(date)
         super(Month, self).__init__(reservations, start, end,
-            parent_persisted_occurrences, occurrence_pool)
+            parent_persisted_occurrences, occurrence_pool, occurrence_cache)
 
     def get_weeks(self):
         return self.get_periods(Week)
@@ -186,6 +353,52 @@ class Month(Period):
     def get_days(self):
         return self.get_periods(Day)
 
+    def build_grid(self, busy_only=False):
+        """
+        Returns the weeks of the month as lists of seven cells, each cell
+        being a dictionary with the ``day`` period, whether the day is
+        ``in_month``, the ``partials`` of the day as returned by
+        ``get_occurrence_partials`` and whether the day is ``busy``.  The
+        partials are computed in a single sweep over the occurrences of the
+        month; they are left empty for the days which are not in the month.
+
+        If ``busy_only`` is set the partials are None and the busy flags are
+        read from ``get_busy_days`` without expanding any occurrence.
+        """
+        one_day = datetime.timedelta(days=1)
+        grid_start = self.create_sub_period(Week).start
+        cells = []
+        date = grid_start
+        while date < self.end or len(cells) % 7:
+            cells.append({
+                'day': self.create_sub_period(Day, date),
+                'in_month': self.start <= date < self.end,
+                'partials': [],
+            })
+            date += one_day
+        if busy_only:
+            busy_days = self.get_busy_days()
+            for cell in cells:
+                cell['partials'] = None
+                cell['busy'] = bool(cell['in_month'] and
+                    busy_days[(cell['day'].start - self.start).days])
+            return [cells[i:i + 7] for i in range(0, len(cells), 7)]
+        for occurrence in self.occurrences:
+            first = max((occurrence.start - grid_start).days, 0)
+            # the last day which starts before the occurrence ends
+            length = occurrence.end - grid_start
+            last = length.days
+            if not (length.seconds or length.microseconds):
+                last -= 1
+            for cell in cells[first:last + 1]:
+                if cell['in_month']:
+                    partial = cell['day'].classify_occurrence(occurrence)
+                    if partial:
+                        cell['partials'].append(partial)
+        for cell in cells:
+            cell['busy'] = bool(cell['partials'])
+        return [cells[i:i + 7] for i in range(0, len(cells), 7)]
+
     def get_day(self, daynumber ):
         date = self.start
         if daynumber > 1:
@@ -193,24 +406,29 @@ class Month(Period):
         return self.create_sub_period(Day, date)
 
     def next_month(self):
-        return Month(self.reservations, self.end)
+        return Month(self.reservations, self.end,
+            occurrence_cache=self.occurrence_cache)
     next = next_month
 
     def prev_month(self):
         start = (self.start - datetime.timedelta(days=1)).replace(day=1)
-        return Month(self.reservations, start)
+        return Month(self.reservations, start,
+            occurrence_cache=self.occurrence_cache)
     prev = prev_month
 
     def current_year(self):
-        return Year(self.reservations, self.start)
+        return Year(self.reservations, self.start,
+            occurrence_cache=self.occurrence_cache)
 
     def prev_year(self):
         start = datetime.datetime.min.replace(year=self.start.year-1)
-        return Year(self.reservations, start)
+        return Year(self.reservations, start,
+            occurrence_cache=self.occurrence_cache)
 
     def next_year(self):
         start = datetime.datetime.min.replace(year=self.start.year+1)
-        return Year(self.reservations, start)
+        return Year(self.reservations, start,
+            occurrence_cache=self.occurrence_cache)
 
     def _get_month_range(self, month):
         year = month.year
@@ -237,26 +455,30 @@ class Week(Period):
     The Week period that has functions for retrieving Day periods within it
     """
     def __init__(self, reservations, date=None, parent_persisted_occurrences=None,
-        occurrence_pool=None):
+        occurrence_pool=None, occurrence_cache=None):
         if date is None:
             date = datetime.datetime.now()
         start, end = self._get_week_range(date)
         super(Week, self).__init__(reservations, start, end,
-            parent_persisted_occurrences, occurrence_pool)
+            parent_persisted_occurrences, occurrence_pool, occurrence_cache)
 
     def prev_week(self):
-        return Week(self.reservations, self.start - datetime.timedelta(days=7))
+        return Week(self.reservations, self.start - datetime.timedelta(days=7),
+            occurrence_cache=self.occurrence_cache)
     prev = prev_week
 
     def next_week(self):
-        return Week(self.reservations, self.end)
+        return Week(self.reservations, self.end,
+            occurrence_cache=self.occurrence_cache)
     next = next_week
 
     def current_month(self):
-        return Month(self.reservations, self.start)
+        return Month(self.reservations, self.start,
+            occurrence_cache=self.occurrence_cache)
 
     def current_year(self):
-        return Year(self.reservations, self.start)
+        return Year(self.reservations, self.start,
+            occurrence_cache=self.occurrence_cache)
 
     def get_days(self):
         return self.get_periods(Day)
@@ -291,12 +513,12 @@ class Week(Period):
 
 class Day(Period):
     def __init__(self, reservations, date=None, parent_persisted_occurrences=None,
-        occurrence_pool=None):
+        occurrence_pool=None, occurrence_cache=None):
         if date is None:
             date = datetime.datetime.now()
         start, end = self._get_day_range(date)
         super(Day, self).__init__(reservations, start, end,
-            parent_persisted_occurrences, occurrence_pool)
+            parent_persisted_occurrences, occurrence_pool, occurrence_cache)
 
     def _get_day_range(self, date):
         if isinstance(date, datetime.datetime):
@@ -313,18 +535,23 @@ class Day(Period):
         }
 
     def prev_day(self):
-        return Day(self.reservations, self.start - datetime.timedelta(days=1))
+        return Day(self.reservations, self.start - datetime.timedelta(days=1),
+            occurrence_cache=self.occurrence_cache)
     prev = prev_day
 
     def next_day(self):
-        return Day(self.reservations, self.end)
+        return Day(self.reservations, self.end,
+            occurrence_cache=self.occurrence_cache)
     next = next_day
 
     def current_year(self):
-        return Year(self.reservations, self.start)
+        return Year(self.reservations, self.start,
+            occurrence_cache=self.occurrence_cache)
 
     def current_month(self):
-        return Month(self.reservations, self.start)
+        return Month(self.reservations, self.start,
+            occurrence_cache=self.occurrence_cache)
 
     def current_week(self):
-        return Week(self.reservations, self.start)
+        return Week(self.reservations, self.start,
+            occurrence_cache=self.occurrence_cache)
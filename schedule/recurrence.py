@@ -0,0 +1,191 @@
+import datetime
+import itertools
+from fractions import gcd
+
+# frequencies whose occurrences are a fixed number of seconds apart, as long
+# as no other parameter than count and interval is used
+SIMPLE_FREQUENCIES = {
+    "WEEKLY": 7 * 24 * 60 * 60,
+    "DAILY": 24 * 60 * 60,
+    "HOURLY": 60 * 60,
+    "MINUTELY": 60,
+    "SECONDLY": 1,
+}
+SIMPLE_PARAMS = set(["count", "interval"])
+
+def _microseconds(delta):
+    return (delta.days * 24 * 60 * 60 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class SimpleRecurrence(object):
+    """
+    A recurrence whose occurrences are ``step`` apart, starting at
+    ``dtstart``.  It answers ``between``, ``after`` and iteration like a
+    ``dateutil.rrule.rrule`` would, but computes the first occurrence of a
+    window with integer arithmetic instead of iterating from ``dtstart``.
+    """
+    def __init__(self, dtstart, step, count=None):
+        # like dateutil, ignore the microseconds of dtstart
+        self.dtstart = dtstart.replace(microsecond=0)
+        self.step = step
+        self.count = count
+        self._step = _microseconds(step)
+
+    def _first_index(self, dt, inc):
+        """
+        Returns the index of the first occurrence after ``dt``.
+        """
+        elapsed = _microseconds(dt - self.dtstart)
+        index, remainder = divmod(elapsed, self._step)
+        if not (inc and remainder == 0):
+            index += 1
+        return max(index, 0)
+
+    def _occurrence(self, index):
+        if self.count is not None and index >= self.count:
+            return None
+        return self.dtstart + self.step * index
+
+    def between(self, after, before, inc=False):
+        occurrences = []
+        index = self._first_index(after, inc)
+        occurrence = self._occurrence(index)
+        while occurrence is not None and (occurrence < before or (inc and occurrence == before)):
+            occurrences.append(occurrence)
+            index += 1
+            occurrence = self._occurrence(index)
+        return occurrences
+
+    def after(self, dt, inc=False):
+        return self._occurrence(self._first_index(dt, inc))
+
+    def xafter(self, dt, inc=False):
+        """
+        Yields the occurrences after ``dt``.
+        """
+        index = self._first_index(dt, inc)
+        occurrence = self._occurrence(index)
+        while occurrence is not None:
+            yield occurrence
+            index += 1
+            occurrence = self._occurrence(index)
+
+    def __iter__(self):
+        return self.xafter(self.dtstart, inc=True)
+
+    def count_before(self, until=None):
+        """
+        Returns the number of occurrences starting before ``until``, or
+        None if there are infinitely many.
+        """
+        count = self.count
+        if until is not None:
+            before = max(-(-_microseconds(until - self.dtstart) // self._step), 0)
+            if count is None or before < count:
+                count = before
+        return count
+
+
+def get_simple_recurrence(frequency, params, dtstart):
+    """
+    Returns a SimpleRecurrence equivalent to the rrule of ``frequency`` and
+    ``params`` starting at ``dtstart``, or None if the rule is too complex
+    to be expanded arithmetically.
+    """
+    if frequency not in SIMPLE_FREQUENCIES or not SIMPLE_PARAMS.issuperset(params):
+        return None
+    interval = params.get("interval", 1)
+    count = params.get("count")
+    if not isinstance(interval, int) or interval < 1:
+        return None
+    if count is not None and not isinstance(count, int):
+        return None
+    step = datetime.timedelta(seconds=SIMPLE_FREQUENCIES[frequency] * interval)
+    return SimpleRecurrence(dtstart, step, count)
+
+
+def iter_after(recurrence, dt):
+    """
+    Yields the occurrences of ``recurrence`` strictly after ``dt``.  A
+    SimpleRecurrence starts right there, a dateutil rrule, which has no
+    ``xafter``, is walked from its dtstart.
+    """
+    if isinstance(recurrence, SimpleRecurrence):
+        return recurrence.xafter(dt)
+    return itertools.dropwhile(lambda occurrence: occurrence <= dt, recurrence)
+
+
+def spans_overlap(first_starts, first_duration, second_starts, second_duration):
+    """
+    Returns whether one of the occurrences starting at the sorted
+    ``first_starts`` and lasting ``first_duration`` overlaps one of the
+    occurrences starting at the sorted ``second_starts``.  Both sequences
+    are consumed at most once and only as far as needed.
+    """
+    first_starts = iter(first_starts)
+    second_starts = iter(second_starts)
+    try:
+        first = first_starts.next()
+        second = second_starts.next()
+        while True:
+            if first + first_duration <= second:
+                first = first_starts.next()
+            elif second + second_duration <= first:
+                second = second_starts.next()
+            else:
+                return True
+    except StopIteration:
+        return False
+
+
+def simple_recurrences_overlap(first, first_duration, first_until,
+    second, second_duration, second_until):
+    """
+    Returns whether an occurrence of the SimpleRecurrence ``first``, lasting
+    ``first_duration`` and starting before ``first_until``, overlaps an
+    occurrence of ``second``.  The untils may be None.
+
+    The start of an occurrence of second minus the start of an occurrence
+    of first is always the phase of second relative to first plus a
+    multiple of the gcd of the two steps, and the pattern repeats every lcm
+    of the steps.  So whenever both recurrences run together for more than
+    that lcm the answer only depends on the phase and the gcd, and the
+    occurrences are never expanded.  Otherwise the occurrences of the short
+    stretch during which both run are merged.
+    """
+    first_count = first.count_before(first_until)
+    second_count = second.count_before(second_until)
+    if first_count == 0 or second_count == 0:
+        return False
+    first_step, second_step = first._step, second._step
+    first_length = _microseconds(first_duration)
+    second_length = _microseconds(second_duration)
+    # everything is measured in microseconds from the start of first
+    phase = _microseconds(second.dtstart - first.dtstart)
+    common_start = max(0, phase)
+    common_end = None
+    if first_count is not None:
+        common_end = (first_count - 1) * first_step + first_length
+    if second_count is not None:
+        second_end = phase + (second_count - 1) * second_step + second_length
+        if common_end is None or second_end < common_end:
+            common_end = second_end
+    if common_end is not None and common_end <= common_start:
+        return False
+    step_gcd = gcd(first_step, second_step)
+    hyperperiod = first_step // step_gcd * second_step
+    margin = hyperperiod + first_step + second_step + first_length + second_length
+    if common_end is None or common_end - common_start >= margin:
+        # the smallest non negative difference between the starts, and the
+        # largest negative one
+        remainder = phase % step_gcd
+        return remainder < first_length or step_gcd - remainder < second_length
+    start = first.dtstart + datetime.timedelta(microseconds=common_start)
+    end = first.dtstart + datetime.timedelta(microseconds=common_end)
+    first_starts = first.between(start - first_duration, end)
+    second_starts = second.between(start - second_duration, end)
+    if first_until is not None:
+        first_starts = [s for s in first_starts if s < first_until]
+    if second_until is not None:
+        second_starts = [s for s in second_starts if s < second_until]
+    return spans_overlap(first_starts, first_duration, second_starts, second_duration)
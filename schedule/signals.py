@@ -1,6 +1,9 @@
-from django.db.models.signals import pre_save
+import datetime
 
-from models import Reservation, Room
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from models import Reservation, Room, Rule, Occurrence, OccurrenceIndex
+from utils import rrule_cache
 
 def optionnal_room(sender, **kwargs):
     reservation = kwargs.pop('instance')
@@ -18,3 +21,65 @@ def optionnal_room(sender, **kwargs):
     return True
 
 pre_save.connect(optionnal_room)
+
+def invalidate_rrule_cache(sender, **kwargs):
+    rrule_cache.invalidate(kwargs['instance'])
+
+post_save.connect(invalidate_rrule_cache, sender=Rule)
+post_delete.connect(invalidate_rrule_cache, sender=Rule)
+
+def refresh_occurrence_index(sender, **kwargs):
+    if not OccurrenceIndex.objects.is_enabled():
+        return
+    instance = kwargs['instance']
+    if isinstance(instance, Reservation):
+        reservations = [instance]
+    else:
+        reservations = instance.reservation_set.all()
+    for reservation in reservations:
+        OccurrenceIndex.objects.refresh_reservation(reservation)
+
+def refresh_occurrence_index_row(sender, **kwargs):
+    if not OccurrenceIndex.objects.is_enabled():
+        return
+    OccurrenceIndex.objects.refresh_occurrence(kwargs['instance'],
+        deleted=kwargs['signal'] is post_delete)
+
+# deleting a reservation, or the rule it uses, deletes its index rows by
+# cascade, so only the deletion of an occurrence needs a refresh
+post_save.connect(refresh_occurrence_index, sender=Reservation)
+post_save.connect(refresh_occurrence_index, sender=Rule)
+post_save.connect(refresh_occurrence_index_row, sender=Occurrence)
+post_delete.connect(refresh_occurrence_index_row, sender=Occurrence)
+
+def bump_room_version(sender, **kwargs):
+    room = kwargs['instance']
+    if room.pk is not None:
+        # the instance may be older than the version bumped by touch
+        versions = list(Room.objects.filter(pk=room.pk).values_list('version', flat=True))
+        room.version = max(versions + [room.version]) + 1
+    room.last_modified = datetime.datetime.now()
+
+pre_save.connect(bump_room_version, sender=Room)
+
+def touch_previous_room(sender, **kwargs):
+    reservation = kwargs['instance']
+    if reservation.pk is not None:
+        # the reservation may be moved to another room
+        Room.objects.touch(Reservation.objects.filter(pk=reservation.pk).values('room'))
+
+def touch_room(sender, **kwargs):
+    instance = kwargs['instance']
+    if isinstance(instance, Reservation):
+        Room.objects.touch([instance.room_id])
+    elif isinstance(instance, Rule):
+        Room.objects.touch(instance.reservation_set.values('room'))
+    else:
+        Room.objects.touch(Reservation.objects.filter(pk=instance.reservation_id).values('room'))
+
+pre_save.connect(touch_previous_room, sender=Reservation)
+post_save.connect(touch_room, sender=Reservation)
+post_delete.connect(touch_room, sender=Reservation)
+post_save.connect(touch_room, sender=Rule)
+post_save.connect(touch_room, sender=Occurrence)
+post_delete.connect(touch_room, sender=Occurrence)
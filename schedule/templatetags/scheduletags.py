@@ -1,44 +1,146 @@
 import datetime
+import hashlib
+import heapq
+from collections import defaultdict, namedtuple
 from django.conf import settings
 from django import template
+from django.core.cache import cache
+from django.template.loader import get_template
 from django.core.urlresolvers import reverse
+from django.utils import translation
 from django.utils.dateformat import format
 from django.conf import settings
-from schedule.conf.settings import CHECK_PERMISSION_FUNC
+from schedule.conf.settings import CHECK_PERMISSION_FUNC, FRAGMENT_CACHE_TIMEOUT, PERMISSION_CLASS_FUNC
 from schedule.models import Room
+from schedule.recurrence import _microseconds
 from schedule.periods import weekday_names, weekday_abbrs,  Month
 
 register = template.Library()
 
-@register.inclusion_tag("schedule/_month_table.html",  takes_context=True)
-def month_table(context,  room, month, size="regular", shift=None):
+class FragmentCache(object):
+    """
+    Renders the fragments of the tags of this library through Django's
+    cache, and counts the hits and misses of every tag to tell how much the
+    fragments are reused across views and users.
+    """
+    def __init__(self):
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._templates = {}
+
+    def get_template(self, template_name):
+        if template_name not in self._templates:
+            self._templates[template_name] = get_template(template_name)
+        return self._templates[template_name]
+
+    def render(self, context, template_name, get_values, room, key_parts, timeout=None):
+        """
+        Renders ``template_name`` with the values returned by ``get_values``
+        added to ``context``.  If ``timeout``, FRAGMENT_CACHE_TIMEOUT by
+        default, is not 0 the fragment is cached under ``key_parts``, the
+        first of which is the name of the tag, the version of ``room``, the
+        permission class of the user and the active language, in which the
+        names of the days and the dates are rendered.
+        """
+        def render():
+            context.update(get_values())
+            try:
+                return self.get_template(template_name).render(context)
+            finally:
+                context.pop()
+        if timeout is None:
+            timeout = FRAGMENT_CACHE_TIMEOUT
+        request = context.get('request')
+        if not timeout or request is None or not isinstance(room, Room):
+            return render()
+        name = key_parts[0]
+        key = u'.'.join([unicode(part) for part in key_parts] + [unicode(room.pk),
+            unicode(room.version), PERMISSION_CLASS_FUNC(request, room),
+            translation.get_language()])
+        key = 'schedule.fragment.%s.%s' % (name, hashlib.md5(key.encode('utf-8')).hexdigest())
+        content = cache.get(key)
+        if content is None:
+            self.misses[name] += 1
+            content = render()
+            cache.set(key, content, timeout)
+        else:
+            self.hits[name] += 1
+        return content
+
+    def hit_rate(self, name=None):
+        """
+        Returns the share of the fragments of the tag ``name``, or of all of
+        the tags, found in the cache.
+        """
+        if name is None:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        else:
+            hits, misses = self.hits[name], self.misses[name]
+        if not hits + misses:
+            return 0.0
+        return float(hits) / (hits + misses)
+
+fragment_cache = FragmentCache()
+
+
+@register.simple_tag(takes_context=True)
+def month_table(context,  room, month, size="regular", shift=None, cache_timeout=None):
+    """
+    Displays a month as a table.  The rendered table is cached for
+    ``cache_timeout`` seconds, FRAGMENT_CACHE_TIMEOUT by default.
+    """
     if shift:
         if shift == -1:
             month = month.prev()
         if shift == 1:
             month = month.next()
-    if size == "small":
-        context['day_names']  = weekday_abbrs
-    else:
-        context['day_names']  = weekday_names
-    context['room'] = room
-    context['month'] = month
-    context['size'] = size
-    return context
+    def get_values():
+        if size == "small":
+            day_names = weekday_abbrs
+        else:
+            day_names = weekday_names
+        return {
+            'day_names': day_names,
+            'room': room,
+            'month': month,
+            # small tables only show whether the days are busy
+            'grid': month.build_grid(busy_only=(size == "small")),
+            'size': size,
+        }
+    return fragment_cache.render(context, "schedule/_month_table.html", get_values,
+        room, ('month_table', month.start, size), cache_timeout)
 
-@register.inclusion_tag("schedule/_day_cell.html",  takes_context=True)
-def day_cell(context,  room, day, month, size="regular" ):
-    context.update({
-        'room' : room,
-        'day' : day,
-        'month' : month,
-        'size' : size
-    })
-    return context
+@register.simple_tag(takes_context=True)
+def day_cell(context,  room, day, month, size="regular", partials=None, busy=None, cache_timeout=None):
+    """
+    Displays a day of a month table.  ``partials`` and ``busy`` are the
+    occurrence partials of the day and its busy flag as computed by
+    ``Month.build_grid``; they are computed from the day itself if they
+    are not given.  Small cells only need the busy flag.  The rendered cell
+    is cached for ``cache_timeout`` seconds, FRAGMENT_CACHE_TIMEOUT by
+    default.  Month tables, which are cached as a whole, do not cache their
+    cells.
+    """
+    def get_values():
+        cell_partials, cell_busy = partials, busy
+        if cell_partials is None and (cell_busy is None or size != "small"):
+            cell_partials = day.get_occurrence_partials()
+        if cell_busy is None:
+            cell_busy = bool(cell_partials)
+        return {
+            'room' : room,
+            'day' : day,
+            'month' : month,
+            'size' : size,
+            'partials' : cell_partials,
+            'busy' : cell_busy,
+        }
+    return fragment_cache.render(context, "schedule/_day_cell.html", get_values,
+        room, ('day_cell', day.start, month.start, size), cache_timeout)
 
 
-@register.inclusion_tag("schedule/_daily_table.html", takes_context=True)
-def daily_table( context, day, width, width_slot, height, start=8, end=20, increment=30):
+@register.simple_tag(takes_context=True)
+def daily_table( context, day, width, width_slot, height, start=8, end=20, increment=30, cache_timeout=None):
     """
       Display a nice table with occurrences and action buttons.
       Arguments:
@@ -48,22 +150,30 @@ def daily_table( context, day, width, width_slot, height, start=8, end=20, incre
       start - hour at which the day starts
       end - hour at which the day ends
       increment - size of a time slot (in minutes)
+      cache_timeout - seconds the table is cached for, FRAGMENT_CACHE_TIMEOUT
+      by default
     """
-    user = context['request'].user
-    context['addable'] = CHECK_PERMISSION_FUNC(None, user)
-    width_occ = width - width_slot
-    day_part = day.get_time_slot(day.start  + datetime.timedelta(hours=start), day.start  + datetime.timedelta(hours=end))
-    occurrences = day_part.get_occurrences()
-    occurrences = _cook_occurrences(day_part, occurrences, width_occ, height)
-    # get slots to display on the left
-    slots = _cook_slots(day_part, increment, width, height)
-    context['occurrences'] = occurrences
-    context['slots'] = slots
-    context['width'] = width
-    context['width_slot'] = width_slot
-    context['width_occ'] = width_occ
-    context['height'] = height
-    return context
+    def get_values():
+        user = context['request'].user
+        width_occ = width - width_slot
+        day_part = day.get_time_slot(day.start  + datetime.timedelta(hours=start), day.start  + datetime.timedelta(hours=end))
+        occurrences = day_part.get_occurrences()
+        occurrences = _cook_occurrences(day_part, occurrences, width_occ, height)
+        # get slots to display on the left
+        slots = _cook_slots(day_part, increment, width, height, occurrences)
+        return {
+            'addable': CHECK_PERMISSION_FUNC(None, user),
+            'occurrences': occurrences,
+            'slots': slots,
+            'width': width,
+            'width_slot': width_slot,
+            'width_occ': width_occ,
+            'height': height,
+        }
+    # the links of the table lead back to the page
+    return fragment_cache.render(context, "schedule/_daily_table.html", get_values,
+        context.get('room'), ('daily_table', day.start, start, end, width, width_slot, height,
+        increment, context.get('here')), cache_timeout)
 
 @register.inclusion_tag("schedule/_reservation_title.html", takes_context=True)
 def title(context, occurrence ):
@@ -214,82 +324,100 @@ def _period_duration(period):
     duration = period.end - period.start
     return (duration.days * 24 * 60 * 60) + duration.seconds
 
+OccurrenceLayout = namedtuple('OccurrenceLayout', [
+    'occurrence', 'cls', 'real_start', 'real_end', 'column', 'columns',
+    'top', 'left', 'width', 'height'])
+
+
 def _cook_occurrences(period, occs, width, height):
     """ Prepare occurrences to be displayed.
-        Calculate dimensions and position (in px) for each occurrence.
-        The algorithm tries to fit overlapping occurrences so that they require a minimum
-        number of "columns".
+        Calculate dimensions and position (in px) for each occurrence and
+        return them as OccurrenceLayout tuples, sorted by start.
+        Every occurrence goes in the leftmost column free at its start; all
+        of the occurrences of a group of overlapping ones share the width of
+        the table equally between the columns the group needs.  The
+        occurrences are swept once by start, keeping the ends of the ones
+        still going on in a heap, so this takes O(n log n).
         Arguments:
         period - time period for the whole series
         occs - occurrences to be displayed
-        increment - slot size in minutes
         width - width of the occurrences column (px)
         height - height of the table (px)
     """
-    last = {}
-    # find out which occurrences overlap
-    for o in occs[:]:
-        o.data = period.classify_occurrence(o)
-        if not o.data:
-            occs.remove(o)
+    duration_seconds = _period_duration(period)
+    layouts = []
+    group = []
+    # (end, column) of the occurrences going on, and the free columns
+    going_on = []
+    free_columns = []
+    columns = 0
+
+    def close_group():
+        w = int(width / columns)
+        for o, data, column in group:
+            real_start = max(o.start, period.start)
+            real_end = min(o.end, period.end)
+            top = int(height * (float((real_start - period.start).seconds) / duration_seconds))
+            o_height = int(height * (float((real_end - real_start).seconds) / duration_seconds))
+            layouts.append(OccurrenceLayout(o, data['class'], real_start, real_end,
+                column, columns, top, w * column, w - 2,
+                # trim what extends beyond the area
+                min(o_height, height - top)))
+
+    for o in sorted(occs, key=lambda o: (o.start, o.end)):
+        data = period.classify_occurrence(o)
+        if not data:
             continue
-        o.level = -1
-        o.max = 0
-        if not last:
-            last[0] = o
-            o.level = 0
+        while going_on and going_on[0][0] <= o.start:
+            heapq.heappush(free_columns, heapq.heappop(going_on)[1])
+        if not going_on and group:
+            close_group()
+            group, free_columns, columns = [], [], 0
+        if free_columns:
+            column = heapq.heappop(free_columns)
         else:
-            for k in sorted(last.keys()):
-                if last[k].end <= o.start:
-                    o.level = k
-                    last[k] = o
-                    break
-            if o.level == -1:
-                k = k + 1
-                last[k] = o
-                o.level = k
-    # calculate position and dimensions
-    for o in occs:
-        # number of overlapping occurrences
-        o.max = len([n for n in occs if not(n.end<=o.start or n.start>=o.end)])
-    for o in occs:
-        o.cls = o.data['class']
-        o.real_start = max(o.start, period.start)
-        o.real_end = min(o.end, period.end)
-        # number of "columns" is a minimum number of overlaps for each overlapping group
-        o.max = min([n.max for n in occs if not(n.end<=o.start or n.start>=o.end)] or [1])
-        w = int(width / (o.max))
-        o.width = w - 2
-        o.left = w * o.level
-
-        duration_seconds = _period_duration(period)
-        o.top = int(height * (float((o.real_start - period.start).seconds) / duration_seconds))
-        o.height = int(height * (float((o.real_end - o.real_start).seconds) / duration_seconds))
-        o.height = min(o.height, height - o.top) # trim what extends beyond the area
-    return occs
-
-
-def _cook_slots(period, increment, width, height):
+            column = columns
+            columns += 1
+        heapq.heappush(going_on, (o.end, column))
+        group.append((o, data, column))
+    if group:
+        close_group()
+    return layouts
+
+
+SlotLayout = namedtuple('SlotLayout', ['start', 'end', 'top', 'height', 'busy'])
+
+
+def _cook_slots(period, increment, width, height, layouts=()):
     """
         Prepare slots to be displayed on the left hand side
-        calculate dimensions (in px) for each slot.
+        calculate dimensions (in px) for each slot, and how many of the
+        occurrences laid out by _cook_occurrences overlap it.  The slots
+        are yielded as SlotLayout tuples.
         Arguments:
         period - time period for the whole series
         increment - slot size in minutes
         width - width of the slot column (px)
         height - height of the table (px)
+        layouts - OccurrenceLayouts of the occurrences of the period
     """
     tdiff = datetime.timedelta(minutes=increment)
     num = _period_duration(period)/tdiff.seconds
-    s = period.start
-    slots = []
+    slot_height = int(height / float(num))
+    # add one at the first slot of every occurrence and remove one after
+    # its last slot, the running sum is the number of occurrences per slot
+    changes = [0] * (num + 1)
+    for layout in layouts:
+        first = _microseconds(layout.real_start - period.start) // _microseconds(tdiff)
+        last = -(-_microseconds(layout.real_end - period.start) // _microseconds(tdiff))
+        if first < last:
+            changes[max(first, 0)] += 1
+            changes[min(last, num)] -= 1
+    busy = 0
     for i in range(num):
-        sl = period.get_time_slot(s, s + tdiff)
-        sl.top = int(height / float(num)) * i
-        sl.height = int(height / float(num))
-        slots.append(sl)
-        s = s + tdiff
-    return slots
+        busy += changes[i]
+        s = period.start + tdiff * i
+        yield SlotLayout(s, s + tdiff, slot_height * i, slot_height, busy)
 
 @register.simple_tag
 def hash_occurrence(occ):
@@ -4,4 +4,6 @@ from test_periods import *
 from test_templatetags import *
 from test_views import *
 from test_rule import *
+from test_indexes import *
+from test_recurrence import *
 
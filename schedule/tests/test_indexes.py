@@ -0,0 +1,95 @@
+import datetime
+
+from django.test import TestCase
+
+from schedule.models import Reservation, Rule, Occurrence, Room, OccurrenceIndex
+from schedule.models import indexes
+from schedule.periods import Period
+
+class TestOccurrenceIndex(TestCase):
+
+    def setUp(self):
+        indexes.USE_OCCURRENCE_INDEX = True
+        OccurrenceIndex.objects.rebuild(datetime.datetime(2008, 1, 1),
+                                        datetime.datetime(2009, 1, 1))
+        rule = Rule(frequency = "WEEKLY")
+        rule.save()
+        self.room = Room(name="MyCal", slug="mycal")
+        self.room.save()
+        self.reservation = Reservation(**{
+                'title': 'Recent Reservation',
+                'start': datetime.datetime(2008, 1, 5, 8, 0),
+                'end': datetime.datetime(2008, 1, 5, 9, 0),
+                'end_recurring_period' : datetime.datetime(2008, 5, 5, 0, 0),
+                'rule': rule,
+                'room': self.room
+               })
+        self.reservation.save()
+        self.start = datetime.datetime(2008, 1, 12, 0, 0)
+        self.end = datetime.datetime(2008, 1, 27, 0, 0)
+
+    def tearDown(self):
+        indexes.USE_OCCURRENCE_INDEX = False
+
+    def test_index_refreshed_on_save(self):
+        self.assertEqual(OccurrenceIndex.objects.count(), 18)
+        self.reservation.end_recurring_period = datetime.datetime(2008, 2, 1, 0, 0)
+        self.reservation.save()
+        self.assertEqual(OccurrenceIndex.objects.count(), 4)
+
+    def test_index_cleared_on_delete(self):
+        other = Reservation(title='Other', room=self.room,
+            start=datetime.datetime(2008, 1, 6, 8, 0),
+            end=datetime.datetime(2008, 1, 6, 9, 0))
+        other.save()
+        self.reservation.get_occurrences(self.start, self.end)[0].cancel()
+        self.assertEqual(OccurrenceIndex.objects.count(), 19)
+        other.delete()
+        self.assertEqual(OccurrenceIndex.objects.count(), 18)
+        self.reservation.rule.delete()
+        self.assertEqual(OccurrenceIndex.objects.count(), 0)
+
+    def test_occurrence_refresh_is_incremental(self):
+        before = set(OccurrenceIndex.objects.values_list('pk', flat=True))
+        occurrence = self.reservation.get_occurrences(self.start, self.end)[0]
+        occurrence.cancel()
+        # only the row of the occurrence is replaced
+        after = set(OccurrenceIndex.objects.values_list('pk', flat=True))
+        self.assertEqual(len(before - after), 1)
+        self.assertEqual(len(after - before), 1)
+        row = OccurrenceIndex.objects.get(pk__in=after - before)
+        self.assertEqual((row.occurrence_id, row.cancelled), (occurrence.pk, True))
+        occurrence.delete()
+        row = OccurrenceIndex.objects.get(original_start=occurrence.original_start)
+        self.assertEqual((row.occurrence_id, row.start), (None, occurrence.original_start))
+        self.assertEqual(OccurrenceIndex.objects.count(), 18)
+
+    def test_period_from_index(self):
+        period = Period(Reservation.objects.all(), self.start, self.end)
+        self.assertEqual(["%s to %s" %(o.start, o.end) for o in period.occurrences],
+            ['2008-01-12 08:00:00 to 2008-01-12 09:00:00',
+             '2008-01-19 08:00:00 to 2008-01-19 09:00:00',
+             '2008-01-26 08:00:00 to 2008-01-26 09:00:00'])
+
+    def test_persisted_occurrences(self):
+        occurrences = self.reservation.get_occurrences(self.start, self.end)
+        occurrences[0].move(occurrences[0].start - datetime.timedelta(days=2),
+                            occurrences[0].end - datetime.timedelta(days=2))
+        occurrences[1].cancel()
+        period = Period(Reservation.objects.all(), self.start, self.end)
+        self.assertEqual([(o.pk is not None, o.cancelled) for o in period.occurrences],
+            [(True, True), (False, False)])
+        occurrences[1].delete()
+        period = Period(Reservation.objects.all(), self.start, self.end)
+        self.assertEqual([(o.pk is not None, o.cancelled) for o in period.occurrences],
+            [(False, False), (False, False)])
+
+    def test_occurrences_after(self):
+        occurrences = self.room.occurrences_after(datetime.datetime(2008, 4, 20))
+        self.assertEqual([o.start for o in occurrences],
+            [datetime.datetime(2008, 4, 26, 8, 0), datetime.datetime(2008, 5, 3, 8, 0)])
+
+    def test_uncovered_window(self):
+        period = Period(Reservation.objects.all(), datetime.datetime(2008, 12, 1),
+            datetime.datetime(2009, 2, 1))
+        self.assertEqual(period.occurrences, [])
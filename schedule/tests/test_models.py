@@ -1,12 +1,14 @@
 import datetime
 import os
 
+from django.core.cache import cache
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 
-from schedule.models import Reservation, Rule, Occurrence, Room
+from schedule.models import Reservation, Rule, Occurrence, VirtualOccurrence, Room
 from schedule.periods import Period, Month, Day
-from schedule.utils import ReservationListManager
+from schedule.models import rooms
+from schedule.utils import ReservationListManager, is_slot_free
 
 class TestReservation(TestCase):
     def setUp(self):
@@ -47,6 +49,19 @@ class TestReservation(TestCase):
         occurrence2 = recurring_reservation.occurrences_after(datetime.datetime(2008,1,5)).next()
         self.assertEqual(occurrence, occurrence2)
 
+    def test_occurrences_after_ends(self):
+        recurring_reservation = Reservation(**self.recurring_data)
+        recurring_reservation.save()
+        occurrences = recurring_reservation.occurrences_after(datetime.datetime(2008, 4, 20))
+        self.assertEqual([o.start for o in occurrences],
+            [datetime.datetime(2008, 4, 26, 8, 0), datetime.datetime(2008, 5, 3, 8, 0)])
+        # without end, an occurrence still going on is the next one
+        recurring_reservation.end_recurring_period = None
+        recurring_reservation.save()
+        occurrences = recurring_reservation.occurrences_after(datetime.datetime(2030, 1, 5, 8, 30))
+        self.assertEqual([occurrences.next().start for i in range(2)],
+            [datetime.datetime(2030, 1, 5, 8, 0), datetime.datetime(2030, 1, 12, 8, 0)])
+
     def test_get_occurrence(self):
         reservation = Reservation(**self.recurring_data)
         reservation.save()
@@ -149,3 +164,365 @@ class TestOccurrence(TestCase):
                                     end=self.end)
         self.assertEquals(len(occurrences_later), len(occurrences))
 
+    def test_virtual_occurrences(self):
+        occurrences = self.recurring_reservation.get_occurrences(start=self.start,
+                                    end=self.end)
+        occurrence = occurrences[0]
+        self.assertTrue(isinstance(occurrence, VirtualOccurrence))
+        self.assertEqual(occurrence.pk, None)
+        self.assertEqual(occurrence.title, 'Recent Reservation')
+        self.assertFalse(occurrence.moved)
+        self.assertFalse(occurrence.cancelled)
+        self.assertEqual(occurrence.get_absolute_url(),
+            reverse('occurrence_by_date', kwargs={
+                'reservation_id': self.recurring_reservation.id,
+                'year': 2008, 'month': 1, 'day': 12,
+                'hour': 8, 'minute': 0, 'second': 0}))
+        self.assertRaises(AttributeError, setattr, occurrence, 'level', 0)
+
+    def test_virtual_occurrence_promotion(self):
+        occurrences = self.recurring_reservation.get_occurrences(start=self.start,
+                                    end=self.end)
+        occurrence = occurrences[0]
+        occurrence.title = 'Moved'
+        occurrence.move(occurrence.start + datetime.timedelta(hours=1),
+                        occurrence.end + datetime.timedelta(hours=1))
+        self.assertTrue(occurrence.pk)
+        persisted = Occurrence.objects.get(pk=occurrence.pk)
+        self.assertEqual(persisted.title, 'Moved')
+        self.assertEqual(persisted.original_start, datetime.datetime(2008, 1, 12, 8, 0))
+        self.assertEqual(persisted.start, datetime.datetime(2008, 1, 12, 9, 0))
+        self.assertEqual(occurrence, persisted)
+        occurrence.cancel()
+        self.assertEqual(Occurrence.objects.count(), 1)
+        self.assertTrue(Occurrence.objects.get(pk=occurrence.pk).cancelled)
+        self.assertEqual(occurrence.get_absolute_url(),
+            reverse('occurrence', kwargs={'occurrence_id': occurrence.pk,
+                'reservation_id': self.recurring_reservation.id}))
+
+    def test_occurrences_in_window(self):
+        occurrences = self.recurring_reservation.get_occurrences(
+            datetime.datetime(2008, 1, 1), datetime.datetime(2008, 5, 1))
+        # one occurrence kept in january, one moved from april into the window
+        # and one left in april
+        occurrences[1].save()
+        occurrences[-1].move(occurrences[-1].start - datetime.timedelta(days=98),
+                             occurrences[-1].end - datetime.timedelta(days=98))
+        occurrences[-2].cancel()
+        in_window = Occurrence.objects.in_window([self.recurring_reservation.pk],
+                                                 self.start, self.end)
+        self.assertEqual(sorted([o.original_start for o in in_window]),
+            [datetime.datetime(2008, 1, 12, 8, 0), datetime.datetime(2008, 4, 26, 8, 0)])
+
+
+
+class TestReservationManager(TestCase):
+    def setUp(self):
+        weekly = Rule(frequency = "WEEKLY")
+        weekly.save()
+        daily = Rule(frequency = "DAILY")
+        daily.save()
+        cal = Room(name="MyCal")
+        cal.save()
+        self.weekly_reservation = Reservation(**{
+                'title': 'Weekly Reservation',
+                'start': datetime.datetime(2008, 1, 5, 8, 0),
+                'end': datetime.datetime(2008, 1, 5, 9, 0),
+                'end_recurring_period' : datetime.datetime(2008, 5, 5, 0, 0),
+                'rule': weekly,
+                'room': cal
+               })
+        self.weekly_reservation.save()
+        self.daily_reservation = Reservation(**{
+                'title': 'Daily Reservation',
+                'start': datetime.datetime(2008, 1, 10, 10, 0),
+                'end': datetime.datetime(2008, 1, 10, 11, 0),
+                'end_recurring_period' : datetime.datetime(2008, 1, 14, 0, 0),
+                'rule': daily,
+                'room': cal
+               })
+        self.daily_reservation.save()
+        self.start = datetime.datetime(2008, 1, 9, 0, 0)
+        self.end = datetime.datetime(2008, 1, 20, 0, 0)
+
+    def test_get_occurrences_for(self):
+        reservations = [self.weekly_reservation, self.daily_reservation]
+        occurrences = Reservation.objects.get_occurrences_for(reservations,
+            self.start, self.end)
+        expected = []
+        for reservation in reservations:
+            expected += reservation.get_occurrences(self.start, self.end)
+        self.assertEqual(occurrences, sorted(expected))
+        self.assertEqual(["%s %s" % (o.start, o.reservation.title) for o in occurrences],
+            ['2008-01-10 10:00:00 Daily Reservation',
+             '2008-01-11 10:00:00 Daily Reservation',
+             '2008-01-12 08:00:00 Weekly Reservation',
+             '2008-01-12 10:00:00 Daily Reservation',
+             '2008-01-13 10:00:00 Daily Reservation',
+             '2008-01-19 08:00:00 Weekly Reservation'])
+
+    def test_get_occurrences_for_persisted(self):
+        reservations = [self.weekly_reservation, self.daily_reservation]
+        occurrences = Reservation.objects.get_occurrences_for(reservations,
+            self.start, self.end)
+        occurrences[0].cancel()
+        occurrences[2].move(datetime.datetime(2008, 1, 9, 8, 0),
+                            datetime.datetime(2008, 1, 9, 9, 0))
+        occurrences = Reservation.objects.get_occurrences_for(reservations,
+            self.start, self.end)
+        self.assertTrue(occurrences[0].moved)
+        self.assertTrue(occurrences[1].cancelled)
+        self.assertEqual(len(occurrences), 6)
+
+    def test_get_occurrences_for_single_query(self):
+        reservations = [self.weekly_reservation, self.daily_reservation]
+        self.assertNumQueries(1, Reservation.objects.get_occurrences_for,
+            reservations, self.start, self.end)
+
+
+class TestFindConflicts(TestCase):
+    def setUp(self):
+        self.weekly = Rule(frequency = "WEEKLY")
+        self.weekly.save()
+        self.daily = Rule(frequency = "DAILY")
+        self.daily.save()
+        self.room = Room(name="Room", slug="room")
+        self.room.save()
+        self.other_room = Room(name="Other Room", slug="other-room")
+        self.other_room.save()
+        # every monday from 9 to 10
+        self.weekly_reservation = Reservation(title='Weekly Meeting',
+            start=datetime.datetime(2008, 1, 7, 9, 0),
+            end=datetime.datetime(2008, 1, 7, 10, 0),
+            end_recurring_period=datetime.datetime(2008, 6, 1),
+            rule=self.weekly, room=self.room)
+        self.weekly_reservation.save()
+        self.single_reservation = Reservation(title='Workshop',
+            start=datetime.datetime(2008, 1, 9, 14, 0),
+            end=datetime.datetime(2008, 1, 9, 17, 0),
+            room=self.room)
+        self.single_reservation.save()
+        Reservation(title='Elsewhere', room=self.other_room,
+            start=datetime.datetime(2008, 1, 8, 9, 0),
+            end=datetime.datetime(2008, 1, 8, 12, 0)).save()
+
+    def find_conflicts(self, start, end, **kwargs):
+        return [(reservation.title, o_start) for reservation, o_start, o_end in
+            Reservation.objects.find_conflicts(self.room, start, end, **kwargs)]
+
+    def test_single_reservation(self):
+        self.assertEqual(self.find_conflicts(datetime.datetime(2008, 1, 14, 9, 30),
+            datetime.datetime(2008, 1, 14, 11, 0)),
+            [('Weekly Meeting', datetime.datetime(2008, 1, 14, 9, 0))])
+        self.assertEqual(self.find_conflicts(datetime.datetime(2008, 1, 9, 8, 0),
+            datetime.datetime(2008, 1, 9, 18, 0)),
+            [('Workshop', datetime.datetime(2008, 1, 9, 14, 0))])
+        # touching is not overlapping
+        self.assertEqual(self.find_conflicts(datetime.datetime(2008, 1, 14, 10, 0),
+            datetime.datetime(2008, 1, 14, 11, 0)), [])
+        self.assertEqual(self.find_conflicts(datetime.datetime(2008, 1, 8, 9, 0),
+            datetime.datetime(2008, 1, 8, 12, 0)), [])
+
+    def test_recurring_reservation(self):
+        # every day from 16 to 17 for a week
+        conflicts = self.find_conflicts(datetime.datetime(2008, 1, 3, 16, 0),
+            datetime.datetime(2008, 1, 3, 17, 0), rule=self.daily,
+            end_recurring_period=datetime.datetime(2008, 1, 10))
+        self.assertEqual(conflicts, [('Workshop', datetime.datetime(2008, 1, 9, 14, 0))])
+        # every day from 9:30 to 9:45, without end
+        conflicts = self.find_conflicts(datetime.datetime(2008, 1, 10, 9, 30),
+            datetime.datetime(2008, 1, 10, 9, 45), rule=self.daily)
+        self.assertEqual(len(conflicts), 20)
+        self.assertEqual(conflicts[0], ('Weekly Meeting', datetime.datetime(2008, 1, 14, 9, 0)))
+
+    def test_exclude_and_cancelled(self):
+        start = datetime.datetime(2008, 1, 21, 9, 0)
+        end = datetime.datetime(2008, 1, 21, 10, 0)
+        self.assertEqual(self.find_conflicts(start, end,
+            exclude=self.weekly_reservation.pk), [])
+        self.weekly_reservation.get_occurrences(start, end)[0].cancel()
+        self.assertEqual(self.find_conflicts(start, end), [])
+        # moving an occurrence onto the slot makes it conflict again
+        occurrence = self.weekly_reservation.get_occurrences(
+            start + datetime.timedelta(days=7), end + datetime.timedelta(days=7))[0]
+        occurrence.move(start, end)
+        self.assertEqual(self.find_conflicts(start, end),
+            [('Weekly Meeting', start)])
+
+    def test_occurrence_moved_from_later(self):
+        later = Reservation(title='Later Meeting',
+            start=datetime.datetime(2008, 2, 4, 9, 0),
+            end=datetime.datetime(2008, 2, 4, 10, 0),
+            rule=self.weekly, room=self.room)
+        later.save()
+        later.get_occurrence(later.start).move(datetime.datetime(2008, 1, 10, 9, 0),
+            datetime.datetime(2008, 1, 10, 10, 0))
+        self.assertEqual(self.find_conflicts(datetime.datetime(2008, 1, 10, 9, 0),
+            datetime.datetime(2008, 1, 10, 10, 0)),
+            [('Later Meeting', datetime.datetime(2008, 1, 10, 9, 0))])
+
+    def test_disjoint_rules(self):
+        # every other monday from 9 to 10 never meets the weekly meeting on
+        # tuesdays, which is not expanded
+        every_other_week = Rule(frequency="WEEKLY", params="interval:2")
+        every_other_week.save()
+        start = datetime.datetime(2008, 1, 8, 9, 0)
+        end = datetime.datetime(2008, 1, 8, 10, 0)
+        self.assertEqual(self.find_conflicts(start, end, rule=every_other_week), [])
+        self.assertEqual(self.find_conflicts(start, end, rule=self.daily)[0],
+            ('Weekly Meeting', datetime.datetime(2008, 1, 14, 9, 0)))
+        # but its occurrences moved onto the proposed ones still conflict
+        occurrence = self.weekly_reservation.get_occurrences(
+            datetime.datetime(2008, 2, 4, 9, 0), datetime.datetime(2008, 2, 4, 10, 0))[0]
+        occurrence.move(datetime.datetime(2008, 2, 5, 9, 30), datetime.datetime(2008, 2, 5, 10, 30))
+        self.assertEqual(self.find_conflicts(start, end, rule=every_other_week),
+            [('Weekly Meeting', datetime.datetime(2008, 2, 5, 9, 30))])
+
+    def test_lock(self):
+        start = datetime.datetime(2008, 1, 14, 12, 0)
+        end = datetime.datetime(2008, 1, 14, 13, 0)
+        self.assertEqual(self.find_conflicts(start, end, lock=True), [])
+        self.assertEqual(Room.objects.get(pk=self.room.pk).slug, 'room')
+
+
+class TestRoomAvailability(TestCase):
+    def setUp(self):
+        daily = Rule(frequency = "DAILY")
+        daily.save()
+        self.room = Room(name="Room", slug="room")
+        self.room.save()
+        self.other_room = Room(name="Other Room", slug="other-room")
+        self.other_room.save()
+        self.reservation = Reservation(title='Daily Reservation',
+            start=datetime.datetime(2008, 1, 1, 9, 0),
+            end=datetime.datetime(2008, 1, 1, 10, 15),
+            rule=daily, room=self.room)
+        self.reservation.save()
+        Reservation(title='Meeting', room=self.other_room,
+            start=datetime.datetime(2008, 1, 2, 8, 0),
+            end=datetime.datetime(2008, 1, 2, 12, 0)).save()
+        self.start = datetime.datetime(2008, 1, 2, 8, 0)
+        self.end = datetime.datetime(2008, 1, 2, 12, 0)
+
+    def free_slots(self, bitmap, slots=8):
+        return [index for index in range(slots) if is_slot_free(bitmap, index)]
+
+    def test_availability(self):
+        bitmap = self.room.availability(self.start, self.end)
+        self.assertEqual(len(bitmap), 1)
+        self.assertEqual(self.free_slots(bitmap), [0, 1, 5, 6, 7])
+        bitmap = self.room.availability(self.start, self.end,
+            datetime.timedelta(minutes=15))
+        self.assertEqual(self.free_slots(bitmap, 16),
+            [0, 1, 2, 3, 9, 10, 11, 12, 13, 14, 15])
+
+    def test_cancelled_occurrences_are_free(self):
+        occurrence = self.reservation.get_occurrences(self.start, self.end)[0]
+        occurrence.cancel()
+        self.assertEqual(self.free_slots(self.room.availability(self.start, self.end)),
+            range(8))
+
+    def test_bulk_availability(self):
+        room_list = [self.room, self.other_room]
+        # the reservations with their rules and the persisted occurrences
+        self.assertNumQueries(2, Room.objects.availability,
+            room_list, self.start, self.end)
+        bitmaps = Room.objects.availability(room_list, self.start, self.end)
+        self.assertEqual(self.free_slots(bitmaps[self.room.pk]), [0, 1, 5, 6, 7])
+        self.assertEqual(self.free_slots(bitmaps[self.other_room.pk]), [])
+
+    def test_cached_availability(self):
+        old_timeout = rooms.AVAILABILITY_CACHE_TIMEOUT
+        rooms.AVAILABILITY_CACHE_TIMEOUT = 60
+        try:
+            cache.clear()
+            bitmap = self.room.availability(self.start, self.end)
+            self.assertNumQueries(0, self.room.availability, self.start, self.end)
+            self.assertEqual(self.room.availability(self.start, self.end), bitmap)
+        finally:
+            rooms.AVAILABILITY_CACHE_TIMEOUT = old_timeout
+
+    def test_find_free_slots(self):
+        window = (datetime.datetime(2008, 1, 2, 6, 0), datetime.datetime(2008, 1, 2, 13, 0))
+        slots = Room.objects.find_free_slots([self.room, self.other_room],
+            datetime.timedelta(hours=1), window, limit=5)
+        self.assertEqual([(room.slug, start.hour, end.hour) for room, start, end in slots],
+            [('room', 6, 7), ('other-room', 6, 7), ('room', 7, 8), ('other-room', 7, 8),
+             ('room', 8, 9)])
+        slots = Room.objects.find_free_slots([self.room, self.other_room],
+            datetime.timedelta(hours=1), window, limit=10)
+        self.assertEqual([(room.slug, start.strftime('%H:%M')) for room, start, end in slots],
+            [('room', '06:00'), ('other-room', '06:00'), ('room', '07:00'),
+             ('other-room', '07:00'), ('room', '08:00'), ('room', '10:15'), ('room', '11:15'),
+             ('other-room', '12:00')])
+
+    def test_find_free_slots_window(self):
+        later = Reservation(title='Later', room=self.room,
+            start=datetime.datetime(2008, 1, 5, 11, 15),
+            end=datetime.datetime(2008, 1, 5, 12, 15))
+        later.save()
+        later.get_occurrence(later.start).move(datetime.datetime(2008, 1, 2, 11, 15),
+            datetime.datetime(2008, 1, 2, 12, 15))
+        Reservation(title='Much Later', room=self.other_room,
+            start=datetime.datetime(2009, 1, 1, 8, 0),
+            end=datetime.datetime(2009, 1, 1, 9, 0)).save()
+        Reservation(title='Earlier', room=self.other_room,
+            start=datetime.datetime(2007, 1, 1, 8, 0),
+            end=datetime.datetime(2007, 1, 1, 9, 0)).save()
+        room_list = [self.room, self.other_room]
+        window = (datetime.datetime(2008, 1, 2, 6, 0), datetime.datetime(2008, 1, 2, 13, 0))
+        self.assertEqual(sorted([r.title for r in Room.objects._get_reservations(
+            [room.pk for room in room_list], *window)]), ['Daily Reservation', 'Later', 'Meeting'])
+        # the reservations with their rules and the persisted occurrences
+        self.assertNumQueries(2, Room.objects.find_free_slots,
+            room_list, datetime.timedelta(hours=1), window)
+        slots = Room.objects.find_free_slots(room_list, datetime.timedelta(hours=1), window)
+        self.assertEqual([(room.slug, start.strftime('%H:%M')) for room, start, end in slots],
+            [('room', '06:00'), ('other-room', '06:00'), ('room', '07:00'),
+             ('other-room', '07:00'), ('room', '08:00'), ('room', '10:15'),
+             ('other-room', '12:00')])
+
+
+class TestRoomVersion(TestCase):
+    def setUp(self):
+        self.room = Room(name="Room", slug="room")
+        self.room.save()
+        self.other_room = Room(name="Other Room", slug="other-room")
+        self.other_room.save()
+        self.rule = Rule(frequency="DAILY")
+        self.rule.save()
+        self.reservation = Reservation(title='Meeting', room=self.room, rule=self.rule,
+            start=datetime.datetime(2008, 1, 2, 8, 0),
+            end=datetime.datetime(2008, 1, 2, 9, 0))
+        self.reservation.save()
+
+    def version(self, room):
+        return Room.objects.get(pk=room.pk).version
+
+    def test_changes_bump_version(self):
+        version = self.version(self.room)
+        self.reservation.get_occurrence(datetime.datetime(2008, 1, 3, 8, 0)).cancel()
+        self.assertTrue(self.version(self.room) > version)
+        version = self.version(self.room)
+        self.rule.save()
+        self.assertTrue(self.version(self.room) > version)
+        version, other_version = self.version(self.room), self.version(self.other_room)
+        self.reservation.room = self.other_room
+        self.reservation.save()
+        self.assertTrue(self.version(self.room) > version)
+        self.assertTrue(self.version(self.other_room) > other_version)
+        other_version = self.version(self.other_room)
+        self.reservation.delete()
+        self.assertTrue(self.version(self.other_room) > other_version)
+        self.assertTrue(Room.objects.get(pk=self.room.pk).last_modified is not None)
+
+    def test_stale_room_does_not_go_back(self):
+        version = self.version(self.room)
+        Room.objects.touch([self.room.pk])
+        Room.objects.touch([self.room.pk])
+        # self.room still has the version it was saved with
+        self.room.name = "Renamed"
+        self.room.save()
+        self.assertEqual(self.version(self.room), version + 3)
+        self.assertEqual(self.room.version, version + 3)
+
@@ -1,5 +1,6 @@
 import datetime
 import os
+from random import Random
 
 from django.test import TestCase
 from django.conf import settings
@@ -7,7 +8,7 @@ from django.core.urlresolvers import reverse
 
 from schedule.conf.settings import FIRST_DAY_OF_WEEK
 from schedule.models import Reservation, Rule, Occurrence, Room
-from schedule.periods import Period, Month, Day, Year
+from schedule.periods import Period, Month, Day, Year, OccurrenceCache, OccurrencePool
 from schedule.utils import ReservationListManager
 
 class TestPeriod(TestCase):
@@ -38,6 +39,40 @@ class TestPeriod(TestCase):
              '2008-01-12 08:00:00 to 2008-01-12 09:00:00',
              '2008-01-19 08:00:00 to 2008-01-19 09:00:00'])
 
+    def test_occurrence_tuples(self):
+        reservation = Reservation.objects.get()
+        reservation.get_occurrence(datetime.datetime(2008, 1, 12, 8, 0)).cancel()
+        occurrence = reservation.get_occurrence(datetime.datetime(2008, 1, 19, 8, 0))
+        occurrence.title = 'Renamed'
+        occurrence.save()
+        reservation.get_occurrence(datetime.datetime(2008, 2, 2, 8, 0)).move(
+            datetime.datetime(2008, 1, 10, 8, 0), datetime.datetime(2008, 1, 10, 10, 0))
+        period = Period(reservations=Reservation.objects.all(),
+            start=self.period.start, end=self.period.end)
+        self.assertEqual(period.occurrence_tuples(),
+            [(o.reservation_id, o.title, o.start, o.end, o.cancelled) for o in period.occurrences])
+        self.assertEqual([(title, start.day, cancelled) for reservation_id, title, start, end, cancelled
+            in period.occurrence_tuples()],
+            [('Recent Reservation', 5, False), ('Recent Reservation', 10, False),
+             ('Recent Reservation', 12, True), ('Renamed', 19, False)])
+        self.assertEqual(reservation.room.occurrence_rows(self.period.start, self.period.end),
+            period.occurrence_tuples())
+
+    def test_occurrence_rows_moved_from_later(self):
+        later = Reservation(title='Later', room=Room.objects.get(),
+            start=datetime.datetime(2008, 2, 4, 9, 0),
+            end=datetime.datetime(2008, 2, 4, 10, 0), rule=Rule.objects.get())
+        later.save()
+        later.get_occurrence(later.start).move(datetime.datetime(2008, 1, 10, 9, 0),
+            datetime.datetime(2008, 1, 10, 10, 0))
+        start, end = datetime.datetime(2008, 1, 7), datetime.datetime(2008, 1, 14)
+        period = Period(reservations=Reservation.objects.all(), start=start, end=end)
+        rows = later.room.occurrence_rows(start, end)
+        self.assertEqual(rows, period.occurrence_tuples())
+        self.assertEqual([(title, o_start) for reservation_id, title, o_start, o_end, cancelled in rows],
+            [('Later', datetime.datetime(2008, 1, 10, 9, 0)),
+             ('Recent Reservation', datetime.datetime(2008, 1, 12, 8, 0))])
+
     def test_get_occurrence_partials(self):
         occurrence_dicts = self.period.get_occurrence_partials()
         self.assertEqual(
@@ -75,6 +110,55 @@ class TestYear(TestCase):
             [datetime.datetime(2008, i, 1) for i in range(1,13)])
 
 
+class TestBusyDays(TestCase):
+
+    def setUp(self):
+        rule = Rule(frequency = "WEEKLY")
+        rule.save()
+        cal = Room(name="MyCal")
+        cal.save()
+        self.recurring_reservation = Reservation(title='Recent Reservation',
+            start=datetime.datetime(2008, 1, 5, 8, 0),
+            end=datetime.datetime(2008, 1, 5, 9, 0),
+            end_recurring_period=datetime.datetime(2008, 5, 5, 0, 0),
+            rule=rule, room=cal)
+        self.recurring_reservation.save()
+        Reservation(title='Long Reservation', room=cal,
+            start=datetime.datetime(2008, 12, 30, 22, 0),
+            end=datetime.datetime(2009, 1, 2, 0, 0)).save()
+        occurrences = self.recurring_reservation.get_occurrences(
+            datetime.datetime(2008, 2, 1), datetime.datetime(2008, 3, 1))
+        occurrences[0].cancel()
+        occurrences[1].move(occurrences[1].start + datetime.timedelta(days=1),
+                            occurrences[1].end + datetime.timedelta(days=1))
+
+    def test_busy_days(self):
+        year = Year(Reservation.objects.all(), datetime.datetime(2008, 1, 1))
+        busy_days = year.get_busy_days()
+        self.assertEqual(len(busy_days), 366)
+        expected = [day.has_occurrences() for month in year.get_months()
+            for day in month.get_days()]
+        self.assertEqual([bool(busy) for busy in busy_days], expected)
+        self.assertEqual(busy_days.count('\x01'), 19)
+
+    def test_busy_grid(self):
+        year = Year(Reservation.objects.all(), datetime.datetime(2008, 1, 1))
+        occurrence_cache = year.occurrence_cache
+        def build_grids():
+            return [month.build_grid(busy_only=True) for month in year.get_months()]
+        # the reservations, the rule and the persisted occurrences, once for
+        # the whole year
+        self.assertNumQueries(3, build_grids)
+        grids = build_grids()
+        self.assertEqual(occurrence_cache._windows, [])
+        february = [cell for row in grids[1] for cell in row if cell['in_month']]
+        self.assertEqual([cell['day'].start.day for cell in february if cell['busy']],
+            [10, 16, 23])
+        self.assertEqual([cell['partials'] for cell in february], [None] * 29)
+        self.assertEqual(len(Month(Reservation.objects.all(),
+            datetime.datetime(2009, 1, 1)).get_busy_days()), 31)
+
+
 class TestMonth(TestCase):
 
     def setUp(self):
@@ -174,6 +258,26 @@ class TestMonth(TestCase):
         for actual, expected in zip(actuals, expecteds):
             self.assertEqual(actual, expected)
 
+    def test_build_grid(self):
+        Reservation(title='Long Reservation', room=Room.objects.get(name="MyCal"),
+            start=datetime.datetime(2008, 2, 12, 22, 0),
+            end=datetime.datetime(2008, 2, 15, 0, 0)).save()
+        month = Month(reservations=Reservation.objects.all(),
+                      date=datetime.datetime(2008, 2, 7, 9, 0))
+        grid = month.build_grid()
+        weeks = list(month.get_weeks())
+        self.assertEqual(len(grid), len(weeks))
+        for week, row in zip(weeks, grid):
+            for day, cell in zip(week.get_days(), row):
+                self.assertEqual(cell['day'].start, day.start)
+                self.assertEqual(cell['in_month'], day.start.month == 2)
+                if cell['in_month']:
+                    self.assertEqual(cell['partials'], day.get_occurrence_partials())
+                    self.assertEqual(cell['busy'], day.has_occurrences())
+        self.assertEqual([(cell['day'].start.day, [p['class'] for p in cell['partials']])
+            for row in grid for cell in row if cell['busy']],
+            [(2, [1]), (9, [1]), (12, [0]), (13, [2]), (14, [2]), (16, [1]), (23, [1])])
+
 
     def test_month_convenience_functions(self):
         self.assertEqual( self.month.prev_month().start, datetime.datetime(2008, 1, 1, 0, 0))
@@ -233,3 +337,86 @@ class TestOccurrencePool(TestCase):
         period = Period(parent_period.reservations, start, end, parent_period.get_persisted_occurrences(), parent_period.occurrences)
         self.assertEquals(parent_period.occurrences, period.occurrences)
 
+    def test_overlapping(self):
+        random = Random(1234)
+        base = datetime.datetime(2008, 1, 1)
+        occurrences = []
+        for i in range(200):
+            start = base + datetime.timedelta(hours=random.randint(0, 24 * 30))
+            end = start + datetime.timedelta(hours=random.choice([1, 2, 5, 24 * 10]))
+            occurrences.append(self.recurring_reservation._create_virtual_occurrence(start, end))
+        pool = OccurrencePool(occurrences)
+        for i in range(100):
+            start = base + datetime.timedelta(hours=random.randint(-24, 24 * 31))
+            end = start + datetime.timedelta(hours=random.randint(1, 24 * 3))
+            expected = [o for o in sorted(occurrences, key=lambda o: o.start)
+                if o.start < end and o.end > start]
+            self.assertEqual(pool.overlapping(start, end), expected)
+
+
+
+class TestOccurrenceCache(TestCase):
+
+    def setUp(self):
+        rule = Rule(frequency = "WEEKLY")
+        rule.save()
+        cal = Room(name="MyCal")
+        cal.save()
+        data = {
+                'title': 'Recent Reservation',
+                'start': datetime.datetime(2008, 1, 5, 8, 0),
+                'end': datetime.datetime(2008, 1, 5, 9, 0),
+                'end_recurring_period' : datetime.datetime(2008, 5, 5, 0, 0),
+                'rule': rule,
+                'room': cal
+               }
+        self.recurring_reservation = Reservation(**data)
+        self.recurring_reservation.save()
+
+    def test_sub_periods_share_the_cache(self):
+        year = Year(Reservation.objects.all(), datetime.datetime(2008, 1, 1))
+        occurrence_cache = year.occurrence_cache
+        months = list(year.get_months())
+        # nothing is expanded until the occurrences are looked up
+        self.assertEqual(occurrence_cache.misses, 0)
+        days = []
+        for month in months[1:4]:
+            self.assertTrue(month.occurrence_cache is occurrence_cache)
+            days += list(month.get_days())
+        self.assertEqual(len([day for day in days if day.has_occurrences()]), 13)
+        self.assertEqual(occurrence_cache.misses, 1)
+        self.assertEqual(occurrence_cache.hits, 89)
+
+    def test_single_expansion(self):
+        year = Year(Reservation.objects.all(), datetime.datetime(2008, 1, 1))
+        year.occurrences
+        def count_days():
+            return len([day for month in year.get_months()
+                for day in month.get_days() if day.has_occurrences()])
+        # the reservations and the occurrences of the year are fetched once,
+        # the months and days are then served from the cache
+        self.assertNumQueries(0, count_days)
+        self.assertEqual(count_days(), 18)
+
+    def test_navigation_shares_the_cache(self):
+        month = Month(Reservation.objects.all(), datetime.datetime(2008, 2, 1))
+        month.occurrences
+        year = month.current_year()
+        self.assertTrue(year.occurrence_cache is month.occurrence_cache)
+        self.assertEqual(len(year.occurrences), 18)
+        prev_month = year.get_months().next().next()
+        self.assertEqual(len(prev_month.occurrences), 4)
+        self.assertEqual(month.occurrence_cache.misses, 2)
+
+    def test_persisted_occurrences(self):
+        occurrence_cache = OccurrenceCache(Reservation.objects.all())
+        self.recurring_reservation.get_occurrences(datetime.datetime(2008, 1, 1),
+            datetime.datetime(2008, 1, 10))[0].cancel()
+        month = Month(Reservation.objects.all(), datetime.datetime(2008, 1, 1),
+            occurrence_cache=occurrence_cache)
+        # nothing is fetched until the occurrences are looked at
+        self.assertNumQueries(0, month.get_persisted_occurrences)
+        self.assertEqual(len(month.get_persisted_occurrences()), 1)
+        self.assertEqual(len(month.get_day(12).get_persisted_occurrences()), 1)
+        self.assertEqual(occurrence_cache.misses, 1)
+        self.assertEqual(occurrence_cache.hits, 1)
@@ -0,0 +1,141 @@
+import datetime
+import itertools
+import random
+
+from django.test import TestCase
+from dateutil import rrule
+
+from schedule.models import Reservation, Rule
+from schedule.recurrence import SimpleRecurrence, get_simple_recurrence, simple_recurrences_overlap
+
+# how far apart the compared windows may be, in seconds
+SPANS = {
+    "WEEKLY": 200 * 24 * 60 * 60,
+    "DAILY": 60 * 24 * 60 * 60,
+    "HOURLY": 5 * 24 * 60 * 60,
+    "MINUTELY": 6 * 60 * 60,
+    "SECONDLY": 30 * 60,
+}
+
+class TestSimpleRecurrence(TestCase):
+    """
+    Checks that the arithmetic expansion gives exactly the same results as
+    dateutil for the rules it accepts.
+    """
+
+    def _random_datetime(self, generator):
+        return datetime.datetime(2008, 1, 1) + datetime.timedelta(
+            seconds=generator.randint(0, 3 * 365 * 24 * 60 * 60),
+            microseconds=generator.choice([0, generator.randint(0, 999999)]))
+
+    def test_differential(self):
+        generator = random.Random(1234)
+        for i in range(200):
+            frequency = generator.choice(["WEEKLY", "DAILY", "HOURLY", "MINUTELY", "SECONDLY"])
+            params = {}
+            if generator.random() < 0.5:
+                params['interval'] = generator.randint(1, 5)
+            if generator.random() < 0.3:
+                params['count'] = generator.randint(1, 30)
+            dtstart = self._random_datetime(generator)
+            expected = rrule.rrule(rrule.__dict__[frequency], dtstart=dtstart, **params)
+            actual = get_simple_recurrence(frequency, params, dtstart)
+            self.assertTrue(actual is not None)
+            span = SPANS[frequency]
+            for j in range(5):
+                after = dtstart + datetime.timedelta(
+                    seconds=generator.randint(-span // 4, span))
+                if j == 0:
+                    after = dtstart
+                before = after + datetime.timedelta(seconds=generator.randint(0, span))
+                for inc in (False, True):
+                    self.assertEqual(actual.between(after, before, inc=inc),
+                        expected.between(after, before, inc=inc),
+                        (frequency, params, dtstart, after, before, inc))
+                    self.assertEqual(actual.after(after, inc=inc),
+                        expected.after(after, inc=inc),
+                        (frequency, params, dtstart, after, inc))
+            self.assertEqual(list(itertools.islice(actual, 50)), list(expected[:50]))
+
+    def test_complex_rules_fall_back(self):
+        dtstart = datetime.datetime(2008, 1, 1)
+        self.assertTrue(get_simple_recurrence("MONTHLY", {}, dtstart) is None)
+        self.assertTrue(get_simple_recurrence("YEARLY", {}, dtstart) is None)
+        self.assertTrue(get_simple_recurrence("WEEKLY", {'byweekday': rrule.MO}, dtstart) is None)
+        self.assertTrue(get_simple_recurrence("DAILY", {'byhour': 8}, dtstart) is None)
+
+    def test_reservation_uses_fast_path(self):
+        rule = Rule(frequency="DAILY", params="interval:3")
+        reservation = Reservation(title='Every three days', rule=rule,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0))
+        self.assertTrue(isinstance(reservation._get_recurrence(), SimpleRecurrence))
+        occurrences = reservation.get_occurrences(datetime.datetime(2008, 1, 4, 8, 30),
+            datetime.datetime(2008, 1, 11))
+        self.assertEqual([o.start.day for o in occurrences], [4, 7, 10])
+        self.assertEqual(reservation.get_occurrence(datetime.datetime(2008, 1, 7, 8, 0)).start,
+            datetime.datetime(2008, 1, 7, 8, 0))
+        self.assertTrue(reservation.get_occurrence(datetime.datetime(2008, 1, 8, 8, 0)) is None)
+
+
+class TestSimpleRecurrencesOverlap(TestCase):
+    """
+    Checks the arithmetic overlap test against the comparison of every pair
+    of occurrences.
+    """
+
+    def _random_recurrence(self, generator, dtstart):
+        frequency = generator.choice(["DAILY", "HOURLY"])
+        params = {'interval': generator.randint(1, 6)}
+        if generator.random() < 0.3:
+            params['count'] = generator.randint(1, 40)
+        dtstart += datetime.timedelta(minutes=generator.randint(0, 3 * 24 * 60))
+        duration = datetime.timedelta(minutes=generator.randint(1, 6 * 60))
+        until = None
+        if generator.random() < 0.5:
+            until = dtstart + datetime.timedelta(minutes=generator.randint(0, 30 * 24 * 60))
+        return get_simple_recurrence(frequency, params, dtstart), duration, until
+
+    def _brute_force(self, first, first_duration, first_until,
+        second, second_duration, second_until, end):
+        def spans(recurrence, duration, until):
+            stop = end if until is None else min(until, end)
+            return [(start, start + duration) for start in recurrence.between(
+                recurrence.dtstart, stop, inc=True) if start < stop]
+        for first_start, first_end in spans(first, first_duration, first_until):
+            for second_start, second_end in spans(second, second_duration, second_until):
+                if first_start < second_end and second_start < first_end:
+                    return True
+        return False
+
+    def test_differential(self):
+        generator = random.Random(4321)
+        dtstart = datetime.datetime(2008, 1, 1)
+        # both patterns repeat every lcm of their steps, at most 30 days
+        end = dtstart + datetime.timedelta(days=100)
+        results = set()
+        for i in range(300):
+            first = self._random_recurrence(generator, dtstart)
+            second = self._random_recurrence(generator, dtstart)
+            expected = self._brute_force(*(first + second + (end,)))
+            self.assertEqual(simple_recurrences_overlap(*(first + second)), expected,
+                (first, second))
+            results.add(expected)
+        self.assertEqual(results, set([True, False]))
+
+    def test_alternating_weeks(self):
+        every_other_week = get_simple_recurrence("WEEKLY", {'interval': 2},
+            datetime.datetime(2008, 1, 7, 9, 0))
+        other_weeks = get_simple_recurrence("WEEKLY", {'interval': 2},
+            datetime.datetime(2008, 1, 14, 9, 0))
+        hour = datetime.timedelta(hours=1)
+        self.assertFalse(simple_recurrences_overlap(every_other_week, hour, None,
+            other_weeks, hour, None))
+        self.assertFalse(simple_recurrences_overlap(every_other_week, 7 * 24 * hour, None,
+            other_weeks, hour, None))
+        self.assertTrue(simple_recurrences_overlap(every_other_week, 7 * 24 * hour + hour, None,
+            other_weeks, hour, None))
+        # nothing overlaps once the first one has stopped
+        self.assertFalse(simple_recurrences_overlap(every_other_week, 7 * 24 * hour + hour,
+            datetime.datetime(2008, 1, 7, 9, 0), other_weeks, hour, None))
+
@@ -4,11 +4,16 @@ import datetime
 import os
 
 from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.forms.models import modelform_factory
 from django.core.urlresolvers import reverse
 
+from schedule.forms import RuleForm
 from schedule.models import Reservation, Rule, Occurrence, Room
+from schedule.models.rules import parse_params
 from schedule.periods import Period, Month, Day
 from schedule.utils import ReservationListManager
+from dateutil import rrule
 
 class TestRule(TestCase):
     """
@@ -76,4 +81,106 @@ class TestRule(TestCase):
         recurring_reservation = Reservation(**recurring_data)
         occurrences = recurring_reservation.get_occurrences(start=datetime.datetime(2010, 1, 1, 0, 0),
                                     end=datetime.datetime(2010, 2, 1, 0, 0))
-        return [o.start.day for o in occurrences]
\ No newline at end of file
+        return [o.start.day for o in occurrences]
+
+class TestRuleParams(TestCase):
+
+    def test_parse_weekdays(self):
+        rule = Rule(frequency='MONTHLY', params='byweekday:MO(+1),FR(-1),SU;interval:2')
+        self.assertEqual(rule.get_params(),
+            {'byweekday': [rrule.MO(+1), rrule.FR(-1), rrule.SU], 'interval': 2})
+
+    def test_parse_rejects_expressions(self):
+        for params in ['byweekday:MO.__class__', 'byweekday:MO(1)+1', 'count:1+1',
+                       'byweekday:MO(0)', 'count', 'foo:1', 'count:1:2']:
+            self.assertRaises(ValueError, parse_params, params)
+            rule = Rule(frequency='DAILY', params=params)
+            self.assertRaises(ValidationError, rule.clean)
+
+    def test_legacy_params(self):
+        # rows saved before the params were validated keep their valid part
+        rule = Rule(frequency='DAILY', params='count:3;foo:1;interval:x')
+        self.assertEqual(rule.get_params(), {'count': 3})
+
+    def test_saved_params(self):
+        rule = Rule(name='First Thursday', description='', frequency='MONTHLY',
+                    params='byweekday:TH(1);count:3')
+        rule.save()
+        self.assertTrue(rule.compiled_params)
+        rule = Rule.objects.get(pk=rule.pk)
+        self.assertEqual(rule.get_params(), {'byweekday': rrule.TH(1), 'count': 3})
+        # the compiled params are ignored once the params change
+        rule.params = 'count:2'
+        self.assertEqual(rule.get_params(), {'count': 2})
+
+    def test_invalid_params(self):
+        rule = Rule(name='Broken', description='', frequency='DAILY', params='count:x')
+        self.assertRaises(ValidationError, rule.full_clean)
+        # the admin builds its form this way
+        form = modelform_factory(Rule, form=RuleForm)({'name': 'Broken', 'description': 'Broken',
+            'frequency': 'DAILY', 'params': 'count:x'})
+        self.assertFalse(form.is_valid())
+        self.assertTrue('params' in form.errors)
+        rule.save()
+        self.assertEqual(Rule.objects.get(pk=rule.pk).get_params(), {})
+
+
+class TestRRuleStrings(TestCase):
+
+    def test_round_trip(self):
+        for value in ['RRULE:FREQ=WEEKLY;COUNT=10;BYDAY=MO,WE',
+                      'RRULE:FREQ=MONTHLY;INTERVAL=2;BYDAY=+1TH',
+                      'RRULE:FREQ=YEARLY;BYMONTH=1,7;BYMONTHDAY=-1',
+                      'RRULE:FREQ=DAILY']:
+            rule = Rule.from_rrule_string(value)
+            self.assertEqual(rule.to_rrule_string(), value)
+
+    def test_matches_rrulestr(self):
+        value = 'RRULE:FREQ=MONTHLY;BYDAY=-1FR;COUNT=6'
+        start = datetime.datetime(2010, 1, 1, 8, 0)
+        rule = Rule.from_rrule_string(value)
+        reservation = Reservation(title='Last Friday', start=start,
+            end=start + datetime.timedelta(hours=1), rule=rule)
+        self.assertEqual(list(reservation.get_rrule_object()),
+            list(rrule.rrulestr(value, dtstart=start)))
+
+    def test_invalid_strings(self):
+        for value in ['RRULE:FREQ=WEEKLY;UNTIL=20100101T000000', 'RRULE:FREQ=FORTNIGHTLY',
+                      'RRULE:FREQ=WEEKLY;BYDAY=XX', 'RRULE:COUNT=2']:
+            self.assertRaises(ValueError, Rule.from_rrule_string, value)
+
+    def test_dedupe(self):
+        rule = Rule(name='Mon Wed', description='', frequency='WEEKLY',
+                    params='byweekday:MO,WE; count:10')
+        rule.save()
+        rules = Rule.objects.from_rrule_strings([
+            'RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=10',
+            'RRULE:FREQ=WEEKLY;COUNT=10;BYDAY=MO,WE',
+            'RRULE:FREQ=DAILY;INTERVAL=2',
+            'FREQ=DAILY;INTERVAL=2'])
+        self.assertEqual(rules['RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=10'], (rule, False))
+        self.assertEqual(rules['RRULE:FREQ=WEEKLY;COUNT=10;BYDAY=MO,WE'], (rule, False))
+        daily, created = rules['RRULE:FREQ=DAILY;INTERVAL=2']
+        self.assertTrue(created)
+        self.assertEqual(rules['FREQ=DAILY;INTERVAL=2'], (daily, False))
+        self.assertEqual(Rule.objects.count(), 2)
+        self.assertEqual(Rule.objects.get_or_create_for_rrule_string(
+            'RRULE:FREQ=DAILY;INTERVAL=2'), (daily, False))
+
+    def test_dedupe_reads_compiled_params(self):
+        rule = Rule(name='Mon Wed', description='', frequency='WEEKLY',
+                    params='byweekday:MO,WE; count:10')
+        rule.save()
+        # a rule saved before the params were compiled
+        legacy = Rule(name='Every other day', description='', frequency='DAILY',
+                      params='interval:2')
+        legacy.save()
+        Rule.objects.filter(pk=legacy.pk).update(compiled_params=None)
+        Rule(name='Broken', description='', frequency='WEEKLY', params='count:x').save()
+        # one query for the weekly rules only
+        self.assertNumQueries(1, Rule.objects.from_rrule_strings,
+            ['RRULE:FREQ=WEEKLY;COUNT=10;BYDAY=MO,WE'])
+        self.assertEqual(Rule.objects.get_or_create_for_rrule_string(
+            'RRULE:FREQ=WEEKLY;COUNT=10;BYDAY=MO,WE'), (rule, False))
+        self.assertEqual(Rule.objects.get_or_create_for_rrule_string(
+            'RRULE:FREQ=DAILY;INTERVAL=2'), (Rule.objects.get(pk=legacy.pk), False))
@@ -2,7 +2,9 @@ import datetime
 
 from django.test import TestCase
 
-from schedule.templatetags.scheduletags import querystring_for_date
+from schedule.models import Reservation
+from schedule.periods import Period
+from schedule.templatetags.scheduletags import querystring_for_date, _cook_occurrences, _cook_slots
 
 class TestTemplateTags(TestCase):
     
@@ -10,4 +12,31 @@ class TestTemplateTags(TestCase):
         date = datetime.datetime(2008,1,1,0,0,0)
         query_string=querystring_for_date(date)
         self.assertEqual("?year=2008&amp;month=1&amp;day=1&amp;hour=0&amp;minute=0&amp;second=0",
-            query_string)
\ No newline at end of file
+            query_string)
+
+    def test_cook_occurrences(self):
+        period = Period([], datetime.datetime(2008, 1, 1, 8, 0), datetime.datetime(2008, 1, 1, 20, 0))
+        def occurrence(start, end):
+            return Reservation(title='%s-%s' % (start, end),
+                start=datetime.datetime(2008, 1, 1, start, 0),
+                end=datetime.datetime(2008, 1, 1, end, 0))._create_virtual_occurrence(
+                datetime.datetime(2008, 1, 1, start, 0), datetime.datetime(2008, 1, 1, end, 0))
+        occurrences = [occurrence(14, 15), occurrence(9, 11), occurrence(10, 12),
+            occurrence(11, 13), occurrence(19, 22), occurrence(21, 23)]
+        layouts = _cook_occurrences(period, occurrences, 300, 720)
+        self.assertEqual([(l.occurrence.title, l.column, l.columns, l.left, l.width, l.top, l.height)
+            for l in layouts],
+            [('9-11', 0, 2, 0, 148, 60, 120),
+             ('10-12', 1, 2, 150, 148, 120, 120),
+             # the first column is free again
+             ('11-13', 0, 2, 0, 148, 180, 120),
+             ('14-15', 0, 1, 0, 298, 360, 60),
+             # trimmed to the period
+             ('19-22', 0, 1, 0, 298, 660, 60)])
+        self.assertEqual(layouts[0].cls, 1)
+        self.assertEqual(layouts[-1].cls, 0)
+        slots = list(_cook_slots(period, 60, 100, 720, layouts))
+        self.assertEqual(len(slots), 12)
+        self.assertEqual((slots[1].start, slots[1].end, slots[1].top, slots[1].height),
+            (datetime.datetime(2008, 1, 1, 9, 0), datetime.datetime(2008, 1, 1, 10, 0), 60, 60))
+        self.assertEqual([slot.busy for slot in slots], [0, 1, 2, 2, 1, 0, 1, 0, 0, 0, 0, 1])
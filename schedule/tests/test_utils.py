@@ -6,7 +6,7 @@ from django.core.urlresolvers import reverse
 
 from schedule.models import Reservation, Rule, Occurrence, Room
 from schedule.periods import Period, Month, Day
-from schedule.utils import ReservationListManager
+from schedule.utils import ReservationListManager, RRuleCache, rrule_cache
 
 class TestReservationListManager(TestCase):
     def setUp(self):
@@ -48,3 +48,77 @@ class TestReservationListManager(TestCase):
         self.assertEqual(occurrences.next().reservation, self.reservation2)
         self.assertEqual(occurrences.next().reservation, self.reservation2)
         self.assertEqual(occurrences.next().reservation, self.reservation1)
+
+    def test_occurrences_after_moved_limit_until(self):
+        for reservation in (self.reservation1, self.reservation2):
+            reservation.description = reservation.title
+            reservation.save()
+        occurrence = self.reservation1.get_occurrence(datetime.datetime(2009, 4, 15, 8, 0))
+        occurrence.move(datetime.datetime(2009, 4, 2, 7, 0), datetime.datetime(2009, 4, 2, 8, 0))
+        for day in range(3, 8):
+            self.reservation2.get_occurrence(datetime.datetime(2009, 4, day, 9, 0)).save()
+        eml = ReservationListManager([self.reservation1, self.reservation2])
+        after = datetime.datetime(2009, 4, 1, 0, 0)
+        # the moved occurrence comes where it takes place now
+        self.assertEqual([(o.reservation, o.start.day, o.start.hour) for o in
+            eml.occurrences_after(after, limit=5, chunk_size=2)],
+            [(self.reservation1, 1, 8), (self.reservation2, 1, 9), (self.reservation1, 2, 7),
+             (self.reservation2, 2, 9), (self.reservation2, 3, 9)])
+        self.assertEqual(len(list(eml.occurrences_after(after, until=datetime.datetime(2009, 4, 3)))), 4)
+        self.assertEqual([o.reservation for o in eml.occurrences_after(
+            datetime.datetime(2009, 4, 15), until=datetime.datetime(2009, 4, 16))],
+            [self.reservation2])
+        # only the first chunk of the persisted occurrences is read
+        def first_occurrences():
+            list(eml.occurrences_after(after, limit=4, chunk_size=2))
+        self.assertNumQueries(2, first_occurrences)
+
+
+class TestRRuleCache(TestCase):
+    def setUp(self):
+        self.cache = RRuleCache(maxsize=2)
+        self.rule = Rule(frequency = "WEEKLY", params = "byweekday:MO,TH")
+        self.rule.save()
+        self.start = datetime.datetime(2009, 4, 1, 8, 0)
+
+    def test_hits_and_misses(self):
+        compiled = self.cache.get(self.rule, self.start)
+        self.assertEqual(compiled.after(self.start),
+            datetime.datetime(2009, 4, 2, 8, 0))
+        self.assertTrue(self.cache.get(self.rule, self.start) is compiled)
+        self.cache.get(self.rule, self.start + datetime.timedelta(days=1))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_lru_eviction(self):
+        for day in range(3):
+            self.cache.get(self.rule, self.start + datetime.timedelta(days=day))
+        self.assertEqual(len(self.cache), 2)
+        self.cache.get(self.rule, self.start)
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_eviction_forgets_rule_keys(self):
+        for day in range(3):
+            self.cache.get(self.rule, self.start + datetime.timedelta(days=day))
+        self.assertEqual(len(self.cache._rule_keys[self.rule.pk]), 2)
+        other_rule = Rule(frequency = "DAILY", params = "")
+        other_rule.save()
+        self.cache.get(other_rule, self.start)
+        self.cache.get(other_rule, self.start + datetime.timedelta(days=1))
+        self.assertEqual(self.cache._rule_keys.keys(), [other_rule.pk])
+
+    def test_invalidate(self):
+        compiled = self.cache.get(self.rule, self.start)
+        self.cache.invalidate(self.rule)
+        self.assertEqual(len(self.cache), 0)
+        self.assertFalse(self.cache.get(self.rule, self.start) is compiled)
+
+    def test_rule_save_invalidates(self):
+        reservation = Reservation(title='Weekly Reservation', start=self.start,
+            end=self.start + datetime.timedelta(hours=1), rule=self.rule)
+        reservation.get_rrule_object()
+        self.assertTrue((self.rule.frequency, self.rule.params, self.start) in rrule_cache._rrules)
+        self.rule.params = "byweekday:TU"
+        self.rule.save()
+        self.assertFalse(("WEEKLY", "byweekday:MO,TH", self.start) in rrule_cache._rrules)
+        self.assertEqual(reservation.get_rrule_object().after(self.start),
+            datetime.datetime(2009, 4, 7, 8, 0))
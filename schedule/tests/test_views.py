@@ -1,10 +1,22 @@
-import os, datetime
+import os, re, datetime
 
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.test import Client
+from django.core.cache import cache
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpRequest
+from django.template import Context, Template
 
+from django.utils import simplejson, translation
+
+from schedule import views
+from schedule.feeds import RoomIRoom
+from schedule.feeds.iroom import format_utc
+from schedule.models import Reservation, Room, Rule
+from schedule.periods import Month
 from schedule.views import check_next_url, coerce_date_dict
+from schedule.templatetags import scheduletags
 from schedule.templatetags.scheduletags import querystring_for_date
 
 class TestViewUtils(TestCase):
@@ -95,6 +107,21 @@ class TestUrls(TestCase):
         self.assertEqual(self.response.status_code, 200)
         c.logout()
 
+    def test_reservation_creation_conflict(self):
+        c.login(username="admin", password="admin")
+        data = {'title': 'title', 'description': 'description',
+                'start_0': '2008-10-30', 'start_1': '09:00:00',
+                'end_0': '2008-10-30', 'end_1': '10:00:00'}
+        url = reverse("room_create_reservation", kwargs={"room_slug": 'example'})
+        self.assertEqual(c.post(url, data).status_code, 302)
+        count = Reservation.objects.count()
+        data.update({'start_1': '09:30:00', 'end_1': '10:30:00'})
+        self.response = c.post(url, data)
+        self.assertEqual(self.response.status_code, 200)
+        self.assertTrue(self.response.context['form'].non_field_errors())
+        self.assertEqual(Reservation.objects.count(), count)
+        c.logout()
+
     def test_view_reservation(self):
         self.response = c.get(reverse("reservation",kwargs={"reservation_id":1}), {})
         self.assertEqual(self.response.status_code, 200)
@@ -120,3 +147,334 @@ class TestUrls(TestCase):
         self.assertEqual(self.response.status_code, 404)
         c.logout()
 
+
+class TestFreeSlots(TestCase):
+
+    def setUp(self):
+        room = Room(name="Room", slug="room")
+        room.save()
+        Room(name="Other Room", slug="other-room").save()
+        Reservation(title='Meeting', room=room,
+            start=datetime.datetime(2008, 1, 2, 8, 0),
+            end=datetime.datetime(2008, 1, 2, 9, 30)).save()
+
+    def get_slots(self, **params):
+        response = c.get(reverse("free_slots"), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return simplejson.loads(response.content)['slots']
+
+    def test_free_slots(self):
+        slots = self.get_slots(room='room', start='2008-01-02T07:00',
+            end='2008-01-02T12:00', limit=3)
+        self.assertEqual(slots, [
+            {'room': 'room', 'start': '2008-01-02T07:00:00', 'end': '2008-01-02T08:00:00'},
+            {'room': 'room', 'start': '2008-01-02T09:30:00', 'end': '2008-01-02T10:30:00'},
+            {'room': 'room', 'start': '2008-01-02T10:30:00', 'end': '2008-01-02T11:30:00'},
+        ])
+
+    def test_free_slots_of_all_rooms(self):
+        slots = self.get_slots(start='2008-01-02T08:00', duration='30')
+        self.assertEqual([(slot['room'], slot['start'][11:16]) for slot in slots[:3]],
+            [('other-room', '08:00'), ('other-room', '08:30'), ('other-room', '09:00')])
+        self.assertEqual(len(slots), 10)
+
+    def test_invalid_parameters(self):
+        response = c.get(reverse("free_slots"), {'start': 'tomorrow'})
+        self.assertEqual(response.status_code, 404)
+        response = c.get(reverse("free_slots"), {'duration': '0'})
+        self.assertEqual(response.status_code, 404)
+
+
+class TestRoomPageCache(TestCase):
+
+    fixtures = ['schedule.json']
+
+    def setUp(self):
+        self.room = Room(name="Room", slug="room")
+        self.room.save()
+        self.old_timeout = views.ROOM_PAGE_CACHE_TIMEOUT
+        views.ROOM_PAGE_CACHE_TIMEOUT = 60
+        cache.clear()
+
+    def tearDown(self):
+        views.ROOM_PAGE_CACHE_TIMEOUT = self.old_timeout
+
+    def get(self, **headers):
+        return c.get(reverse("year_room", kwargs={"room_slug": 'room'}),
+            {'year': 2008}, **headers)
+
+    def test_cached_page(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+        # served from the cache, without rendering
+        cached = self.get()
+        self.assertEqual(cached.content, response.content)
+        self.assertTrue(cached.context is None)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # a new reservation changes the page
+        Reservation(title='Meeting', room=self.room,
+            start=datetime.datetime(2008, 1, 2, 8, 0),
+            end=datetime.datetime(2008, 1, 2, 9, 0)).save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        # and so does logging in
+        c.login(username="admin", password="admin")
+        try:
+            self.assertNotEqual(self.get()['ETag'], response['ETag'])
+        finally:
+            c.logout()
+        # and so does the language
+        translation.activate('fr')
+        try:
+            self.assertNotEqual(self.get()['ETag'], response['ETag'])
+        finally:
+            translation.deactivate()
+        self.assertEqual(self.get()['ETag'], response['ETag'])
+
+
+class TestFragmentCache(TestCase):
+
+    def setUp(self):
+        self.room = Room(name="Room", slug="room")
+        self.room.save()
+        Reservation(title='Meeting', room=self.room,
+            start=datetime.datetime(2008, 1, 2, 8, 0),
+            end=datetime.datetime(2008, 1, 2, 9, 0)).save()
+        self.old_timeout = scheduletags.FRAGMENT_CACHE_TIMEOUT
+        scheduletags.FRAGMENT_CACHE_TIMEOUT = 60
+        self.old_cache = scheduletags.fragment_cache
+        scheduletags.fragment_cache = self.fragment_cache = scheduletags.FragmentCache()
+        cache.clear()
+
+    def tearDown(self):
+        scheduletags.FRAGMENT_CACHE_TIMEOUT = self.old_timeout
+        scheduletags.fragment_cache = self.old_cache
+
+    def get(self, name, **params):
+        response = c.get(reverse(name, kwargs={"room_slug": 'room'}), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_month_tables(self):
+        content = self.get("year_room", year=2008).content
+        self.assertEqual(self.fragment_cache.misses['month_table'], 12)
+        self.assertEqual(self.fragment_cache.hits['month_table'], 0)
+        self.assertEqual(self.get("year_room", year=2008).content, content)
+        self.assertEqual(self.fragment_cache.hits['month_table'], 12)
+        # the small tables of the year are shared with the other views
+        self.get("tri_month_room", year=2008, month=2)
+        self.get("compact_room", year=2008, month=1)
+        self.assertEqual(self.fragment_cache.hits['month_table'], 16)
+        self.assertEqual(self.fragment_cache.misses['month_table'], 12)
+        # the regular table needs the occurrences of the cells
+        self.assertTrue('Meeting' in self.get("month_room", year=2008, month=1).content)
+        self.assertEqual(self.fragment_cache.misses['month_table'], 13)
+        self.assertEqual(self.fragment_cache.hit_rate('month_table'), 16.0 / 29)
+        # changing the reservations of the room renders the tables again
+        Reservation(title='Workshop', room=self.room,
+            start=datetime.datetime(2008, 3, 2, 8, 0),
+            end=datetime.datetime(2008, 3, 2, 9, 0)).save()
+        self.get("year_room", year=2008)
+        self.assertEqual(self.fragment_cache.misses['month_table'], 25)
+
+    def test_day_cell(self):
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        month = Month(Reservation.objects.all(), datetime.datetime(2008, 1, 1))
+        day = list(month.get_days())[1]
+        template = Template('{% load scheduletags %}{% day_cell room day month %}')
+        content = template.render(Context({'request': request, 'room': self.room,
+            'day': day, 'month': month}))
+        self.assertTrue('Meeting' in content)
+        self.assertEqual(template.render(Context({'request': request, 'room': self.room,
+            'day': day, 'month': month})), content)
+        self.assertEqual((self.fragment_cache.hits['day_cell'], self.fragment_cache.misses['day_cell']),
+            (1, 1))
+        self.assertEqual(self.fragment_cache.hit_rate(), 0.5)
+        # the cell is rendered again in another language
+        translation.activate('fr')
+        try:
+            template.render(Context({'request': request, 'room': self.room,
+                'day': day, 'month': month}))
+        finally:
+            translation.deactivate()
+        self.assertEqual(self.fragment_cache.misses['day_cell'], 2)
+
+    def test_daily_table(self):
+        response = self.get("day_room", year=2008, month=1, day=2)
+        self.assertTrue('Meeting' in response.content)
+        self.assertEqual(self.fragment_cache.misses['daily_table'], 2)
+        self.assertEqual(self.get("day_room", year=2008, month=1, day=2).content,
+            response.content)
+        self.assertEqual(self.fragment_cache.hits['daily_table'], 2)
+        # the tables have links for the logged in users
+        c.login(username="admin", password="admin")
+        try:
+            self.get("day_room", year=2008, month=1, day=2)
+        finally:
+            c.logout()
+
+
+class TestRoomOccurrences(TestCase):
+
+    def setUp(self):
+        room = Room(name="Room", slug="room")
+        room.save()
+        daily = Rule(frequency="DAILY")
+        daily.save()
+        self.daily = Reservation(title='Daily', room=room, rule=daily,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0),
+            end_recurring_period=datetime.datetime(2008, 1, 6))
+        self.daily.save()
+        self.other = Reservation(title='Other', room=room, rule=daily,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 10, 0),
+            end_recurring_period=datetime.datetime(2008, 1, 4))
+        self.other.save()
+        self.daily.get_occurrence(datetime.datetime(2008, 1, 2, 8, 0)).cancel()
+
+    def get(self, **params):
+        response = c.get(reverse("room_occurrences", kwargs={"room_slug": 'room'}), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return simplejson.loads(response.content)
+
+    def test_window(self):
+        data = self.get(start='2008-01-02', end='2008-01-03')
+        self.assertEqual(data, {'next': None, 'occurrences': [
+            {'reservation': self.daily.pk, 'title': 'Daily', 'start': '2008-01-02T08:00:00',
+             'end': '2008-01-02T09:00:00', 'cancelled': True},
+            {'reservation': self.other.pk, 'title': 'Other', 'start': '2008-01-02T08:00:00',
+             'end': '2008-01-02T10:00:00', 'cancelled': False}]})
+        data = self.get(start='2008-01-01', end='2008-01-10', fields='title,start')
+        self.assertEqual(len(data['occurrences']), 8)
+        self.assertEqual(data['occurrences'][-1], {'title': 'Daily', 'start': '2008-01-05T08:00:00'})
+
+    def test_pages(self):
+        # the occurrences going on at 8:30 on the 1st are included
+        data = self.get(after='2008-01-01T08:30', limit=3, fields='title,start')
+        pages = [data['occurrences']]
+        while data['next']:
+            data = self.get(cursor=data['next'], limit=3, fields='title,start')
+            pages.append(data['occurrences'])
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual([(o['title'], o['start'][8:10]) for page in pages for o in page],
+            [('Daily', '01'), ('Other', '01'), ('Daily', '02'), ('Other', '02'),
+             ('Daily', '03'), ('Other', '03'), ('Daily', '04'), ('Daily', '05')])
+        # an occurrence ending before the first page is not on the next ones
+        data = self.get(after='2008-01-01T09:30', limit=1, fields='title')
+        self.assertEqual(data['occurrences'], [{'title': 'Other'}])
+        self.assertEqual(self.get(cursor=data['next'], limit=1, fields='title,start')['occurrences'],
+            [{'title': 'Daily', 'start': '2008-01-02T08:00:00'}])
+
+    def test_pages_with_ties(self):
+        room = Room.objects.get(slug='room')
+        daily = Rule.objects.get(frequency="DAILY")
+        for i in range(3):
+            Reservation(title='Tie %d' % i, room=room, rule=daily,
+                start=datetime.datetime(2008, 1, 1, 8, 0),
+                end=datetime.datetime(2008, 1, 1, 9, 0),
+                end_recurring_period=datetime.datetime(2008, 1, 4)).save()
+        expected = [(o['reservation'], o['start']) for o in
+            self.get(start='2008-01-01T08:30', end='2008-01-10')['occurrences']]
+        self.assertEqual(len(expected), 17)
+        for limit in range(1, 8):
+            data = self.get(after='2008-01-01T08:30', limit=limit, fields='reservation,start')
+            occurrences = data['occurrences']
+            while data['next']:
+                data = self.get(cursor=data['next'], limit=limit, fields='reservation,start')
+                occurrences += data['occurrences']
+            self.assertEqual(sorted((o['reservation'], o['start']) for o in occurrences),
+                sorted(expected))
+            self.assertEqual([o['start'] for o in occurrences],
+                sorted(o['start'] for o in occurrences))
+
+    def test_invalid_parameters(self):
+        url = reverse("room_occurrences", kwargs={"room_slug": 'room'})
+        for params in ({'start': '2008-01-01'}, {'start': 'today', 'end': '2008-01-02'},
+                {'cursor': 'nope'}, {'limit': '0'}, {'fields': 'title,secret'}):
+            self.assertEqual(c.get(url, params).status_code, 404)
+        self.assertEqual(c.get(reverse("room_occurrences", kwargs={"room_slug": 'nope'})).status_code, 404)
+
+
+
+class TestRoomIRoom(TestCase):
+
+    def setUp(self):
+        self.room = Room(name="Room", slug="room")
+        self.room.save()
+        daily = Rule(frequency="DAILY")
+        daily.save()
+        self.daily = Reservation(title='Daily, early', room=self.room, rule=daily,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0),
+            end_recurring_period=datetime.datetime(2008, 1, 6, 8, 0))
+        self.daily.save()
+        self.once = Reservation(title='Once', room=self.room,
+            start=datetime.datetime(2008, 1, 3, 12, 0),
+            end=datetime.datetime(2008, 1, 3, 13, 0))
+        self.once.save()
+        self.daily.get_occurrence(datetime.datetime(2008, 1, 2, 8, 0)).cancel()
+        moved = self.daily.get_occurrence(datetime.datetime(2008, 1, 3, 8, 0))
+        moved.move(datetime.datetime(2008, 1, 3, 10, 0), datetime.datetime(2008, 1, 3, 11, 0))
+        # persisted but unchanged, it needs no VEVENT of its own
+        self.daily.get_occurrence(datetime.datetime(2008, 1, 4, 8, 0)).save()
+
+    def test_calendar(self):
+        response = c.get(reverse('room_ical', args=[self.room.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        content = response.content
+        self.assertTrue(content.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertTrue(content.endswith('END:VCALENDAR\r\n'))
+        events = content.split('BEGIN:VEVENT\r\n')[1:]
+        self.assertEqual(len(events), 3)
+        master, moved, once = [dict(line.split(':', 1) for line in event.splitlines()[:-1])
+            for event in events]
+        self.assertEqual(master['UID'], 'reservation-%s@example.com' % self.daily.pk)
+        self.assertTrue(re.match(r'^\d{8}T\d{6}Z$', master['DTSTAMP']))
+        self.assertEqual(master['CREATED'], format_utc(self.daily.created_on))
+        self.assertTrue(master['CREATED'].endswith('Z'))
+        self.assertEqual(once['DTSTAMP'], master['DTSTAMP'])
+        self.assertEqual(master['SUMMARY'], 'Daily\\, early')
+        self.assertEqual(master['DTSTART'], '20080101T080000')
+        self.assertEqual(master['RRULE'], 'FREQ=DAILY;UNTIL=20080106T075959')
+        self.assertEqual(master['EXDATE'], '20080102T080000')
+        self.assertEqual(moved['UID'], master['UID'])
+        self.assertEqual(moved['RECURRENCE-ID'], '20080103T080000')
+        self.assertEqual(moved['DTSTART'], '20080103T100000')
+        self.assertEqual(moved['DTEND'], '20080103T110000')
+        self.assertEqual(once['UID'], 'reservation-%s@example.com' % self.once.pk)
+        self.assertFalse('RRULE' in once)
+
+    def test_count_and_folding(self):
+        Rule(frequency="WEEKLY", params="count:10").save()
+        weekly = Rule.objects.get(frequency="WEEKLY")
+        Reservation(title='W' * 100, room=self.room, rule=weekly,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0),
+            end_recurring_period=datetime.datetime(2008, 1, 22, 8, 0)).save()
+        content = c.get(reverse('room_ical', args=[self.room.pk])).content
+        self.assertTrue('RRULE:FREQ=WEEKLY;COUNT=3\r\n' in content)
+        self.assertTrue(max(len(line) for line in content.split('\r\n')) <= 75)
+        self.assertTrue('SUMMARY:' + 'W' * 67 + '\r\n ' + 'W' * 33 + '\r\n' in content)
+
+    def test_overlapping_requests(self):
+        other = Room(name="Other", slug="other")
+        other.save()
+        Reservation(title='Elsewhere', room=other,
+            start=datetime.datetime(2008, 1, 3, 12, 0),
+            end=datetime.datetime(2008, 1, 3, 13, 0)).save()
+        feed = RoomIRoom()
+        # the first response is only written after the second request
+        first = feed(HttpRequest(), str(self.room.pk))
+        second = feed(HttpRequest(), str(other.pk))
+        self.assertTrue('SUMMARY:Once' in first.content)
+        self.assertFalse('Elsewhere' in first.content)
+        self.assertTrue('SUMMARY:Elsewhere' in second.content)
+        self.assertEqual(c.get(reverse('room_ical', args=[0])).status_code, 404)
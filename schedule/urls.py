@@ -47,6 +47,16 @@ url(r'^room/daily/(?P<room_slug>[-\w]+)/$',
     name = "day_room",
     kwargs={'periods': [Day], 'template_name': 'schedule/room_day.html'}),
 
+url(r'^room/free_slots\.json$',
+    'schedule.views.free_slots',
+    name = "free_slots",
+    ),
+
+url(r'^room/(?P<room_slug>[-\w]+)/occurrences\.json$',
+    'schedule.views.room_occurrences',
+    name = "room_occurrences",
+    ),
+
 url(r'^room/(?P<room_slug>[-\w]+)/$',
     'schedule.views.room',
     name = "room_home",
@@ -94,7 +104,7 @@ url(r'^feed/room/(.*)/$',
     'django.contrib.syndication.views.feed', 
     { "feed_dict": { "upcoming": UpcomingReservationsFeed } }),
  
-(r'^ical/room/(.*)/$', RoomIRoom()),
+url(r'^ical/room/(.*)/$', RoomIRoom(), name="room_ical"),
 
  url(r'^$', object_list, info_dict, name='schedule'), 
 )
@@ -1,9 +1,16 @@
+import binascii
 import datetime
 import heapq
+import itertools
+import threading
+from collections import OrderedDict
+from dateutil import rrule
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, Q
 from django.http import HttpResponseRedirect
 from django.conf import settings
-from schedule.conf.settings import CHECK_PERMISSION_FUNC
+from schedule.conf.settings import CHECK_PERMISSION_FUNC, RRULE_CACHE_SIZE
+from schedule.recurrence import _microseconds
 
 class ReservationListManager(object):
     """
@@ -14,37 +21,102 @@ class ReservationListManager(object):
     def __init__(self, reservations):
         self.reservations = reservations
 
-    def occurrences_after(self, after=None):
+    def get_occurrences(self, start, end):
+        """
+        Returns a sorted list of the occurrences of all of the reservations in
+        ``self.reservations`` from start to end.
+        """
+        from schedule.models import Reservation
+        return Reservation.objects.get_occurrences_for(self.reservations, start, end)
+
+    def occurrences_after(self, after=None, limit=None, until=None, chunk_size=100):
         """
         It is often useful to know what the next occurrence is given a list of
-        reservations.  This function produces a generator that yields the
-        the most recent occurrence after the date ``after`` from any of the
-        reservations in ``self.reservations``
+        reservations.  This function produces a generator that yields, sorted
+        by start, the occurrences ending after the date ``after`` of the
+        reservations in ``self.reservations``, including the persisted
+        occurrences moved there from elsewhere.  Occurrences starting at the
+        same time come in the order of ``occurrence_key``.  It stops after ``limit``
+        occurrences or at the first one starting at ``until`` or later.
+
+        The persisted occurrences are read ``chunk_size`` at a time, as far as
+        the generated ones have gone.
         """
         from schedule.models import Occurrence
         if after is None:
             after = datetime.datetime.now()
-        occ_replacer = OccurrenceReplacer(
-            Occurrence.objects.filter(reservation__in = self.reservations))
-        generators = [reservation._occurrences_after_generator(after) for reservation in self.reservations]
-        occurrences = []
+        reservations = list(self.reservations)
+        reservation_map = dict((reservation.pk, reservation) for reservation in reservations
+            if reservation.pk is not None)
+        reservation_ids = reservation_map.keys()
+        def with_reservation(occurrences):
+            for occ in occurrences:
+                occ.reservation = reservation_map[occ.reservation_id]
+                yield occ
+        persisted = Occurrence.objects.filter(reservation__in = reservation_ids,
+            original_end__gt = after)
+        moved = Occurrence.objects.filter(reservation__in = reservation_ids,
+            end__gt = after).exclude(start = F('original_start'), end = F('original_end'))
+        if until is not None:
+            persisted = persisted.filter(original_start__lt = until)
+            moved = moved.filter(start__lt = until)
+        occ_replacer = LazyOccurrenceReplacer(
+            with_reservation(iter_chunks(persisted, 'original_start', chunk_size)))
+        generated = merge_occurrences(*[reservation._occurrences_after_generator(after)
+            for reservation in reservations])
+        occurrences = merge_occurrences(
+            (occ for occ in itertools.imap(occ_replacer.get_occurrence, generated) if not occ.moved),
+            with_reservation(iter_chunks(moved, 'start', chunk_size)))
+        if until is not None:
+            occurrences = itertools.takewhile(lambda occ: occ.start < until, occurrences)
+        return itertools.islice(occurrences, limit)
 
-        for generator in generators:
-            try:
-                heapq.heappush(occurrences, (generator.next(), generator))
-            except StopIteration:
-                pass
 
-        while True:
-            if len(occurrences) == 0: raise StopIteration
+def occurrence_key(occ):
+    """
+    Returns the key sorting occurrences by start.  It tells any two
+    occurrences apart, unlike the comparisons of the occurrences themselves
+    which only look at start and end.
+    """
+    return (occ.start, occ.end, occ.reservation_id, occ.original_start)
+
 
-            generator=occurrences[0][1]
+def _decorate_by_start(index, occurrences):
+    for number, occ in enumerate(occurrences):
+        yield (occ.start, index, number, occ)
 
-            try:
-                next = heapq.heapreplace(occurrences, (generator.next(), generator))[0]
-            except StopIteration:
-                next = heapq.heappop(occurrences)[0]
-            yield occ_replacer.get_occurrence(next)
+
+def merge_occurrences(*iterables):
+    """
+    Merges iterables of occurrences sorted by start into one iterator
+    sorted by ``occurrence_key``.  Only the occurrences starting at the
+    same time are held in memory at once.
+    """
+    merged = heapq.merge(*[_decorate_by_start(index, occurrences)
+        for index, occurrences in enumerate(iterables)])
+    merged = (item[-1] for item in merged)
+    for start, group in itertools.groupby(merged, lambda occ: occ.start):
+        for occ in sorted(group, key=occurrence_key):
+            yield occ
+
+
+def iter_chunks(queryset, field, chunk_size=100):
+    """
+    Yields the objects of ``queryset`` sorted by ``field`` and then by pk,
+    running one query per ``chunk_size`` objects, and only when the
+    previous ones have all been consumed.
+    """
+    queryset = queryset.order_by(field, 'pk')
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        value = getattr(last, field)
+        chunk = list(queryset.filter(Q(**{field + '__gt': value}) |
+            Q(**{field: value, 'pk__gt': last.pk}))[:chunk_size])
 
 
 class OccurrenceReplacer(object):
@@ -77,6 +149,186 @@ class OccurrenceReplacer(object):
         """
         return [occ for key,occ in self.lookup.items() if (occ.start < end and occ.end >= start and not occ.cancelled)]
 
+    def replace_occurrences(self, occurrences, start, end):
+        """
+        Swap the generated ``occurrences`` for their persisted counterparts
+        and add the persisted occurrences which were moved into the period
+        from start to end.
+        """
+        final_occurrences = []
+        for occ in occurrences:
+            # replace occurrences with their persisted counterparts
+            if self.has_occurrence(occ):
+                p_occ = self.get_occurrence(occ)
+                # ...but only if they are within this period
+                if p_occ.start < end and p_occ.end >= start:
+                    final_occurrences.append(p_occ)
+            else:
+                final_occurrences.append(occ)
+        # then add persisted occurrences which originated outside of this period but now
+        # fall within it
+        final_occurrences += self.get_additional_occurrences(start, end)
+        return final_occurrences
+
+
+class LazyOccurrenceReplacer(OccurrenceReplacer):
+    """
+    An OccurrenceReplacer fed from an iterator of persisted occurrences
+    sorted by original start.  The generated occurrences must be passed to
+    ``get_occurrence`` by increasing original start too, and the persisted
+    occurrences are only read as far as the last of them.
+    """
+    def __init__(self, persisted_occurrences):
+        self.lookup = {}
+        self.persisted_occurrences = iter(persisted_occurrences)
+        self.next_occurrence = None
+
+    def _read_until(self, original_start):
+        while True:
+            if self.next_occurrence is None:
+                try:
+                    self.next_occurrence = self.persisted_occurrences.next()
+                except StopIteration:
+                    return
+            occ = self.next_occurrence
+            if occ.original_start > original_start:
+                return
+            self.lookup[(occ.reservation_id, occ.original_start, occ.original_end)] = occ
+            self.next_occurrence = None
+
+    def get_occurrence(self, occ):
+        self._read_until(occ.original_start)
+        return super(LazyOccurrenceReplacer, self).get_occurrence(occ)
+
+    def has_occurrence(self, occ):
+        self._read_until(occ.original_start)
+        return super(LazyOccurrenceReplacer, self).has_occurrence(occ)
+
+
+class RRuleCache(object):
+    """
+    A process wide LRU cache of compiled ``dateutil.rrule.rrule`` objects.
+    Rules are keyed on their frequency, params and dtstart, so all of the
+    reservations sharing a rule and a start reuse the same rrule object.
+    The rrules are built with their internal cache enabled which turns
+    repeated ``between`` calls on them into lookups.
+    """
+    def __init__(self, maxsize=RRULE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._rrules = OrderedDict()
+        self._rule_keys = {}
+
+    def get(self, rule, dtstart):
+        """
+        Returns the compiled rrule of ``rule`` starting at ``dtstart``.
+        """
+        key = (rule.frequency, rule.params, dtstart)
+        self._lock.acquire()
+        try:
+            if key in self._rrules:
+                self.hits += 1
+                # move the key to the most recently used end
+                compiled, rule_pk = self._rrules.pop(key)
+                self._rrules[key] = (compiled, rule_pk)
+                return compiled
+            self.misses += 1
+        finally:
+            self._lock.release()
+        frequency = rrule.__dict__[rule.frequency]
+        compiled = rrule.rrule(frequency, dtstart=dtstart, cache=True, **rule.get_params())
+        self._lock.acquire()
+        try:
+            # the entries remember the rule they were compiled for, so that
+            # evicting them also forgets them in _rule_keys
+            self._rrules[key] = (compiled, rule.pk)
+            if rule.pk is not None:
+                self._rule_keys.setdefault(rule.pk, set()).add(key)
+            while len(self._rrules) > self.maxsize:
+                evicted, (_, rule_pk) = self._rrules.popitem(last=False)
+                rule_keys = self._rule_keys.get(rule_pk)
+                if rule_keys is not None:
+                    rule_keys.discard(evicted)
+                    if not rule_keys:
+                        del self._rule_keys[rule_pk]
+        finally:
+            self._lock.release()
+        return compiled
+
+    def invalidate(self, rule):
+        """
+        Drops the compiled rrules of ``rule``.
+        """
+        self._lock.acquire()
+        try:
+            for key in self._rule_keys.pop(rule.pk, ()):
+                self._rrules.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._rrules.clear()
+            self._rule_keys.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._rrules)
+
+rrule_cache = RRuleCache()
+
+
+def get_availability_bitmap(spans, start, end, granularity):
+    """
+    Returns a bitmap with one bit per ``granularity`` long slot from start to
+    end, packed into a string, most significant bit first.  The bit of a
+    slot is set if the slot is free, i.e. does not overlap any of the
+    (start, end) ``spans``.  The slots are painted with slice assignments,
+    one per span, so the cost does not depend on the number of slots a
+    span covers.
+
+    >>> start = datetime.datetime(2008, 1, 1, 8, 0)
+    >>> spans = [(datetime.datetime(2008, 1, 1, 8, 30), datetime.datetime(2008, 1, 1, 9, 15))]
+    >>> bitmap = get_availability_bitmap(spans, start,
+    ...     datetime.datetime(2008, 1, 1, 12, 0), datetime.timedelta(minutes=30))
+    >>> [is_slot_free(bitmap, index) for index in range(8)]
+    [True, False, False, True, True, True, True, True]
+    """
+    step = _microseconds(granularity)
+    slots = -(-_microseconds(end - start) // step)
+    flags = bytearray('1' * slots)
+    for o_start, o_end in spans:
+        first = max(_microseconds(o_start - start) // step, 0)
+        last = min(-(-_microseconds(o_end - start) // step), slots)
+        if first < last:
+            flags[first:last] = '0' * (last - first)
+    return pack_bits(flags)
+
+def pack_bits(flags):
+    """
+    Packs a string of '0' and '1' characters into a string of bytes, padding
+    the last byte with 0 bits.
+
+    >>> pack_bits('1000000011')
+    '\\x80\\xc0'
+    """
+    digits = str(flags)
+    digits += '0' * (-len(digits) % 8)
+    if not digits:
+        return ''
+    return binascii.unhexlify('%0*x' % (len(digits) // 4, int(digits, 2)))
+
+def is_slot_free(bitmap, index):
+    """
+    Returns whether the slot ``index`` of an availability bitmap is free.
+    """
+    return bool(ord(bitmap[index // 8]) & (0x80 >> (index % 8)))
+
 
 class check_reservation_permissions(object):
 
@@ -123,3 +375,21 @@ def coerce_date_dict(date_dict):
             break
     return modified and retVal or {}
 
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+def coerce_datetime(value):
+    """
+    Parses a datetime from a query string value in one of DATETIME_FORMATS.
+    Raises a ValueError if it is not in any of them.
+
+    >>> coerce_datetime('2008-01-05T08:30')
+    datetime.datetime(2008, 1, 5, 8, 30)
+    >>> coerce_datetime('2008-01-05')
+    datetime.datetime(2008, 1, 5, 0, 0)
+    """
+    for format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except (TypeError, ValueError):
+            pass
+    raise ValueError("%r is not a valid datetime" % value)
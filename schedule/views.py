@@ -1,7 +1,17 @@
+import hashlib
+import time
 from urllib import quote
 from django.shortcuts import render_to_response, get_object_or_404
 from django.views.generic.create_update import delete_object
-from django.http import HttpResponseRedirect, Http404, HttpResponse
+from django.core.cache import cache
+from django.core.exceptions import NON_FIELD_ERRORS
+from django.db import transaction
+from django.http import HttpResponseRedirect, Http404, HttpResponse, HttpResponseNotModified
+from django.template.loader import render_to_string
+from django.utils.http import http_date, parse_etags, quote_etag
+from django.utils import simplejson
+from django.utils import translation
+from django.utils.translation import ugettext as _
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
@@ -10,10 +20,12 @@ from django.views.generic.create_update import delete_object
 import datetime
 
 from schedule.conf.settings import GET_EVENTS_FUNC, OCCURRENCE_CANCEL_REDIRECT
+from schedule.conf.settings import PERMISSION_CLASS_FUNC, ROOM_PAGE_CACHE_TIMEOUT
 from schedule.forms import ReservationForm, OccurrenceForm
 from schedule.models import *
-from schedule.periods import weekday_names
-from schedule.utils import check_reservation_permissions, coerce_date_dict
+from schedule.periods import weekday_names, OccurrenceCache
+from schedule.utils import ReservationListManager, check_reservation_permissions, coerce_date_dict, coerce_datetime
+from schedule.utils import occurrence_key
 
 def room(request, room_slug, template='schedule/room.html', extra_context=None):
     """
@@ -66,6 +78,9 @@ def room_by_periods(request, room_slug, periods=None,
         This is for convenience. It returns the local names of weekedays for
         internationalization.
 
+    If ROOM_PAGE_CACHE_TIMEOUT is set, the rendered page is cached for the
+    version of the room, the periods and the permission class of the user,
+    and answered with a 304 if the browser already has it.
     """
     extra_context = extra_context or {}
     room = get_object_or_404(Room, slug=room_slug)
@@ -78,7 +93,9 @@ def room_by_periods(request, room_slug, periods=None,
     else:
         date = datetime.datetime.now()
     reservation_list = GET_EVENTS_FUNC(request, room)
-    period_objects = dict([(period.__name__.lower(), period(reservation_list, date)) for period in periods])
+    occurrence_cache = OccurrenceCache(reservation_list)
+    period_objects = dict([(period.__name__.lower(), period(reservation_list, date,
+        occurrence_cache=occurrence_cache)) for period in periods])
     context = {
             'date': date,
             'periods': period_objects,
@@ -87,7 +104,28 @@ def room_by_periods(request, room_slug, periods=None,
             'here':quote(request.get_full_path()),
         }
     context.update(extra_context)
-    return render_to_response(template_name, context, context_instance=RequestContext(request),)
+    if not ROOM_PAGE_CACHE_TIMEOUT:
+        return render_to_response(template_name, context, context_instance=RequestContext(request),)
+    # the names of days and months are translated when the page renders
+    cache_key = 'schedule.room_by_periods.%s.%s.%s.%s.%s.%s.%s' % (room.pk, room.version,
+        PERMISSION_CLASS_FUNC(request, room), translation.get_language(),
+        '.'.join(['%s-%s' % (name, period.start.strftime('%Y%m%d%H%M%S'))
+            for name, period in sorted(period_objects.items())]),
+        hashlib.md5(template_name).hexdigest(),
+        hashlib.md5(request.get_full_path()).hexdigest())
+    etag = hashlib.md5(cache_key).hexdigest()
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        content = cache.get(cache_key)
+        if content is None:
+            content = render_to_string(template_name, context, context_instance=RequestContext(request))
+            cache.set(cache_key, content, ROOM_PAGE_CACHE_TIMEOUT)
+        response = HttpResponse(content)
+    response['ETag'] = quote_etag(etag)
+    if room.last_modified is not None:
+        response['Last-Modified'] = http_date(time.mktime(room.last_modified.timetuple()))
+    return response
 
 def reservation(request, reservation_id, template_name="schedule/reservation.html", extra_context=None):
     """
@@ -278,10 +316,12 @@ def create_or_edit_reservation(request, room_slug, reservation_id=None, next=Non
         if instance is None:
             reservation.creator = request.user
             reservation.room = room
-        reservation.save()
-        next = next or reverse('reservation', args=[reservation.id])
-        next = get_next_url(request, next)
-        return HttpResponseRedirect(next)
+        if save_reservation_unless_conflicting(reservation):
+            next = next or reverse('reservation', args=[reservation.id])
+            next = get_next_url(request, next)
+            return HttpResponseRedirect(next)
+        form._errors[NON_FIELD_ERRORS] = form.error_class(
+            [_("This reservation conflicts with another reservation of the room.")])
 
     next = get_next_url(request, next)
     context = {
@@ -292,6 +332,22 @@ def create_or_edit_reservation(request, room_slug, reservation_id=None, next=Non
     context.update(extra_context)
     return render_to_response(template_name, context, context_instance=RequestContext(request))
 
+def save_reservation_unless_conflicting(reservation):
+    """
+    Saves ``reservation`` and returns True, unless one of its occurrences
+    conflicts with an occurrence of another reservation of its room.  The
+    check locks the room and runs in the same transaction as the save, so
+    two concurrent bookings of the same slot cannot both succeed.
+    """
+    conflicts = Reservation.objects.find_conflicts(reservation.room,
+        reservation.start, reservation.end, rule=reservation.rule,
+        end_recurring_period=reservation.end_recurring_period,
+        exclude=reservation.pk, lock=True)
+    if conflicts:
+        return False
+    reservation.save()
+    return True
+save_reservation_unless_conflicting = transaction.commit_on_success(save_reservation_unless_conflicting)
 
 @check_reservation_permissions
 def delete_reservation(request, reservation_id, next=None, login_required=True, extra_context=None):
@@ -317,6 +373,160 @@ def delete_reservation(request, reservation_id, next=None, login_required=True,
                          login_required = login_required
                         )
 
+def free_slots(request, max_limit=100):
+    """
+    Returns the earliest free slots of a set of rooms as JSON.  The request
+    can have these GET variables:
+
+    ``room``
+        the slug of a room to search, can be repeated; all the rooms are
+        searched if it is not given
+    ``start``, ``end``
+        the window to search in, as YYYY-MM-DDTHH:MM; defaults to the next
+        seven days
+    ``duration``
+        the length of the slots in minutes, 60 by default
+    ``limit``
+        the maximum number of slots to return, 10 by default, at most
+        ``max_limit``
+
+    The response looks like {"slots": [{"room": slug, "start": ..., "end":
+    ...}, ...]}.
+    """
+    rooms = Room.objects.all()
+    slugs = request.GET.getlist('room')
+    if slugs:
+        rooms = rooms.filter(slug__in=slugs)
+    try:
+        start = coerce_datetime(request.GET.get('start') or
+            datetime.datetime.now().strftime('%Y-%m-%dT%H:%M'))
+        if 'end' in request.GET:
+            end = coerce_datetime(request.GET['end'])
+        else:
+            end = start + datetime.timedelta(days=7)
+        duration = datetime.timedelta(minutes=int(request.GET.get('duration', 60)))
+        limit = min(int(request.GET.get('limit', 10)), max_limit)
+    except ValueError:
+        raise Http404
+    if duration <= datetime.timedelta(0) or limit < 0:
+        raise Http404
+    slots = Room.objects.find_free_slots(rooms, duration, (start, end), limit)
+    data = {'slots': [{
+        'room': room.slug,
+        'start': slot_start.isoformat(),
+        'end': slot_end.isoformat(),
+    } for room, slot_start, slot_end in slots]}
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+OCCURRENCE_FIELDS = ('reservation', 'title', 'start', 'end', 'cancelled')
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+def room_occurrences(request, room_slug, default_limit=50, max_limit=500):
+    """
+    Returns the occurrences of a room as JSON, written out as they are
+    computed.  The request can have these GET variables:
+
+    ``start``, ``end``
+        the window whose occurrences are returned, as YYYY-MM-DDTHH:MM
+    ``after``
+        without a window, the occurrences ending after this date, now by
+        default, are returned a page at a time
+    ``cursor``
+        the ``next`` value of the previous page, to get the next one
+    ``limit``
+        the size of a page, ``default_limit`` by default, at most
+        ``max_limit``
+    ``fields``
+        the comma separated fields of the occurrences to return, out of
+        OCCURRENCE_FIELDS, all of them by default
+
+    The response looks like {"occurrences": [{"reservation": id, "title":
+    ..., "start": ..., "end": ..., "cancelled": false}, ...], "next":
+    cursor}, where next is null after the last page and for windows.
+    """
+    room = get_object_or_404(Room, slug=room_slug)
+    fields = request.GET.get('fields')
+    fields = fields and fields.split(',') or OCCURRENCE_FIELDS
+    if not set(fields).issubset(OCCURRENCE_FIELDS):
+        raise Http404
+    reservations = GET_EVENTS_FUNC(request, room)
+    try:
+        if 'start' in request.GET or 'end' in request.GET:
+            start = coerce_datetime(request.GET.get('start'))
+            end = coerce_datetime(request.GET.get('end'))
+            rows = iter(Reservation.objects.get_occurrence_rows(reservations, start, end))
+            next_cursor = lambda: None
+        else:
+            limit = min(int(request.GET.get('limit', default_limit)), max_limit)
+            if 'cursor' in request.GET:
+                cursor = request.GET['cursor'].split('.')
+                if len(cursor) != 5:
+                    raise ValueError
+                start, end, original_start, after = [datetime.datetime.strptime(
+                    cursor[i], CURSOR_FORMAT) for i in (0, 1, 3, 4)]
+                last = (start, end, int(cursor[2]), original_start)
+            else:
+                after = coerce_datetime(request.GET.get('after') or
+                    datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))
+                last = None
+            if limit < 1:
+                raise ValueError
+            rows, next_cursor = _occurrence_page(reservations, after, last, limit)
+    except ValueError:
+        raise Http404
+    return HttpResponse(_stream_occurrences(rows, next_cursor, fields), mimetype='application/json')
+
+def _occurrence_page(reservations, after, last, limit):
+    """
+    Returns an iterator over the (reservation_id, title, start, end,
+    cancelled) tuples of a page of ``limit`` occurrences of ``reservations``
+    ending after ``after``, and a function returning the cursor of the next
+    page once the page has been consumed.
+
+    The occurrences come in the order of ``occurrence_key``, which tells
+    apart the occurrences starting at the same time.  The first page has no
+    ``last``, the next ones begin right after the key ``last`` of the last
+    occurrence of the previous page.
+    """
+    if last is None:
+        occurrences = ReservationListManager(reservations).occurrences_after(after)
+    else:
+        # every occurrence starting at or after the last one ends after it
+        occurrences = ReservationListManager(reservations).occurrences_after(last[0])
+        occurrences = (o for o in occurrences if occurrence_key(o) > last and o.end > after)
+    state = {'count': 0, 'last': last, 'more': False}
+    def rows():
+        for occurrence in occurrences:
+            if state['count'] == limit:
+                state['more'] = True
+                return
+            state['last'] = occurrence_key(occurrence)
+            state['count'] += 1
+            yield (occurrence.reservation_id, occurrence.title, occurrence.start,
+                occurrence.end, occurrence.cancelled)
+    def next_cursor():
+        if state['more']:
+            start, end, reservation_id, original_start = state['last']
+            return '.'.join([start.strftime(CURSOR_FORMAT), end.strftime(CURSOR_FORMAT),
+                str(reservation_id), original_start.strftime(CURSOR_FORMAT),
+                after.strftime(CURSOR_FORMAT)])
+    return rows(), next_cursor
+
+def _stream_occurrences(rows, next_cursor, fields):
+    indexes = [OCCURRENCE_FIELDS.index(field) for field in fields]
+    yield '{"occurrences": ['
+    separator = ''
+    for row in rows:
+        data = {}
+        for field, index in zip(fields, indexes):
+            value = row[index]
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            data[field] = value
+        yield separator + simplejson.dumps(data)
+        separator = ', '
+    yield '], "next": %s}' % simplejson.dumps(next_cursor())
+
 def check_next_url(next):
     """
     Checks to make sure the next url is not redirecting to another page.